@@ -12,7 +12,16 @@ AS
 BEGIN
     SET NOCOUNT ON;
     
-    -- Simplificar: buscar reglas directamente sin parsear
+    -- Productos del carrito (STRING_SPLIT) y versión publicada de reglas
+    DECLARE @CartProducts TABLE (ProductId INT PRIMARY KEY);
+    INSERT INTO @CartProducts (ProductId)
+    SELECT DISTINCT TRY_CAST(LTRIM(RTRIM(value)) AS INT)
+    FROM STRING_SPLIT(@ProductIds, ',')
+    WHERE TRY_CAST(LTRIM(RTRIM(value)) AS INT) IS NOT NULL;
+    
+    DECLARE @RuleSetId INT = (SELECT RuleSetId FROM dwh.AssociationRuleSetActive WHERE Scope = 'global');
+    
+    -- Antecedente contenido completo en el carrito, consecuente fuera del carrito
     SELECT TOP (@TopN)
         par.RuleID,
         par.AntecedentProductIds,
@@ -24,11 +33,24 @@ BEGIN
         par.Lift,
         par.FechaCalculo,
         (par.Lift * par.Confidence) AS Score
-    FROM dwh.ProductAssociationRules par
-    WHERE par.Activo = 1
-      AND (
-          CHARINDEX(',' + par.AntecedentProductIds + ',', ',' + @ProductIds + ',') > 0
-          OR CHARINDEX(',' + REPLACE(par.AntecedentProductIds, ',', ',,') + ',', ',' + @ProductIds + ',') > 0
+    FROM (
+        SELECT i.RuleID, COUNT(*) AS Coincidencias
+        FROM @CartProducts cp
+        INNER JOIN dwh.ProductAssociationRuleItems i
+            ON i.ProductId = cp.ProductId
+           AND i.Role = 'A'
+           AND i.RuleSetId = @RuleSetId
+        GROUP BY i.RuleID
+    ) m
+    INNER JOIN dwh.ProductAssociationRules par
+        ON par.RuleID = m.RuleID
+       AND par.AntecedentSize = m.Coincidencias
+    WHERE NOT EXISTS (
+          SELECT 1
+          FROM dwh.ProductAssociationRuleItems c
+          INNER JOIN @CartProducts cp ON cp.ProductId = c.ProductId
+          WHERE c.RuleID = par.RuleID
+            AND c.Role = 'C'
       )
     ORDER BY par.Lift DESC, par.Confidence DESC;
 END;
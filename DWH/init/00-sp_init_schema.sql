@@ -43,10 +43,16 @@ BEGIN
         -----------------------------------------------------------------------
 
         -- FACTS & APRIORI
+        IF OBJECT_ID('dwh.AprioriItemsetCount', 'U') IS NOT NULL DROP TABLE dwh.AprioriItemsetCount;
+        IF OBJECT_ID('dwh.AprioriMiningState', 'U') IS NOT NULL DROP TABLE dwh.AprioriMiningState;
+        IF OBJECT_ID('dwh.AssociationRuleSetActive', 'U') IS NOT NULL DROP TABLE dwh.AssociationRuleSetActive;
+        IF OBJECT_ID('dwh.ProductAssociationRuleItems', 'U') IS NOT NULL DROP TABLE dwh.ProductAssociationRuleItems;
         IF OBJECT_ID('dwh.ProductAssociationRules', 'U') IS NOT NULL DROP TABLE dwh.ProductAssociationRules;
+        IF OBJECT_ID('dwh.AssociationRuleSet', 'U') IS NOT NULL DROP TABLE dwh.AssociationRuleSet;
         IF OBJECT_ID('dwh.FactTargetSales', 'U') IS NOT NULL DROP TABLE dwh.FactTargetSales;
         IF OBJECT_ID('dwh.MetasVentas', 'U') IS NOT NULL DROP TABLE dwh.MetasVentas;
         IF OBJECT_ID('dwh.FactSales', 'U') IS NOT NULL DROP TABLE dwh.FactSales;
+        IF OBJECT_ID('dwh.EtlBatch', 'U') IS NOT NULL DROP TABLE dwh.EtlBatch;
 
         -- DIMENSIONS
         IF OBJECT_ID('dwh.DimOrder', 'U') IS NOT NULL DROP TABLE dwh.DimOrder;
@@ -55,10 +61,12 @@ BEGIN
         IF OBJECT_ID('dwh.DimChannel', 'U') IS NOT NULL DROP TABLE dwh.DimChannel;
         IF OBJECT_ID('dwh.DimCategory', 'U') IS NOT NULL DROP TABLE dwh.DimCategory;
         IF OBJECT_ID('dwh.DimTime', 'U') IS NOT NULL DROP TABLE dwh.DimTime;
+        IF OBJECT_ID('dwh.ExchangeRateCalendar', 'U') IS NOT NULL DROP TABLE dwh.ExchangeRateCalendar;
         IF OBJECT_ID('dwh.DimExchangeRate', 'U') IS NOT NULL DROP TABLE dwh.DimExchangeRate;
 
         -- STAGING
         IF OBJECT_ID('staging.source_tracking', 'U') IS NOT NULL DROP TABLE staging.source_tracking;
+        IF OBJECT_ID('staging.tipo_cambio_sin_dato', 'U') IS NOT NULL DROP TABLE staging.tipo_cambio_sin_dato;
         IF OBJECT_ID('staging.tipo_cambio', 'U') IS NOT NULL DROP TABLE staging.tipo_cambio;
         IF OBJECT_ID('staging.map_producto', 'U') IS NOT NULL DROP TABLE staging.map_producto;
 
@@ -94,6 +102,16 @@ BEGIN
         );
         CREATE INDEX idx_stg_fecha_cambio ON staging.tipo_cambio(fecha);
 
+        -- Días hábiles que el BCCR ya respondió sin dato (feriados): la sincronización
+        -- por huecos no los vuelve a consultar
+        CREATE TABLE staging.tipo_cambio_sin_dato (
+            fecha DATE NOT NULL,
+            de_moneda CHAR(3) NOT NULL,
+            a_moneda CHAR(3) NOT NULL,
+            fecha_consulta DATETIME DEFAULT GETDATE(),
+            CONSTRAINT pk_tipo_cambio_sin_dato PRIMARY KEY (fecha, de_moneda, a_moneda)
+        );
+
         CREATE TABLE staging.source_tracking (
             tracking_id INT IDENTITY(1,1) PRIMARY KEY,
             source_system NVARCHAR(50) NOT NULL,
@@ -156,8 +174,14 @@ BEGIN
         CREATE TABLE dwh.DimOrder (
             id INT IDENTITY(1,1) PRIMARY KEY,
             totalOrderUSD DECIMAL(10,2) NOT NULL,
+            -- Llave natural: sistema origen + id de la orden en ese sistema
+            source_system NVARCHAR(50) NULL,
+            source_order_key NVARCHAR(200) NULL,
             CONSTRAINT chk_total_order CHECK (totalOrderUSD >= 0)
         );
+        -- Única: el MERGE de la carga incremental asume una fila por orden de cada fuente
+        CREATE UNIQUE INDEX idx_dimorder_source ON dwh.DimOrder(source_system, source_order_key)
+            WHERE source_order_key IS NOT NULL;
 
         CREATE TABLE dwh.DimExchangeRate (
             id INT IDENTITY(1,1) PRIMARY KEY,
@@ -169,6 +193,19 @@ BEGIN
             CONSTRAINT unique_exchange_rate UNIQUE (fromCurrency, toCurrency, date)
         );
 
+        -- Una fila por día calendario con la última tasa publicada (forward-fill),
+        -- mantenida por sp_promote_exchange_rate: conversiones por equi-join
+        CREATE TABLE dwh.ExchangeRateCalendar (
+            fromCurrency VARCHAR(3) NOT NULL,
+            toCurrency VARCHAR(3) NOT NULL,
+            date DATE NOT NULL,
+            rate DECIMAL(18,6) NOT NULL,
+            exchangeRateId INT NOT NULL,
+            rateDate DATE NOT NULL,
+            CONSTRAINT pk_exchange_rate_calendar PRIMARY KEY (fromCurrency, toCurrency, date),
+            FOREIGN KEY (exchangeRateId) REFERENCES dwh.DimExchangeRate(id)
+        );
+
 
         -----------------------------------------------------------------------
         -- ================================ FACTS ===============================
@@ -187,6 +224,10 @@ BEGIN
             discountPercentage DECIMAL(5,2) DEFAULT 0,
             created_at DATETIME DEFAULT GETDATE(),
             exchangeRateId INT NULL,
+            -- Linaje: línea de staging que originó el hecho y corrida que la cargó
+            source_system NVARCHAR(50) NULL,
+            source_key NVARCHAR(200) NULL,
+            etlBatchId INT NULL,
             FOREIGN KEY (productId) REFERENCES dwh.DimProduct(id),
             FOREIGN KEY (timeId) REFERENCES dwh.DimTime(id),
             FOREIGN KEY (orderId) REFERENCES dwh.DimOrder(id),
@@ -194,6 +235,21 @@ BEGIN
             FOREIGN KEY (customerId) REFERENCES dwh.DimCustomer(id),
             FOREIGN KEY (exchangeRateId) REFERENCES dwh.DimExchangeRate(id)
         );
+        CREATE INDEX idx_factsales_source ON dwh.FactSales(source_system, source_key);
+        CREATE INDEX idx_factsales_batch ON dwh.FactSales(etlBatchId);
+
+        -- Corridas del transform staging → dwh (incremental / completo)
+        CREATE TABLE dwh.EtlBatch (
+            id INT IDENTITY(1,1) PRIMARY KEY,
+            mode VARCHAR(20) NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'RUNNING',
+            startedAt DATETIME NOT NULL DEFAULT GETDATE(),
+            finishedAt DATETIME NULL,
+            rowsInserted INT NULL,
+            CONSTRAINT chk_batch_mode CHECK (mode IN ('full', 'incremental')),
+            CONSTRAINT chk_batch_status CHECK (status IN ('RUNNING', 'OK', 'DISCARDED'))
+        );
+        CREATE INDEX idx_etlbatch_status ON dwh.EtlBatch(status, startedAt);
 
         CREATE TABLE dwh.FactTargetSales (
             id INT IDENTITY(1,1) PRIMARY KEY,
@@ -219,11 +275,26 @@ BEGIN
             CONSTRAINT unique_meta UNIQUE (customerId, productId, Anio, Mes)
         );
 
+        -- Versiones de reglas de asociación: cada corrida de Apriori carga una
+        -- versión nueva (CARGANDO) y la publica moviendo el puntero activo
+        CREATE TABLE dwh.AssociationRuleSet (
+            RuleSetId INT IDENTITY(1,1) PRIMARY KEY,
+            Scope NVARCHAR(20) NOT NULL DEFAULT 'global',   -- global | channel | country | month
+            Estado NVARCHAR(20) NOT NULL DEFAULT 'CARGANDO',
+            TotalReglas INT NOT NULL DEFAULT 0,
+            FechaCalculo DATETIME NOT NULL DEFAULT GETDATE(),
+            FechaPublicacion DATETIME NULL,
+            CONSTRAINT chk_ruleset_estado CHECK (Estado IN ('CARGANDO', 'PUBLICADA', 'RETIRADA'))
+        );
+
         -- Tabla de reglas de asociación (Apriori)
         CREATE TABLE dwh.ProductAssociationRules (
             RuleID INT IDENTITY(1,1) PRIMARY KEY,
+            RuleSetId INT NOT NULL,
+            SegmentKey NVARCHAR(100) NOT NULL DEFAULT 'global',  -- p.ej. channel=3, country=CR, month=2025-01
             AntecedentProductIds NVARCHAR(500) NOT NULL,  -- IDs separados por coma
             ConsequentProductIds NVARCHAR(500) NOT NULL,
+            AntecedentSize TINYINT NOT NULL DEFAULT 1,    -- productos en el antecedente (match exacto de carritos)
             AntecedentNames NVARCHAR(1000),  -- Nombres para display
             ConsequentNames NVARCHAR(1000),
             Support DECIMAL(10,6) NOT NULL,
@@ -233,10 +304,58 @@ BEGIN
             Activo BIT DEFAULT 1,
             CONSTRAINT chk_support CHECK (Support > 0 AND Support <= 1),
             CONSTRAINT chk_confidence CHECK (Confidence > 0 AND Confidence <= 1),
-            CONSTRAINT chk_lift CHECK (Lift > 0)
+            CONSTRAINT chk_lift CHECK (Lift > 0),
+            FOREIGN KEY (RuleSetId) REFERENCES dwh.AssociationRuleSet(RuleSetId)
         );
         CREATE INDEX idx_apriori_antecedent ON dwh.ProductAssociationRules(AntecedentProductIds);
         CREATE INDEX idx_apriori_activo ON dwh.ProductAssociationRules(Activo, Lift DESC);
+        CREATE INDEX idx_apriori_ruleset ON dwh.ProductAssociationRules(RuleSetId, SegmentKey, Lift DESC);
+
+        -- Productos de cada regla normalizados (Role: A = antecedente, C = consecuente).
+        -- Las recomendaciones buscan por ProductId con un index seek en lugar de LIKE.
+        CREATE TABLE dwh.ProductAssociationRuleItems (
+            RuleSetId INT NOT NULL,
+            RuleID INT NOT NULL,
+            ProductId INT NOT NULL,
+            Role CHAR(1) NOT NULL,
+            CONSTRAINT pk_rule_items PRIMARY KEY CLUSTERED (ProductId, Role, RuleSetId, RuleID),
+            CONSTRAINT chk_rule_items_role CHECK (Role IN ('A', 'C')),
+            FOREIGN KEY (RuleID) REFERENCES dwh.ProductAssociationRules(RuleID) ON DELETE CASCADE
+        );
+        CREATE INDEX idx_rule_items_rule ON dwh.ProductAssociationRuleItems(RuleID, Role, ProductId);
+
+        -- Puntero a la versión activa de cada alcance (global y un segmentado por
+        -- dimensión). Los lectores hacen JOIN con esta tabla; publicar una versión
+        -- es un UPDATE de la fila de su Scope.
+        CREATE TABLE dwh.AssociationRuleSetActive (
+            Scope NVARCHAR(20) NOT NULL PRIMARY KEY,
+            RuleSetId INT NULL,
+            FechaPublicacion DATETIME NULL,
+            FOREIGN KEY (RuleSetId) REFERENCES dwh.AssociationRuleSet(RuleSetId)
+        );
+        INSERT INTO dwh.AssociationRuleSetActive (Scope, RuleSetId) VALUES ('global', NULL);
+
+        -- Estado para apriori incremental: conteos de los itemsets frecuentes y
+        -- de su borde negativo (IsBorder = 1) sobre TransactionCount órdenes,
+        -- con hechos hasta LastFactId. TransactionCount NULL = estado inválido.
+        CREATE TABLE dwh.AprioriItemsetCount (
+            Itemset NVARCHAR(400) NOT NULL PRIMARY KEY,  -- IDs ordenados separados por coma
+            ItemsetSize TINYINT NOT NULL,
+            SupportCount INT NOT NULL,
+            IsBorder BIT NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE dwh.AprioriMiningState (
+            Id TINYINT NOT NULL PRIMARY KEY DEFAULT 1,
+            TransactionCount INT NULL,
+            FactRowCount INT NULL,
+            LastFactId INT NULL,
+            MinSupport DECIMAL(10,6) NULL,
+            Modo NVARCHAR(20) NULL,                      -- full | incremental
+            FechaMineria DATETIME NULL,
+            CONSTRAINT chk_mining_state_single CHECK (Id = 1)
+        );
+        INSERT INTO dwh.AprioriMiningState (Id) VALUES (1);
 
 
         -----------------------------------------------------------------------
@@ -247,11 +366,12 @@ BEGIN
         PRINT 'SCHEMA del Data Warehouse INICIALIZADO CORRECTAMENTE';
         PRINT '=========================================================';
         PRINT 'Schemas: staging, dwh';
-        PRINT 'Tablas STAGING:   3';
-        PRINT 'Tablas DIMENSION: 7';
+        PRINT 'Tablas STAGING:   4';
+        PRINT 'Tablas DIMENSION: 8';
         PRINT 'Tablas FACT:      3';
-        PRINT 'Tablas APRIORI:   1';
-        PRINT 'Total tablas:     14';
+        PRINT 'Tablas APRIORI:   6';
+        PRINT 'Tablas CONTROL:   1';
+        PRINT 'Total tablas:     22';
         PRINT '=========================================================';
 
     END TRY
@@ -380,3 +380,20 @@ BEGIN
     CREATE INDEX ix_supabase_products_category ON staging.supabase_products(category);
 END
 GO
+
+-- ====================== Control de extraccion incremental =========================
+-- High-water mark por fuente y tabla de staging (max id, _id o fecha ya extraido)
+IF OBJECT_ID('staging.etl_watermark', 'U') IS NULL
+BEGIN
+    CREATE TABLE staging.etl_watermark (
+        watermark_id     INT IDENTITY(1,1) PRIMARY KEY,
+        source_system    NVARCHAR(50) NOT NULL,
+        table_name       NVARCHAR(128) NOT NULL, -- tabla de staging destino
+        watermark_column NVARCHAR(100) NOT NULL, -- columna de la fuente
+        watermark_value  NVARCHAR(100) NULL,
+        rows_loaded      INT NULL,
+        updated_at       DATETIME DEFAULT GETDATE(),
+        CONSTRAINT uq_etl_watermark UNIQUE (source_system, table_name)
+    );
+END
+GO
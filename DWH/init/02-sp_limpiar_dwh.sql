@@ -24,6 +24,12 @@ BEGIN
         DELETE FROM dwh.FactTargetSales;
         DELETE FROM dwh.MetasVentas;
         DELETE FROM dwh.FactSales;
+        DELETE FROM dwh.EtlBatch;
+        
+        -- Estado del Apriori incremental: los conteos apuntan a hechos y productos
+        -- que se acaban de borrar; la próxima corrida incremental hará minado completo
+        UPDATE dwh.AprioriMiningState SET TransactionCount = NULL;
+        TRUNCATE TABLE dwh.AprioriItemsetCount;
         
         -- Limpiar dimensiones
         DELETE FROM dwh.DimOrder;
@@ -58,6 +64,8 @@ BEGIN
         DELETE FROM staging.supabase_products;
         DELETE FROM staging.supabase_orders;
         DELETE FROM staging.supabase_order_items;
+        -- Watermarks: staging vacio => la proxima extraccion es completa
+        DELETE FROM staging.etl_watermark;
         -- NO limpiamos staging.tipo_cambio (datos del BCCR preservados)
         
         -- Resetear identidades (DimTime no tiene IDENTITY)
@@ -67,6 +75,7 @@ BEGIN
         DBCC CHECKIDENT ('dwh.DimProduct', RESEED, 0);
         DBCC CHECKIDENT ('dwh.DimOrder', RESEED, 0);
         DBCC CHECKIDENT ('dwh.FactSales', RESEED, 0);
+        DBCC CHECKIDENT ('dwh.EtlBatch', RESEED, 0);
         DBCC CHECKIDENT ('dwh.FactTargetSales', RESEED, 0);
         DBCC CHECKIDENT ('dwh.MetasVentas', RESEED, 0);
         DBCC CHECKIDENT ('staging.source_tracking', RESEED, 0);
@@ -40,7 +40,13 @@ BEGIN
             DROP TABLE dwh.FactSales;
             PRINT '[OK] FactSales eliminada';
         END
-        
+
+        IF OBJECT_ID('dwh.EtlBatch', 'U') IS NOT NULL
+        BEGIN
+            DROP TABLE dwh.EtlBatch;
+            PRINT '[OK] EtlBatch eliminada';
+        END
+
         -- Eliminar dimensiones
         IF OBJECT_ID('dwh.DimOrder', 'U') IS NOT NULL
         BEGIN
@@ -78,6 +84,12 @@ BEGIN
             PRINT '[OK] DimTime eliminada';
         END
         
+        IF OBJECT_ID('dwh.ExchangeRateCalendar', 'U') IS NOT NULL
+        BEGIN
+            DROP TABLE dwh.ExchangeRateCalendar;
+            PRINT '[OK] ExchangeRateCalendar eliminada';
+        END
+        
         IF OBJECT_ID('dwh.DimExchangeRate', 'U') IS NOT NULL
         BEGIN
             DROP TABLE dwh.DimExchangeRate;
@@ -91,6 +103,12 @@ BEGIN
             PRINT '[OK] staging.source_tracking eliminada';
         END
         
+        IF OBJECT_ID('staging.tipo_cambio_sin_dato', 'U') IS NOT NULL
+        BEGIN
+            DROP TABLE staging.tipo_cambio_sin_dato;
+            PRINT '[OK] staging.tipo_cambio_sin_dato eliminada';
+        END
+        
         IF OBJECT_ID('staging.tipo_cambio', 'U') IS NOT NULL
         BEGIN
             DROP TABLE staging.tipo_cambio;
@@ -151,6 +169,12 @@ BEGIN
             PRINT '[OK] staging.supabase_users eliminada';
         END
         
+        IF OBJECT_ID('staging.etl_watermark', 'U') IS NOT NULL
+        BEGIN
+            DROP TABLE staging.etl_watermark;
+            PRINT '[OK] staging.etl_watermark eliminada';
+        END
+        
         IF OBJECT_ID('staging.map_producto', 'U') IS NOT NULL
         BEGIN
             DROP TABLE staging.map_producto;
@@ -24,6 +24,11 @@ BEGIN
         IF OBJECT_ID('dwh.FactTargetSales', 'U') IS NOT NULL DELETE FROM dwh.FactTargetSales;
         IF OBJECT_ID('dwh.MetasVentas', 'U') IS NOT NULL DELETE FROM dwh.MetasVentas;
         IF OBJECT_ID('dwh.FactSales', 'U') IS NOT NULL DELETE FROM dwh.FactSales;
+        IF OBJECT_ID('dwh.EtlBatch', 'U') IS NOT NULL DELETE FROM dwh.EtlBatch;
+        
+        -- Estado del Apriori incremental: obliga a un minado completo tras la recarga
+        IF OBJECT_ID('dwh.AprioriMiningState', 'U') IS NOT NULL UPDATE dwh.AprioriMiningState SET TransactionCount = NULL;
+        IF OBJECT_ID('dwh.AprioriItemsetCount', 'U') IS NOT NULL TRUNCATE TABLE dwh.AprioriItemsetCount;
         
         -- Limpiar dimensiones
         IF OBJECT_ID('dwh.DimOrder', 'U') IS NOT NULL DELETE FROM dwh.DimOrder;
@@ -32,6 +37,7 @@ BEGIN
         IF OBJECT_ID('dwh.DimChannel', 'U') IS NOT NULL DELETE FROM dwh.DimChannel;
         IF OBJECT_ID('dwh.DimCategory', 'U') IS NOT NULL DELETE FROM dwh.DimCategory;
         IF OBJECT_ID('dwh.DimTime', 'U') IS NOT NULL DELETE FROM dwh.DimTime;
+        IF OBJECT_ID('dwh.ExchangeRateCalendar', 'U') IS NOT NULL DELETE FROM dwh.ExchangeRateCalendar;
         IF OBJECT_ID('dwh.DimExchangeRate', 'U') IS NOT NULL DELETE FROM dwh.DimExchangeRate;
         
         -- Limpiar staging
@@ -47,6 +53,7 @@ BEGIN
         IF OBJECT_ID('staging.neo4j_nodes', 'U') IS NOT NULL DELETE FROM staging.neo4j_nodes;
         IF OBJECT_ID('staging.neo4j_edges', 'U') IS NOT NULL DELETE FROM staging.neo4j_edges;
         IF OBJECT_ID('staging.supabase_users', 'U') IS NOT NULL DELETE FROM staging.supabase_users;
+        IF OBJECT_ID('staging.etl_watermark', 'U') IS NOT NULL DELETE FROM staging.etl_watermark;
         
         -- Resetear identidades (solo si existen)
         IF OBJECT_ID('dwh.DimCategory', 'U') IS NOT NULL DBCC CHECKIDENT ('dwh.DimCategory', RESEED, 0);
@@ -57,6 +64,7 @@ BEGIN
         IF OBJECT_ID('dwh.DimTime', 'U') IS NOT NULL DBCC CHECKIDENT ('dwh.DimTime', RESEED, 0);
         IF OBJECT_ID('dwh.DimExchangeRate', 'U') IS NOT NULL DBCC CHECKIDENT ('dwh.DimExchangeRate', RESEED, 0);
         IF OBJECT_ID('dwh.FactSales', 'U') IS NOT NULL DBCC CHECKIDENT ('dwh.FactSales', RESEED, 0);
+        IF OBJECT_ID('dwh.EtlBatch', 'U') IS NOT NULL DBCC CHECKIDENT ('dwh.EtlBatch', RESEED, 0);
         IF OBJECT_ID('dwh.FactTargetSales', 'U') IS NOT NULL DBCC CHECKIDENT ('dwh.FactTargetSales', RESEED, 0);
         IF OBJECT_ID('dwh.MetasVentas', 'U') IS NOT NULL DBCC CHECKIDENT ('dwh.MetasVentas', RESEED, 0);
         IF OBJECT_ID('staging.source_tracking', 'U') IS NOT NULL DBCC CHECKIDENT ('staging.source_tracking', RESEED, 0);
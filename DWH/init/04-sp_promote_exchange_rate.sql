@@ -1,6 +1,7 @@
 -- ============================================================================
 -- 04-sp_promote_exchange_rate.sql
--- Promueve staging.tipo_cambio hacia dwh.DimExchangeRate (CRC -> USD)
+-- Promueve staging.tipo_cambio hacia dwh.DimExchangeRate (CRC -> USD) y
+-- mantiene dwh.ExchangeRateCalendar (una fila por día, forward-fill)
 -- ============================================================================
 
 USE MSSQL_DW;
@@ -10,26 +11,79 @@ IF OBJECT_ID('dbo.sp_promote_exchange_rate', 'P') IS NOT NULL
     DROP PROCEDURE dbo.sp_promote_exchange_rate;
 GO
 
+-- @FechaDesde / @FechaHasta (opcionales) limitan la promoción al rango de un
+-- lote recién cargado; sin parámetros se promueve todo staging.tipo_cambio.
 CREATE PROCEDURE dbo.sp_promote_exchange_rate
+    @FechaDesde DATE = NULL,
+    @FechaHasta DATE = NULL
 AS
 BEGIN
     SET NOCOUNT ON;
     BEGIN TRY
+        DECLARE @Cambios TABLE ([date] DATE NOT NULL);
+
         MERGE dwh.DimExchangeRate AS target
         USING (
             SELECT fecha, de_moneda, a_moneda, tasa
             FROM staging.tipo_cambio
+            WHERE (@FechaDesde IS NULL OR fecha >= @FechaDesde)
+              AND (@FechaHasta IS NULL OR fecha <= @FechaHasta)
         ) AS src(fecha, de_moneda, a_moneda, tasa)
         ON target.[date] = src.fecha
            AND target.fromCurrency = src.de_moneda
            AND target.toCurrency = src.a_moneda
-        WHEN MATCHED THEN
+        WHEN MATCHED AND target.rate <> src.tasa THEN
             UPDATE SET rate = src.tasa
         WHEN NOT MATCHED THEN
             INSERT (toCurrency, fromCurrency, [date], rate)
-            VALUES (src.a_moneda, src.de_moneda, src.fecha, src.tasa);
+            VALUES (src.a_moneda, src.de_moneda, src.fecha, src.tasa)
+        OUTPUT inserted.[date] INTO @Cambios;
 
         PRINT '[OK] DimExchangeRate actualizada desde staging.tipo_cambio';
+
+        -- Calendario denso: se recalcula desde la primera fecha con tasa nueva o
+        -- modificada; si no hubo cambios solo se extiende hasta hoy. Fines de
+        -- semana y feriados heredan la última tasa publicada.
+        DECLARE @Hoy DATE = CAST(GETDATE() AS DATE);
+        DECLARE @Desde DATE = (SELECT MIN([date]) FROM @Cambios);
+        DECLARE @FinCalendario DATE = (SELECT MAX([date]) FROM dwh.ExchangeRateCalendar);
+        DECLARE @Hasta DATE = (SELECT MAX([date]) FROM dwh.DimExchangeRate);
+
+        IF @FinCalendario IS NULL
+            SET @Desde = (SELECT MIN([date]) FROM dwh.DimExchangeRate);
+        ELSE IF @Desde IS NULL OR @Desde > DATEADD(day, 1, @FinCalendario)
+            SET @Desde = DATEADD(day, 1, @FinCalendario);
+        IF @Hasta IS NULL OR @Hasta < @Hoy
+            SET @Hasta = @Hoy;
+
+        IF @Desde IS NOT NULL AND @Desde <= @Hasta
+        BEGIN
+            DELETE FROM dwh.ExchangeRateCalendar WHERE [date] >= @Desde;
+
+            WITH dias AS (
+                SELECT TOP (DATEDIFF(day, @Desde, @Hasta) + 1)
+                    DATEADD(day, ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1, @Desde) AS [date]
+                FROM sys.all_objects a CROSS JOIN sys.all_objects b
+            ),
+            pares AS (
+                SELECT DISTINCT fromCurrency, toCurrency FROM dwh.DimExchangeRate
+            )
+            INSERT INTO dwh.ExchangeRateCalendar (fromCurrency, toCurrency, [date], rate, exchangeRateId, rateDate)
+            SELECT p.fromCurrency, p.toCurrency, d.[date], r.rate, r.id, r.[date]
+            FROM pares p
+            CROSS JOIN dias d
+            CROSS APPLY (
+                -- seek sobre unique_exchange_rate (fromCurrency, toCurrency, date)
+                SELECT TOP 1 e.id, e.rate, e.[date]
+                FROM dwh.DimExchangeRate e
+                WHERE e.fromCurrency = p.fromCurrency
+                  AND e.toCurrency = p.toCurrency
+                  AND e.[date] <= d.[date]
+                ORDER BY e.[date] DESC
+            ) r;
+
+            PRINT '[OK] ExchangeRateCalendar recalculado desde ' + CONVERT(VARCHAR(10), @Desde, 23);
+        END
     END TRY
     BEGIN CATCH
         DECLARE @ErrorMessage NVARCHAR(4000) = ERROR_MESSAGE();
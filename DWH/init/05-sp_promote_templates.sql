@@ -272,10 +272,10 @@ BEGIN
         ),
         sales_rates AS (
             SELECT su.*,
-                   ex.id AS exchangeRateId,
+                   ex.exchangeRateId AS exchangeRateId,
                    CASE WHEN UPPER(ISNULL(su.currency,'')) = 'CRC' THEN ISNULL(ex.rate, 1) ELSE 1 END AS rate_to_usd
             FROM sales_filtered su
-            LEFT JOIN dwh.DimExchangeRate ex
+            LEFT JOIN dwh.ExchangeRateCalendar ex
                 ON ex.[date] = su.order_date
                AND ex.fromCurrency = 'CRC'
                AND ex.toCurrency = 'USD'
@@ -15,7 +15,8 @@ GO
 
 CREATE PROCEDURE dbo.sp_get_product_recommendations
     @ProductId INT,
-    @TopN INT = 10
+    @TopN INT = 10,
+    @SegmentKey NVARCHAR(100) = NULL  -- NULL = reglas globales; 'channel=3', 'country=CR', 'month=2025-01'
 AS
 BEGIN
     SET NOCOUNT ON;
@@ -28,7 +29,13 @@ BEGIN
             RETURN;
         END
         
-        -- Buscar reglas donde el producto es antecedente
+        DECLARE @Segment NVARCHAR(100) = ISNULL(@SegmentKey, 'global');
+        DECLARE @Scope NVARCHAR(20) = CASE
+            WHEN CHARINDEX('=', @Segment) > 0 THEN LEFT(@Segment, CHARINDEX('=', @Segment) - 1)
+            ELSE @Segment
+        END;
+        
+        -- Buscar reglas donde el producto es antecedente (seek sobre ProductAssociationRuleItems)
         SELECT TOP (@TopN)
             par.RuleID,
             par.ConsequentProductIds,
@@ -37,14 +44,15 @@ BEGIN
             par.Confidence,
             par.Lift,
             par.FechaCalculo
-        FROM dwh.ProductAssociationRules par
-        WHERE par.Activo = 1
-          AND (
-              par.AntecedentProductIds = CAST(@ProductId AS NVARCHAR(50))  -- Solo este producto
-              OR par.AntecedentProductIds LIKE CAST(@ProductId AS NVARCHAR(50)) + ',%'  -- Primero en lista
-              OR par.AntecedentProductIds LIKE '%,' + CAST(@ProductId AS NVARCHAR(50)) + ',%'  -- En medio
-              OR par.AntecedentProductIds LIKE '%,' + CAST(@ProductId AS NVARCHAR(50))  -- Último en lista
-          )
+        -- Sólo la versión publicada (puntero dwh.AssociationRuleSetActive)
+        FROM dwh.AssociationRuleSetActive act
+        INNER JOIN dwh.ProductAssociationRuleItems i
+            ON i.ProductId = @ProductId
+           AND i.Role = 'A'
+           AND i.RuleSetId = act.RuleSetId
+        INNER JOIN dwh.ProductAssociationRules par ON par.RuleID = i.RuleID
+        WHERE act.Scope = @Scope
+          AND par.SegmentKey = @Segment
         ORDER BY par.Lift DESC, par.Confidence DESC;
         
     END TRY
@@ -107,8 +115,10 @@ BEGIN
             SET @Pos = @NextPos + 1;
         END
         
-        -- Buscar reglas donde alguno de los productos del carrito es antecedente
-        -- y el consecuente NO está en el carrito
+        DECLARE @RuleSetId INT = (SELECT RuleSetId FROM dwh.AssociationRuleSetActive WHERE Scope = 'global');
+        
+        -- Reglas cuyo antecedente está contenido completo en el carrito
+        -- (coincidencias = AntecedentSize) y cuyo consecuente NO está en el carrito
         SELECT TOP (@TopN)
             par.RuleID,
             par.ConsequentProductIds,
@@ -119,23 +129,24 @@ BEGIN
             par.FechaCalculo,
             -- Calcular score ponderado (lift * confidence)
             (par.Lift * par.Confidence) AS Score
-        FROM dwh.ProductAssociationRules par
-        WHERE par.Activo = 1
-          AND EXISTS (
-              -- Verificar que al menos un producto del carrito está en antecedentes
-              SELECT 1 FROM @CartProducts cp
-              WHERE par.AntecedentProductIds = CAST(cp.ProductId AS NVARCHAR(50))
-                 OR par.AntecedentProductIds LIKE CAST(cp.ProductId AS NVARCHAR(50)) + ',%'
-                 OR par.AntecedentProductIds LIKE '%,' + CAST(cp.ProductId AS NVARCHAR(50)) + ',%'
-                 OR par.AntecedentProductIds LIKE '%,' + CAST(cp.ProductId AS NVARCHAR(50))
-          )
-          AND NOT EXISTS (
-              -- Excluir si el consecuente ya está en el carrito
-              SELECT 1 FROM @CartProducts cp
-              WHERE par.ConsequentProductIds = CAST(cp.ProductId AS NVARCHAR(50))
-                 OR par.ConsequentProductIds LIKE CAST(cp.ProductId AS NVARCHAR(50)) + ',%'
-                 OR par.ConsequentProductIds LIKE '%,' + CAST(cp.ProductId AS NVARCHAR(50)) + ',%'
-                 OR par.ConsequentProductIds LIKE '%,' + CAST(cp.ProductId AS NVARCHAR(50))
+        FROM (
+            SELECT i.RuleID, COUNT(*) AS Coincidencias
+            FROM (SELECT DISTINCT ProductId FROM @CartProducts) cp
+            INNER JOIN dwh.ProductAssociationRuleItems i
+                ON i.ProductId = cp.ProductId
+               AND i.Role = 'A'
+               AND i.RuleSetId = @RuleSetId
+            GROUP BY i.RuleID
+        ) m
+        INNER JOIN dwh.ProductAssociationRules par
+            ON par.RuleID = m.RuleID
+           AND par.AntecedentSize = m.Coincidencias
+        WHERE NOT EXISTS (
+              SELECT 1
+              FROM dwh.ProductAssociationRuleItems c
+              INNER JOIN @CartProducts cp ON cp.ProductId = c.ProductId
+              WHERE c.RuleID = par.RuleID
+                AND c.Role = 'C'
           )
         ORDER BY Score DESC, par.Lift DESC;
         
@@ -168,24 +179,24 @@ BEGIN
     BEGIN TRY
         IF @OrderBy = 'Confidence'
         BEGIN
-            SELECT TOP (@TopN) * 
-            FROM dwh.ProductAssociationRules
-            WHERE Activo = 1
-            ORDER BY Confidence DESC, Lift DESC;
+            SELECT TOP (@TopN) par.*
+            FROM dwh.ProductAssociationRules par
+            INNER JOIN dwh.AssociationRuleSetActive act ON act.RuleSetId = par.RuleSetId AND act.Scope = 'global'
+            ORDER BY par.Confidence DESC, par.Lift DESC;
         END
         ELSE IF @OrderBy = 'Support'
         BEGIN
-            SELECT TOP (@TopN) * 
-            FROM dwh.ProductAssociationRules
-            WHERE Activo = 1
-            ORDER BY Support DESC, Lift DESC;
+            SELECT TOP (@TopN) par.*
+            FROM dwh.ProductAssociationRules par
+            INNER JOIN dwh.AssociationRuleSetActive act ON act.RuleSetId = par.RuleSetId AND act.Scope = 'global'
+            ORDER BY par.Support DESC, par.Lift DESC;
         END
         ELSE -- Default: Lift
         BEGIN
-            SELECT TOP (@TopN) * 
-            FROM dwh.ProductAssociationRules
-            WHERE Activo = 1
-            ORDER BY Lift DESC, Confidence DESC;
+            SELECT TOP (@TopN) par.*
+            FROM dwh.ProductAssociationRules par
+            INNER JOIN dwh.AssociationRuleSetActive act ON act.RuleSetId = par.RuleSetId AND act.Scope = 'global'
+            ORDER BY par.Lift DESC, par.Confidence DESC;
         END
         
     END TRY
@@ -211,15 +222,18 @@ AS
 BEGIN
     SET NOCOUNT ON;
     
+    DECLARE @ActiveRuleSetId INT = (SELECT RuleSetId FROM dwh.AssociationRuleSetActive WHERE Scope = 'global');
+
     SELECT 
         COUNT(*) AS TotalReglas,
-        SUM(CASE WHEN Activo = 1 THEN 1 ELSE 0 END) AS ReglasActivas,
-        MAX(FechaCalculo) AS UltimaActualizacion,
-        AVG(CASE WHEN Activo = 1 THEN Support ELSE NULL END) AS SupportPromedio,
-        AVG(CASE WHEN Activo = 1 THEN Confidence ELSE NULL END) AS ConfidencePromedio,
-        AVG(CASE WHEN Activo = 1 THEN Lift ELSE NULL END) AS LiftPromedio,
-        MAX(CASE WHEN Activo = 1 THEN Lift ELSE NULL END) AS LiftMaximo,
-        MIN(CASE WHEN Activo = 1 THEN Support ELSE NULL END) AS SupportMinimo
+        SUM(CASE WHEN RuleSetId = @ActiveRuleSetId THEN 1 ELSE 0 END) AS ReglasActivas,
+        MAX(CASE WHEN RuleSetId = @ActiveRuleSetId THEN FechaCalculo ELSE NULL END) AS UltimaActualizacion,
+        AVG(CASE WHEN RuleSetId = @ActiveRuleSetId THEN Support ELSE NULL END) AS SupportPromedio,
+        AVG(CASE WHEN RuleSetId = @ActiveRuleSetId THEN Confidence ELSE NULL END) AS ConfidencePromedio,
+        AVG(CASE WHEN RuleSetId = @ActiveRuleSetId THEN Lift ELSE NULL END) AS LiftPromedio,
+        MAX(CASE WHEN RuleSetId = @ActiveRuleSetId THEN Lift ELSE NULL END) AS LiftMaximo,
+        MIN(CASE WHEN RuleSetId = @ActiveRuleSetId THEN Support ELSE NULL END) AS SupportMinimo,
+        @ActiveRuleSetId AS RuleSetIdActivo
     FROM dwh.ProductAssociationRules;
 END;
 GO
@@ -5,14 +5,24 @@ Extrae transacciones del DWH, aplica Apriori y guarda reglas en dwh.ProductAssoc
 import logging
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from collections import defaultdict
 
+import numpy as np
 import pandas as pd
-import pymssql
+from db_utils import acquire_connection, bulk_insert, fetch_iter, release_connection, wait_for_db
 from dotenv import load_dotenv
-from mlxtend.frequent_patterns import apriori, association_rules
-from mlxtend.preprocessing import TransactionEncoder
+from mining_engines import (
+    DEFAULT_ENGINE,
+    EncodedTransactions,
+    build_itemset_state,
+    frequent_from_counts,
+    mine_frequent_itemsets,
+    mine_pair_rules,
+    update_itemset_counts,
+)
+from mlxtend.frequent_patterns import association_rules
+from recommendation_cache import publish_recommendations
 
 # Configurar logging
 logging.basicConfig(
@@ -25,6 +35,28 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+GLOBAL_SCOPE = "global"
+
+# Dimensiones de segmentación: expresión por (orden, producto) y JOIN necesario.
+# Una orden pertenece al segmento de su primera línea.
+SEGMENT_DIMENSIONS = {
+    "channel": ("MIN(fs.channelId)", ""),
+    "country": ("MIN(c.country)", "INNER JOIN dwh.DimCustomer c ON c.id = fs.customerId"),
+    "month": ("MIN(t.year * 100 + t.month)", "INNER JOIN dwh.DimTime t ON t.id = fs.timeId"),
+}
+
+
+def segment_key(dimension, value):
+    """SegmentKey guardado en dwh.ProductAssociationRules: channel=3, country=CR, month=2025-01"""
+    if dimension == "month":
+        value = f"{int(value) // 100}-{int(value) % 100:02d}"
+    return f"{dimension}={value}"
+
+RULE_COLUMNS = [
+    "RuleSetId", "SegmentKey", "AntecedentProductIds", "ConsequentProductIds", "AntecedentSize", "AntecedentNames", "ConsequentNames",
+    "Support", "Confidence", "Lift", "FechaCalculo", "Activo",
+]
+
 # Cargar variables de entorno
 load_dotenv()
 
@@ -42,130 +74,197 @@ class AprioriAnalysis:
         self.min_support = float(os.getenv("APRIORI_MIN_SUPPORT", "0.01"))  # 1%
         self.min_confidence = float(os.getenv("APRIORI_MIN_CONFIDENCE", "0.3"))  # 30%
         self.min_lift = float(os.getenv("APRIORI_MIN_LIFT", "1.0"))
+        # Motor de itemsets frecuentes: dense | sparse | fpgrowth | eclat (ver mining_engines.py)
+        self.engine = os.getenv("APRIORI_ENGINE", DEFAULT_ENGINE)
+        # Modo particionado SON: >1 reparte la minería en un pool de procesos
+        self.partitions = int(os.getenv("APRIORI_PARTITIONS", "1"))
+        self.max_workers = int(os.getenv("APRIORI_WORKERS", "0")) or None
+        # Ruta rápida sólo pares 1 -> 1 y top-K por antecedente (0 = sin límite)
+        self.pairs_only = os.getenv("APRIORI_PAIRS_ONLY", "0") == "1"
+        self.pair_top_k = int(os.getenv("APRIORI_PAIR_TOP_K", "0"))
+        # Versiones de reglas a conservar (la activa siempre se conserva)
+        self.keep_rule_sets = int(os.getenv("APRIORI_KEEP_RULE_SETS", "3"))
+        self.prune_batch = int(os.getenv("APRIORI_PRUNE_BATCH", "5000"))
+        # Modo segmentado: dimensiones por defecto y mínimo de órdenes por segmento
+        self.segments = [d.strip() for d in os.getenv("APRIORI_SEGMENTS", "channel,country").split(",") if d.strip()]
+        self.segment_min_orders = int(os.getenv("APRIORI_SEGMENT_MIN_ORDERS", "50"))
         
-        logger.info(f"Parámetros Apriori: support={self.min_support}, confidence={self.min_confidence}, lift={self.min_lift}")
+        logger.info(f"Parámetros Apriori: support={self.min_support}, confidence={self.min_confidence}, lift={self.min_lift}, engine={self.engine}, partitions={self.partitions}")
     
     def connect_to_database(self):
-        """Conectar a SQL Server DWH"""
+        """Obtener una conexión del pool del DWH (se devuelve con release_connection)"""
         try:
-            server_parts = self.server.replace(",", ":").split(":")
-            server_host = server_parts[0]
-            server_port = int(server_parts[1]) if len(server_parts) > 1 else 1433
-            
-            # Dentro de Docker usamos el nombre del servicio
-            if server_host == "localhost":
-                server_host = "sqlserver-dw"
-                server_port = 1433
-            
-            logger.info(f"Conectando a {server_host}:{server_port}/{self.database}")
-            
-            connection = pymssql.connect(
-                server=server_host,
-                port=server_port,
-                user=self.username,
-                password=self.password,
-                database=self.database,
-                timeout=30,
-                as_dict=False
-            )
+            if not wait_for_db():
+                logger.error(f"DWH {self.database} no disponible")
+                return None
             
-            logger.info("Conexión exitosa a base de datos")
+            connection = acquire_connection()
+            logger.info("Conexión obtenida del pool del DWH")
             return connection
         
-        except pymssql.DatabaseError as e:
+        except Exception as e:
             logger.error(f"Error conectando a base de datos: {e}")
             return None
     
-    def extract_transactions(self):
+    def get_max_fact_id(self):
+        """Último FactSales.id: límite superior consistente para una corrida"""
+        connection = self.connect_to_database()
+        if not connection:
+            return None
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT ISNULL(MAX(id), 0) FROM dwh.FactSales")
+            return cursor.fetchone()[0]
+        finally:
+            release_connection(connection)
+    
+    def extract_transactions(self, until_fact_id=None, since_fact_id=None):
         """
-        Extrae transacciones del DWH.
-        Retorna: lista de transacciones, cada transacción es lista de product_ids
+        Extrae transacciones del DWH en streaming.
+        until_fact_id: sólo hechos con id <= until (foto consistente de la corrida)
+        since_fact_id: sólo órdenes con algún hecho id > since (incremento)
+        Retorna: (EncodedTransactions, {product_id: nombre})
         """
         connection = self.connect_to_database()
         if not connection:
-            return [], {}
+            return EncodedTransactions(), {}
         
         try:
             cursor = connection.cursor()
             
-            # Extraer items por orden (transacción = orden)
-            query = """
-                SELECT 
-                    o.id AS order_id,
-                    p.id AS product_id,
-                    p.name AS product_name
+            # Un renglón por (orden, producto), ya agrupado y ordenado en el servidor:
+            # las órdenes llegan en corridas consecutivas (transacción = orden)
+            filters = ["fs.productCant > 0"]
+            params = {}
+            if until_fact_id is not None:
+                filters.append("fs.id <= %(until)s")
+                params["until"] = until_fact_id
+            if since_fact_id is not None:
+                filters.append("""fs.orderId IN (
+                    SELECT d.orderId FROM dwh.FactSales d
+                    WHERE d.id > %(since)s AND d.id <= %(until)s
+                )""")
+                params["since"] = since_fact_id
+            query = f"""
+                SELECT fs.orderId, fs.productId
                 FROM dwh.FactSales fs
-                INNER JOIN dwh.DimOrder o ON o.id = fs.orderId
-                INNER JOIN dwh.DimProduct p ON p.id = fs.productId
-                WHERE fs.productCant > 0
-                ORDER BY o.id, p.id
+                WHERE {' AND '.join(filters)}
+                GROUP BY fs.orderId, fs.productId
+                ORDER BY fs.orderId, fs.productId
             """
             
             logger.info("Extrayendo transacciones desde FactSales...")
-            cursor.execute(query)
-            rows = cursor.fetchall()
-            
-            if not rows:
+            cursor.execute(query, params or None)
+            
+            transactions = EncodedTransactions()
+            current_order = None
+            basket = []
+            for order_id, product_id in fetch_iter(cursor):
+                if order_id != current_order:
+                    if basket:
+                        transactions.add(basket)
+                    current_order = order_id
+                    basket = []
+                basket.append(product_id)
+            if basket:
+                transactions.add(basket)
+            
+            if not len(transactions):
                 logger.warning("No se encontraron transacciones en FactSales")
-                return [], {}
+                return transactions, {}
             
-            # Agrupar productos por orden
-            transactions_dict = defaultdict(set)
-            product_names = {}
+            # Nombres una sola vez desde la dimensión, no por cada fila de hechos
+            cursor.execute("SELECT id, name FROM dwh.DimProduct")
+            product_names = dict(fetch_iter(cursor))
             
-            for order_id, product_id, product_name in rows:
-                transactions_dict[order_id].add(product_id)
-                product_names[product_id] = product_name
-            
-            # Convertir a lista de listas
-            transactions = [list(items) for items in transactions_dict.values()]
-            
-            logger.info(f"Extraídas {len(transactions)} transacciones con {len(product_names)} productos únicos")
+            logger.info(f"Extraídas {len(transactions)} transacciones con {len(transactions.product_ids)} productos únicos ({transactions.nbytes() / 1024:.0f} KB)")
             
             # Estadísticas
-            items_per_transaction = [len(t) for t in transactions]
-            logger.info(f"Items por transacción - Min: {min(items_per_transaction)}, Max: {max(items_per_transaction)}, Promedio: {sum(items_per_transaction)/len(items_per_transaction):.2f}")
+            items_per_transaction = np.diff(np.frombuffer(transactions.offsets, dtype=np.int64))
+            logger.info(f"Items por transacción - Min: {items_per_transaction.min()}, Max: {items_per_transaction.max()}, Promedio: {items_per_transaction.mean():.2f}")
             
             return transactions, product_names
         
         except Exception as e:
             logger.error(f"Error extrayendo transacciones: {e}")
-            return [], {}
+            return EncodedTransactions(), {}
         finally:
-            connection.close()
+            release_connection(connection)
     
-    def run_apriori(self, transactions):
-        """
-        Ejecuta algoritmo Apriori sobre las transacciones.
-        Retorna: DataFrame con reglas de asociación
-        """
+    def find_frequent_itemsets(self, transactions):
+        """Fase 1: itemsets frecuentes (DataFrame support/itemsets, vacío si no hay)"""
         if not transactions:
             logger.warning("No hay transacciones para analizar")
             return pd.DataFrame()
         
         try:
             logger.info("Ejecutando algoritmo Apriori...")
-            
-            # Convertir a formato one-hot encoding
-            te = TransactionEncoder()
-            te_ary = te.fit(transactions).transform(transactions)
-            df_encoded = pd.DataFrame(te_ary, columns=te.columns_)
-            
-            logger.info(f"Matriz transaccional: {df_encoded.shape[0]} transacciones x {df_encoded.shape[1]} productos")
-            
-            # Fase 1: Encontrar itemsets frecuentes
             logger.info(f"Buscando itemsets frecuentes (min_support={self.min_support})...")
-            frequent_itemsets = apriori(
-                df_encoded,
-                min_support=self.min_support,
-                use_colnames=True,
-                low_memory=True
+            frequent_itemsets = mine_frequent_itemsets(
+                transactions, self.min_support, self.engine,
+                partitions=self.partitions, max_workers=self.max_workers
             )
             
             if frequent_itemsets.empty:
                 logger.warning("No se encontraron itemsets frecuentes. Considerar reducir min_support.")
                 return pd.DataFrame()
             
+            return frequent_itemsets
+        
+        except Exception as e:
+            logger.error(f"Error ejecutando Apriori: {e}")
+            return pd.DataFrame()
+    
+    def run_apriori(self, transactions):
+        """
+        Ejecuta algoritmo Apriori sobre las transacciones.
+        Retorna: DataFrame con reglas de asociación
+        """
+        return self.mine_rules(transactions)[1]
+    
+    def mine_rules(self, transactions):
+        """
+        Itemsets frecuentes + reglas según el modo configurado.
+        Con APRIORI_PAIRS_ONLY sólo hay reglas 1 -> 1 (sin itemsets).
+        Retorna: (frequent_itemsets, rules)
+        """
+        if self.pairs_only:
+            return pd.DataFrame(), self.run_pair_rules(transactions)
+        frequent_itemsets = self.find_frequent_itemsets(transactions)
+        return frequent_itemsets, self.derive_rules(frequent_itemsets)
+    
+    def run_pair_rules(self, transactions):
+        """Ruta rápida de reglas 1 -> 1 (co-ocurrencias por producto de matrices dispersas)"""
+        if not transactions:
+            logger.warning("No hay transacciones para analizar")
+            return pd.DataFrame()
+        
+        try:
+            logger.info(f"Generando reglas de pares (support={self.min_support}, confidence={self.min_confidence}, lift={self.min_lift}, top_k={self.pair_top_k})...")
+            rules = mine_pair_rules(
+                transactions, self.min_support, self.min_confidence, self.min_lift, self.pair_top_k
+            )
+            if rules.empty:
+                logger.warning("No se generaron reglas de pares con los umbrales configurados")
+                return pd.DataFrame()
+            
+            rules = rules.sort_values('lift', ascending=False)
+            logger.info(f"Generadas {len(rules)} reglas de asociación (pares)")
+            return rules
+        
+        except Exception as e:
+            logger.error(f"Error generando reglas de pares: {e}")
+            return pd.DataFrame()
+    
+    def derive_rules(self, frequent_itemsets):
+        """
+        Fase 2: reglas de asociación (confidence y lift) desde los itemsets frecuentes.
+        Retorna: DataFrame con reglas de asociación
+        """
+        if frequent_itemsets.empty:
+            return pd.DataFrame()
+        
+        try:
             logger.info(f"Encontrados {len(frequent_itemsets)} itemsets frecuentes")
             
             # Mostrar itemsets de diferentes tamaños
@@ -220,13 +319,57 @@ class AprioriAnalysis:
             return rules
         
         except Exception as e:
-            logger.error(f"Error ejecutando Apriori: {e}")
+            logger.error(f"Error generando reglas: {e}")
             return pd.DataFrame()
     
-    def save_rules_to_database(self, rules, product_names):
+    def _rule_rows(self, rules, product_names, rule_set_id, fecha_calculo):
+        """Filas para dwh.ProductAssociationRules (Activo = 0; solo la versión global publicada pasa a 1)"""
+        skipped = 0
+        segments = rules['segment'] if 'segment' in rules else [GLOBAL_SCOPE] * len(rules)
+        for segment, antecedents, consequents, support, confidence, lift in zip(
+            segments, rules['antecedents'], rules['consequents'],
+            rules['support'], rules['confidence'], rules['lift']
+        ):
+            # Respetar los CHECK de la tabla (DECIMAL(10,6)) en lugar de fallar el lote
+            if round(float(support), 6) <= 0 or round(float(lift), 6) <= 0:
+                skipped += 1
+                continue
+            
+            antecedent_ids = sorted(antecedents)
+            consequent_ids = sorted(consequents)
+            
+            # Nombres para display, truncados al tamaño de la columna
+            antecedent_names = ', '.join([product_names.get(pid, f'ID:{pid}') for pid in antecedent_ids])[:1000]
+            consequent_names = ', '.join([product_names.get(pid, f'ID:{pid}') for pid in consequent_ids])[:1000]
+            
+            yield (
+                rule_set_id,
+                segment,
+                ','.join(map(str, antecedent_ids)),
+                ','.join(map(str, consequent_ids)),
+                len(antecedent_ids),
+                antecedent_names,
+                consequent_names,
+                float(support),
+                min(float(confidence), 1.0),
+                float(lift),
+                fecha_calculo,
+                0,
+            )
+        if skipped:
+            logger.warning(f"{skipped} reglas omitidas por support/lift fuera de rango")
+    
+    def save_rules_to_database(self, rules, product_names, scope=GLOBAL_SCOPE):
         """
-        Guarda las reglas de asociación en dwh.ProductAssociationRules.
-        Marca reglas antiguas como inactivas y agrega las nuevas.
+        Guarda las reglas de asociación como una versión nueva (RuleSetId) del
+        alcance `scope` ('global' o una dimensión de segmentación; en ese caso
+        `rules` trae la columna `segment` con el SegmentKey de cada regla):
+          1. registra la versión en estado CARGANDO
+          2. carga las reglas y sus productos normalizados en bloque
+             (los lectores siguen viendo la versión anterior)
+          3. publica en una sola transacción moviendo dwh.AssociationRuleSetActive
+          4. publica el top-N por producto para recommendation_cache (sólo global)
+          5. depura versiones viejas por lotes
         """
         if rules.empty:
             logger.warning("No hay reglas para guardar")
@@ -236,75 +379,355 @@ class AprioriAnalysis:
         if not connection:
             return
         
+        rule_set_id = None
         try:
             cursor = connection.cursor()
+            fecha_calculo = datetime.now()
             
-            # 1. Marcar todas las reglas existentes como inactivas
-            logger.info("Marcando reglas anteriores como inactivas...")
-            cursor.execute("UPDATE dwh.ProductAssociationRules SET Activo = 0")
+            # 1. Nueva versión
+            cursor.execute(
+                "INSERT INTO dwh.AssociationRuleSet (Scope, Estado, FechaCalculo) OUTPUT INSERTED.RuleSetId VALUES (%s, 'CARGANDO', %s)",
+                (scope, fecha_calculo)
+            )
+            rule_set_id = cursor.fetchone()[0]
             connection.commit()
+            logger.info(f"Cargando reglas en la versión RuleSetId={rule_set_id} (scope={scope})...")
             
-            # 2. Insertar nuevas reglas
-            insert_query = """
-                INSERT INTO dwh.ProductAssociationRules 
-                (AntecedentProductIds, ConsequentProductIds, AntecedentNames, ConsequentNames, 
-                 Support, Confidence, Lift, FechaCalculo, Activo)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 1)
-            """
+            # 2. Carga masiva
+            inserted_count = bulk_insert(
+                "dwh.ProductAssociationRules",
+                RULE_COLUMNS,
+                self._rule_rows(rules, product_names, rule_set_id, fecha_calculo),
+            )
+            
+            # Productos por regla para las búsquedas por ProductId de los SPs
+            cursor.execute("""
+                INSERT INTO dwh.ProductAssociationRuleItems (RuleSetId, RuleID, ProductId, Role)
+                SELECT r.RuleSetId, r.RuleID, CAST(a.value AS INT), 'A'
+                FROM dwh.ProductAssociationRules r
+                CROSS APPLY STRING_SPLIT(r.AntecedentProductIds, ',') a
+                WHERE r.RuleSetId = %s
+                UNION ALL
+                SELECT r.RuleSetId, r.RuleID, CAST(c.value AS INT), 'C'
+                FROM dwh.ProductAssociationRules r
+                CROSS APPLY STRING_SPLIT(r.ConsequentProductIds, ',') c
+                WHERE r.RuleSetId = %s
+            """, (rule_set_id, rule_set_id))
+            connection.commit()
             
-            inserted_count = 0
+            # 3. Publicación atómica: puntero + Activo (para consultas directas sobre Activo).
+            #    Activo marca solo el conjunto global: los lectores que filtran por Activo = 1
+            #    no deben mezclar reglas de segmentos (esas se leen por el puntero de su Scope)
+            cursor.execute("SELECT RuleSetId FROM dwh.AssociationRuleSetActive WITH (UPDLOCK) WHERE Scope = %s", (scope,))
+            row = cursor.fetchone()
+            previous_id = row[0] if row else None
+            if row:
+                cursor.execute(
+                    "UPDATE dwh.AssociationRuleSetActive SET RuleSetId = %s, FechaPublicacion = GETDATE() WHERE Scope = %s",
+                    (rule_set_id, scope)
+                )
+            else:
+                cursor.execute(
+                    "INSERT INTO dwh.AssociationRuleSetActive (Scope, RuleSetId, FechaPublicacion) VALUES (%s, %s, GETDATE())",
+                    (scope, rule_set_id)
+                )
+            cursor.execute(
+                "UPDATE dwh.AssociationRuleSet SET Estado = 'PUBLICADA', TotalReglas = %s, FechaPublicacion = GETDATE() WHERE RuleSetId = %s",
+                (inserted_count, rule_set_id)
+            )
+            if previous_id is not None:
+                cursor.execute("UPDATE dwh.AssociationRuleSet SET Estado = 'RETIRADA' WHERE RuleSetId = %s", (previous_id,))
+                cursor.execute("UPDATE dwh.ProductAssociationRules SET Activo = 0 WHERE RuleSetId = %s AND Activo = 1", (previous_id,))
+            if scope == GLOBAL_SCOPE:
+                cursor.execute("UPDATE dwh.ProductAssociationRules SET Activo = 1 WHERE RuleSetId = %s", (rule_set_id,))
+            connection.commit()
+            logger.info(f"✓ {inserted_count} reglas publicadas en {scope} (RuleSetId {previous_id} -> {rule_set_id})")
             
-            for _, rule in rules.iterrows():
-                # Convertir frozensets a listas de IDs
-                antecedent_ids = list(rule['antecedents'])
-                consequent_ids = list(rule['consequents'])
-                
-                # Crear strings separados por coma
-                antecedent_str = ','.join(map(str, sorted(antecedent_ids)))
-                consequent_str = ','.join(map(str, sorted(consequent_ids)))
-                
-                # Obtener nombres de productos
-                antecedent_names = ', '.join([product_names.get(pid, f'ID:{pid}') for pid in antecedent_ids])
-                consequent_names = ', '.join([product_names.get(pid, f'ID:{pid}') for pid in consequent_ids])
-                
-                # Truncar si es muy largo
-                antecedent_names = antecedent_names[:1000]
-                consequent_names = consequent_names[:1000]
-                
+            # 4. Top-N precalculado para recommendation_cache (derivado: un fallo no revierte la versión)
+            if scope == GLOBAL_SCOPE:
                 try:
-                    cursor.execute(insert_query, (
-                        antecedent_str,
-                        consequent_str,
-                        antecedent_names,
-                        consequent_names,
-                        float(rule['support']),
-                        float(rule['confidence']),
-                        float(rule['lift']),
-                        datetime.now()
-                    ))
-                    inserted_count += 1
-                
+                    publish_recommendations(rules, rule_set_id)
                 except Exception as e:
-                    logger.error(f"Error insertando regla {antecedent_str} => {consequent_str}: {e}")
-                    continue
+                    logger.warning(f"No se pudo publicar la caché de recomendaciones: {e}")
             
+            # 5. Depurar versiones viejas
+            self.prune_rule_sets(connection)
+        
+        except Exception as e:
+            logger.error(f"Error guardando reglas en base de datos (RuleSetId={rule_set_id}): {e}")
+            connection.rollback()
+        finally:
+            release_connection(connection)
+    
+    def prune_rule_sets(self, connection):
+        """
+        Borra, por Scope, las versiones no activas más allá de APRIORI_KEEP_RULE_SETS (incluye
+        cargas abortadas), en lotes de APRIORI_PRUNE_BATCH reglas con commit por lote
+        para no bloquear la tabla ni inflar el log. Los ProductAssociationRuleItems
+        se borran en cascada.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+            WITH versiones AS (
+                SELECT RuleSetId, Scope, Estado,
+                       ROW_NUMBER() OVER (PARTITION BY Scope, CASE WHEN Estado = 'CARGANDO' THEN 1 ELSE 0 END
+                                          ORDER BY RuleSetId DESC) AS rn,
+                       MAX(RuleSetId) OVER (PARTITION BY Scope) AS ultima
+                FROM dwh.AssociationRuleSet
+            )
+            SELECT v.RuleSetId
+            FROM versiones v
+            WHERE (v.Estado = 'CARGANDO' OR v.rn > %s)
+              AND v.RuleSetId < v.ultima
+              AND NOT EXISTS (SELECT 1 FROM dwh.AssociationRuleSetActive a WHERE a.RuleSetId = v.RuleSetId)
+        """, (self.keep_rule_sets,))
+        stale = [row[0] for row in cursor.fetchall()]
+        
+        for rule_set_id in stale:
+            deleted = 0
+            while True:
+                cursor.execute(
+                    "DELETE TOP (%s) FROM dwh.ProductAssociationRules WHERE RuleSetId = %s",
+                    (self.prune_batch, rule_set_id)
+                )
+                connection.commit()
+                if cursor.rowcount <= 0:
+                    break
+                deleted += cursor.rowcount
+            cursor.execute("DELETE FROM dwh.AssociationRuleSet WHERE RuleSetId = %s", (rule_set_id,))
             connection.commit()
-            logger.info(f"✓ {inserted_count} reglas de asociación guardadas en dwh.ProductAssociationRules")
-            
-            # 3. Estadísticas
-            cursor.execute("SELECT COUNT(*) FROM dwh.ProductAssociationRules WHERE Activo = 1")
-            active_count = cursor.fetchone()[0]
+            logger.info(f"Versión RuleSetId={rule_set_id} depurada ({deleted} reglas)")
+    
+    def extract_segmented_transactions(self, dimensions):
+        """
+        Una sola extracción con los atributos de segmento de cada orden; las
+        transacciones se reparten en memoria.
+        Retorna: ({dimensión: {SegmentKey: EncodedTransactions}}, {product_id: nombre})
+        """
+        connection = self.connect_to_database()
+        if not connection:
+            return {}, {}
+        
+        try:
+            cursor = connection.cursor()
+            columns = ", ".join(SEGMENT_DIMENSIONS[d][0] for d in dimensions)
+            joins = "\n".join(SEGMENT_DIMENSIONS[d][1] for d in dimensions if SEGMENT_DIMENSIONS[d][1])
+            query = f"""
+                SELECT fs.orderId, fs.productId, {columns}
+                FROM dwh.FactSales fs
+                {joins}
+                WHERE fs.productCant > 0
+                GROUP BY fs.orderId, fs.productId
+                ORDER BY fs.orderId, fs.productId
+            """
             
-            cursor.execute("SELECT COUNT(*) FROM dwh.ProductAssociationRules WHERE Activo = 0")
-            inactive_count = cursor.fetchone()[0]
+            logger.info(f"Extrayendo transacciones segmentadas por {', '.join(dimensions)}...")
+            cursor.execute(query)
             
-            logger.info(f"Reglas activas: {active_count}, Reglas históricas: {inactive_count}")
+            segments = {d: {} for d in dimensions}
+            
+            def emit(attrs, basket):
+                for dimension, value in zip(dimensions, attrs):
+                    if value is None:
+                        continue
+                    key = segment_key(dimension, value)
+                    bucket = segments[dimension].get(key)
+                    if bucket is None:
+                        bucket = segments[dimension][key] = EncodedTransactions()
+                    bucket.add(basket)
+            
+            current_order = None
+            attrs = None
+            basket = []
+            for row in fetch_iter(cursor):
+                order_id, product_id = row[0], row[1]
+                if order_id != current_order:
+                    if basket:
+                        emit(attrs, basket)
+                    current_order = order_id
+                    attrs = row[2:]
+                    basket = []
+                basket.append(product_id)
+            if basket:
+                emit(attrs, basket)
+            
+            cursor.execute("SELECT id, name FROM dwh.DimProduct")
+            product_names = dict(fetch_iter(cursor))
+            
+            for dimension, buckets in segments.items():
+                logger.info(f"  {dimension}: {len(buckets)} segmentos, {sum(len(t) for t in buckets.values())} transacciones")
+            return segments, product_names
+        
+        except Exception as e:
+            logger.error(f"Error extrayendo transacciones segmentadas: {e}")
+            return {}, {}
+        finally:
+            release_connection(connection)
+    
+    def run_segmented(self, dimensions=None):
+        """
+        Reglas por segmento (canal, país, mes): una extracción, minado de todos
+        los segmentos en paralelo y una versión publicada por dimensión (Scope).
+        """
+        dimensions = dimensions or self.segments
+        unknown = [d for d in dimensions if d not in SEGMENT_DIMENSIONS]
+        if unknown:
+            raise ValueError(f"Dimensión de segmentación desconocida: {', '.join(unknown)} (opciones: {', '.join(SEGMENT_DIMENSIONS)})")
+        
+        logger.info("=" * 80)
+        logger.info(f"ANÁLISIS APRIORI SEGMENTADO ({', '.join(dimensions)})")
+        logger.info("=" * 80)
+        
+        start_time = datetime.now()
+        segments, product_names = self.extract_segmented_transactions(dimensions)
+        
+        params = {
+            "min_support": self.min_support,
+            "min_confidence": self.min_confidence,
+            "min_lift": self.min_lift,
+            "engine": self.engine,
+            "pairs_only": self.pairs_only,
+            "pair_top_k": self.pair_top_k,
+        }
+        tasks = []
+        for dimension, buckets in segments.items():
+            for key, transactions in buckets.items():
+                if len(transactions) < self.segment_min_orders:
+                    logger.info(f"  {key}: {len(transactions)} órdenes, se omite (mínimo {self.segment_min_orders})")
+                    continue
+                tasks.append((dimension, key, transactions, params))
+        if not tasks:
+            logger.warning("Ningún segmento con suficientes órdenes")
+            return
+        
+        results = {dimension: [] for dimension in dimensions}
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            for dimension, key, rules in pool.map(_mine_segment, tasks):
+                logger.info(f"  {key}: {len(rules)} reglas")
+                if not rules.empty:
+                    results[dimension].append(rules.assign(segment=key))
         
+        for dimension, frames in results.items():
+            if not frames:
+                logger.warning(f"Sin reglas para la dimensión {dimension}")
+                continue
+            self.save_rules_to_database(pd.concat(frames, ignore_index=True), product_names, scope=dimension)
+        
+        elapsed_time = (datetime.now() - start_time).total_seconds()
+        logger.info(f"\n✓ Análisis segmentado completado en {elapsed_time:.2f} segundos ({len(tasks)} segmentos)")
+        logger.info("=" * 80)
+    
+    def load_mining_state(self):
+        """
+        Estado del último minado (dwh.AprioriMiningState + dwh.AprioriItemsetCount).
+        Retorna dict con counts/border/n/last_fact_id/fact_rows, o None si no hay
+        estado válido (nunca se minó, quedó a medio guardar o cambió min_support).
+        """
+        connection = self.connect_to_database()
+        if not connection:
+            return None
+        try:
+            cursor = connection.cursor()
+            cursor.execute("""
+                SELECT TransactionCount, FactRowCount, LastFactId, MinSupport
+                FROM dwh.AprioriMiningState WHERE Id = 1
+            """)
+            row = cursor.fetchone()
+            if not row or row[0] is None:
+                return None
+            n, fact_rows, last_fact_id, min_support = row
+            if round(float(min_support), 6) != round(self.min_support, 6):
+                logger.info(f"min_support cambió ({float(min_support)} -> {self.min_support}); se requiere minado completo")
+                return None
+            
+            counts = {}
+            border = set()
+            cursor.execute("SELECT Itemset, SupportCount, IsBorder FROM dwh.AprioriItemsetCount")
+            for itemset, count, is_border in fetch_iter(cursor):
+                key = frozenset(int(pid) for pid in itemset.split(','))
+                counts[key] = count
+                if is_border:
+                    border.add(key)
+            return {"counts": counts, "border": border, "n": n, "last_fact_id": last_fact_id, "fact_rows": fact_rows}
+        except Exception as e:
+            logger.error(f"Error leyendo estado de minado: {e}")
+            return None
+        finally:
+            release_connection(connection)
+    
+    def save_mining_state(self, counts, border, n, last_fact_id, mode):
+        """
+        Persiste conteos (frecuentes + borde negativo), número de transacciones y
+        watermark. El estado se invalida antes de reescribir los conteos, así un
+        fallo a medio camino sólo provoca un minado completo en la próxima corrida.
+        """
+        connection = self.connect_to_database()
+        if not connection:
+            return
+        try:
+            cursor = connection.cursor()
+            cursor.execute("UPDATE dwh.AprioriMiningState SET TransactionCount = NULL WHERE Id = 1")
+            cursor.execute("TRUNCATE TABLE dwh.AprioriItemsetCount")
+            connection.commit()
+            
+            bulk_insert(
+                "dwh.AprioriItemsetCount",
+                ["Itemset", "ItemsetSize", "SupportCount", "IsBorder"],
+                (
+                    (','.join(map(str, sorted(itemset))), len(itemset), int(count), 1 if itemset in border else 0)
+                    for itemset, count in counts.items()
+                ),
+            )
+            
+            # Filas de hechos que respaldan el estado: detecta borrados/reprocesos
+            cursor.execute(
+                "SELECT COUNT(*) FROM dwh.FactSales WHERE productCant > 0 AND id <= %s",
+                (last_fact_id,)
+            )
+            fact_rows = cursor.fetchone()[0]
+            cursor.execute("""
+                UPDATE dwh.AprioriMiningState
+                SET TransactionCount = %s, FactRowCount = %s, LastFactId = %s,
+                    MinSupport = %s, Modo = %s, FechaMineria = GETDATE()
+                WHERE Id = 1
+            """, (n, fact_rows, last_fact_id, self.min_support, mode))
+            connection.commit()
+            logger.info(f"Estado de minado guardado: {len(counts)} itemsets, {n} transacciones, FactSales.id <= {last_fact_id}")
         except Exception as e:
-            logger.error(f"Error guardando reglas en base de datos: {e}")
+            logger.error(f"Error guardando estado de minado: {e}")
             connection.rollback()
         finally:
-            connection.close()
+            release_connection(connection)
+    
+    def _increment_is_foldable(self, state, until_fact_id):
+        """
+        El incremento sólo puede sumarse si los hechos ya contados no cambiaron:
+        mismas filas hasta el watermark y ninguna orden nueva con líneas viejas
+        (una orden modificada cambia una canasta ya contada).
+        """
+        connection = self.connect_to_database()
+        if not connection:
+            return False
+        try:
+            cursor = connection.cursor()
+            cursor.execute("""
+                SELECT
+                    (SELECT COUNT(*) FROM dwh.FactSales WHERE productCant > 0 AND id <= %(since)s),
+                    (SELECT COUNT(*) FROM dwh.FactSales f
+                     WHERE f.productCant > 0 AND f.id <= %(since)s
+                       AND f.orderId IN (SELECT d.orderId FROM dwh.FactSales d
+                                         WHERE d.id > %(since)s AND d.id <= %(until)s))
+            """, {"since": state["last_fact_id"], "until": until_fact_id})
+            fact_rows, touched = cursor.fetchone()
+            if fact_rows != state["fact_rows"]:
+                logger.info(f"Hechos ya minados cambiaron ({state['fact_rows']} -> {fact_rows} filas)")
+                return False
+            if touched:
+                logger.info(f"{touched} líneas de órdenes ya minadas fueron modificadas")
+                return False
+            return True
+        finally:
+            release_connection(connection)
     
     def run_analysis(self):
         """Ejecuta el análisis completo de Apriori"""
@@ -315,25 +738,104 @@ class AprioriAnalysis:
         start_time = datetime.now()
         
         # 1. Extraer transacciones
-        transactions, product_names = self.extract_transactions()
+        until_fact_id = self.get_max_fact_id()
+        transactions, product_names = self.extract_transactions(until_fact_id)
         
         if not transactions:
             logger.error("No se pudieron extraer transacciones. Abortando análisis.")
             return
         
         # 2. Ejecutar Apriori
-        rules = self.run_apriori(transactions)
+        frequent_itemsets, rules = self.mine_rules(transactions)
+        
+        # 3. Estado para corridas incrementales
+        if not frequent_itemsets.empty:
+            counts, border = build_itemset_state(transactions, frequent_itemsets)
+            self.save_mining_state(counts, border, len(transactions), until_fact_id, "full")
         
         if rules.empty:
             logger.warning("No se generaron reglas de asociación. Considerar ajustar parámetros.")
             return
         
-        # 3. Guardar en base de datos
+        # 4. Guardar en base de datos
         self.save_rules_to_database(rules, product_names)
         
         elapsed_time = (datetime.now() - start_time).total_seconds()
         logger.info(f"\n✓ Análisis Apriori completado en {elapsed_time:.2f} segundos")
         logger.info("=" * 80)
+    
+    def run_incremental(self):
+        """
+        Suma sólo las órdenes con hechos nuevos desde el último watermark a los
+        conteos persistidos y rederiva confidence/lift. Cae a run_analysis si no
+        hay estado, si cambiaron hechos ya minados o si cambió el borde.
+        """
+        logger.info("=" * 80)
+        logger.info("ACTUALIZACIÓN INCREMENTAL DE REGLAS DE ASOCIACIÓN")
+        logger.info("=" * 80)
+        
+        start_time = datetime.now()
+        
+        if self.pairs_only:
+            # Los pares se recalculan completos: el producto X^T X ya es más barato que mantener estado
+            logger.info("APRIORI_PAIRS_ONLY activo: recálculo completo de pares")
+            return self.run_analysis()
+        
+        state = self.load_mining_state()
+        if state is None:
+            logger.info("Sin estado de minado válido: minado completo")
+            return self.run_analysis()
+        
+        until_fact_id = self.get_max_fact_id()
+        if until_fact_id is None:
+            return
+        if until_fact_id < state["last_fact_id"]:
+            # FactSales se limpió y recargó (identidad reseteada): los conteos ya no aplican
+            logger.info(f"FactSales.id retrocedió ({state['last_fact_id']} -> {until_fact_id}): minado completo")
+            return self.run_analysis()
+        
+        if not self._increment_is_foldable(state, until_fact_id):
+            return self.run_analysis()
+        
+        if until_fact_id == state["last_fact_id"]:
+            logger.info(f"Sin hechos nuevos desde FactSales.id {state['last_fact_id']}")
+            return
+        
+        # 1. Incremento
+        delta, product_names = self.extract_transactions(until_fact_id, state["last_fact_id"])
+        if not delta:
+            # Sólo llegaron líneas con productCant <= 0: avanzar watermark
+            self.save_mining_state(state["counts"], state["border"], state["n"], until_fact_id, "incremental")
+            return
+        
+        # 2. Conteos actualizados (None = cambió el borde)
+        updated = update_itemset_counts(state["counts"], state["border"], state["n"], delta, self.min_support)
+        if updated is None:
+            return self.run_analysis()
+        counts, border, n = updated
+        
+        # 3. Reglas desde los conteos
+        rules = self.derive_rules(frequent_from_counts(counts, n, self.min_support))
+        self.save_mining_state(counts, border, n, until_fact_id, "incremental")
+        
+        if rules.empty:
+            logger.warning("No se generaron reglas de asociación. Considerar ajustar parámetros.")
+            return
+        
+        self.save_rules_to_database(rules, product_names)
+        
+        elapsed_time = (datetime.now() - start_time).total_seconds()
+        logger.info(f"\n✓ Actualización incremental completada en {elapsed_time:.2f} segundos ({len(delta)} órdenes nuevas)")
+        logger.info("=" * 80)
+
+
+def _mine_segment(task):
+    """Worker de run_segmented: minado serial de un segmento con los umbrales del proceso padre."""
+    dimension, key, transactions, params = task
+    analysis = AprioriAnalysis()
+    analysis.__dict__.update(params)
+    analysis.partitions = 1
+    return dimension, key, analysis.mine_rules(transactions)[1]
 
 
 def main():
@@ -347,9 +849,14 @@ def main():
         
         if command == "run":
             apriori.run_analysis()
+        elif command == "incremental":
+            apriori.run_incremental()
+        elif command == "segmented":
+            dimensions = sys.argv[2].split(",") if len(sys.argv) > 2 else None
+            apriori.run_segmented(dimensions)
         else:
             print(f"Comando desconocido: {command}")
-            print("Uso: python apriori_analysis.py run")
+            print("Uso: python apriori_analysis.py [run|incremental|segmented [channel,country,month]]")
     else:
         # Por defecto ejecutar análisis
         apriori.run_analysis()
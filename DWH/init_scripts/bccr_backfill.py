@@ -0,0 +1,158 @@
+"""
+Motor de backfill concurrente para consultas al BCCR.
+
+Divide un rango de fechas en ventanas, las consulta en paralelo sobre una
+sesión HTTP compartida (keep-alive) bajo un token bucket que limita las
+solicitudes por segundo, y reintenta cada ventana con backoff exponencial con
+jitter. Devuelve los registros obtenidos y las ventanas que fallaron, para que
+el llamador las reporte en lugar de dejar huecos silenciosos.
+
+Uso:
+    from bccr_backfill import backfill, make_session, split_windows
+    rates, failed = backfill(bccr.fetch_exchange_rate_data, split_windows(inicio, fin, 180))
+
+coalesce_windows arma las ventanas a partir de rangos faltantes (sync por huecos).
+"""
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_RATE = 2.0  # solicitudes por segundo
+DEFAULT_BURST = 4
+DEFAULT_RETRIES = 4
+DEFAULT_BACKOFF = 1.0  # segundos, base del backoff exponencial
+DEFAULT_MAX_BACKOFF = 30.0
+
+
+class TokenBucket:
+    """Limitador de tasa thread-safe: `rate` tokens por segundo, hasta `capacity` acumulados."""
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=DEFAULT_BURST):
+        self.rate = float(rate)
+        self.capacity = float(max(capacity, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Bloquea hasta que haya un token disponible. Con rate <= 0 no limita."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def make_session(pool_size=DEFAULT_WORKERS):
+    """Sesión requests con un pool de conexiones keep-alive del tamaño del paralelismo."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def split_windows(start_date, end_date, chunk_days):
+    """Ventanas [inicio, fin] contiguas de a lo sumo chunk_days + 1 días que cubren el rango."""
+    windows = []
+    current = start_date
+    while current <= end_date:
+        window_end = min(current + timedelta(days=chunk_days), end_date)
+        windows.append((current, window_end))
+        current = window_end + timedelta(days=1)
+    return windows
+
+
+def backoff_delay(attempt, base=DEFAULT_BACKOFF, cap=DEFAULT_MAX_BACKOFF):
+    """Backoff exponencial con jitter completo: uniforme en [0, min(cap, base * 2^attempt)]."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def fetch_with_retry(fetch, start_date, end_date, bucket, retries=DEFAULT_RETRIES,
+                     backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF):
+    """
+    Llama fetch(start, end) respetando el token bucket y reintenta ante cualquier
+    excepción. Lanza la última excepción si se agotan los intentos.
+    """
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        try:
+            return fetch(start_date, end_date)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff_delay(attempt, backoff, max_backoff)
+            logger.warning(
+                f"Ventana {start_date} a {end_date} falló (intento {attempt + 1}/{retries + 1}): {e}. "
+                f"Reintentando en {delay:.1f}s"
+            )
+            time.sleep(delay)
+
+
+def backfill(fetch, windows, max_workers=DEFAULT_WORKERS, bucket=None, retries=DEFAULT_RETRIES,
+             backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF):
+    """
+    Consulta todas las ventanas en paralelo.
+    fetch(start, end) debe devolver una lista de registros o lanzar excepción.
+    Retorna: (registros, [(inicio, fin, error), ...] de ventanas fallidas)
+    """
+    if not windows:
+        return [], []
+    bucket = bucket or TokenBucket()
+    records = []
+    failed = []
+    workers = max(1, min(max_workers, len(windows)))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(fetch_with_retry, fetch, start, end, bucket, retries, backoff, max_backoff): (start, end)
+            for start, end in windows
+        }
+        for future in as_completed(futures):
+            start, end = futures[future]
+            try:
+                rows = future.result()
+                records.extend(rows)
+                logger.info(f"Ventana {start} a {end}: {len(rows)} registros")
+            except Exception as e:
+                logger.error(f"Ventana {start} a {end} falló definitivamente: {e}")
+                failed.append((start, end, str(e)))
+
+    failed.sort()
+    return records, failed
+
+
+def coalesce_windows(ranges, chunk_days, max_gap_days=0):
+    """
+    Convierte rangos faltantes [(inicio, fin), ...] en el mínimo de ventanas de
+    consulta: une rangos separados por a lo sumo max_gap_days días (reconsultar
+    unos días conocidos cuesta menos que otra solicitud) y parte los que
+    exceden chunk_days.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and (start - merged[-1][1]).days - 1 <= max_gap_days:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    windows = []
+    for start, end in merged:
+        windows.extend(split_windows(start, end, chunk_days))
+    return windows
@@ -0,0 +1,132 @@
+"""
+Caché local (SQLite) de tipos de cambio ya parseados del BCCR.
+
+Las consultas se alinean a meses calendario: cada mes es una entrada cuya
+llave es el hash de (indicador, inicio, fin). Los meses anteriores al actual
+no cambian una vez publicados y quedan inmutables solo si la respuesta los
+cubre completos; el mes en curso (incluye el día de hoy) y los meses
+incompletos expiran tras BCCR_CACHE_TTL segundos.
+
+Modos (BCCR_CACHE_MODE):
+    on      lee del caché y consulta al BCCR solo lo que falta o expiró
+    off     siempre consulta al BCCR
+    replay  nunca consulta al BCCR: sirve lo guardado aunque haya expirado y
+            lanza RateCacheMiss si falta un mes (pruebas y benchmarks offline)
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+BCCR_CACHE_MODE = os.getenv("BCCR_CACHE_MODE", "on").lower()
+BCCR_CACHE_PATH = Path(os.getenv("BCCR_CACHE_PATH", "/app/logs/bccr_cache.sqlite"))
+BCCR_CACHE_TTL = int(os.getenv("BCCR_CACHE_TTL", "900"))  # segundos, mes en curso
+
+CACHE_MODES = ("on", "off", "replay")
+
+
+class RateCacheMiss(LookupError):
+    """En modo replay, un mes pedido no está en el caché."""
+
+
+def month_pieces(start_date, end_date):
+    """Meses calendario completos [(primer_dia, ultimo_dia), ...] que cubren el rango."""
+    pieces = []
+    current = start_date.replace(day=1)
+    while current <= end_date:
+        next_month = (current.replace(day=28) + timedelta(days=4)).replace(day=1)
+        pieces.append((current, next_month - timedelta(days=1)))
+        current = next_month
+    return pieces
+
+
+def cache_key(indicador, start_date, end_date):
+    return hashlib.sha256(f"{indicador}:{start_date.isoformat()}:{end_date.isoformat()}".encode()).hexdigest()
+
+
+class RateCache:
+    """Entradas (indicador, ventana) -> lista de {fecha, tipo_cambio}. Seguro entre threads."""
+
+    def __init__(self, path=BCCR_CACHE_PATH, ttl=BCCR_CACHE_TTL):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS rate_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    indicador TEXT NOT NULL,
+                    inicio TEXT NOT NULL,
+                    fin TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    expires_at REAL
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        # Una conexión por operación: los workers del backfill comparten el archivo, no la conexión
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def expires_at(self, end_date, today=None, complete=True):
+        """None (inmutable) si la ventana está completa y termina antes del mes en curso; si no, ahora + ttl."""
+        today = today or date.today()
+        if complete and end_date < today.replace(day=1):
+            return None
+        return time.time() + self.ttl
+
+    def get(self, indicador, start_date, end_date, allow_expired=False):
+        """Registros guardados de la ventana, o None si no hay entrada vigente."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT payload, expires_at FROM rate_cache WHERE cache_key = ?",
+                (cache_key(indicador, start_date, end_date),),
+            ).fetchone()
+        if row is None:
+            return None
+        payload, expires_at = row
+        if expires_at is not None and expires_at < time.time() and not allow_expired:
+            return None
+        return [{"fecha": date.fromisoformat(fecha), "tipo_cambio": valor} for fecha, valor in json.loads(payload)]
+
+    def put(self, indicador, start_date, end_date, rates, complete=True):
+        """complete=False guarda con ttl aunque el mes esté cerrado (respuesta parcial)."""
+        payload = json.dumps([[r["fecha"].isoformat(), r["tipo_cambio"]] for r in rates], separators=(",", ":"))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    cache_key(indicador, start_date, end_date),
+                    str(indicador),
+                    start_date.isoformat(),
+                    end_date.isoformat(),
+                    payload,
+                    time.time(),
+                    self.expires_at(end_date, complete=complete),
+                ),
+            )
+
+    def purge_expired(self):
+        with self._connect() as conn:
+            deleted = conn.execute(
+                "DELETE FROM rate_cache WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),)
+            ).rowcount
+        if deleted:
+            logger.info(f"Caché BCCR: {deleted} entradas expiradas eliminadas")
+        return deleted
@@ -1,13 +1,17 @@
 
+import json
 import logging
 import os
 import platform
-import time
+import sys
+import threading
 from datetime import datetime, timedelta
 import xml.etree.ElementTree as ET
 
-import pymssql
 import requests
+from bccr_cache import BCCR_CACHE_MODE, CACHE_MODES, RateCache, RateCacheMiss, month_pieces
+from bccr_backfill import TokenBucket, backfill, coalesce_windows, make_session, split_windows
+from db_utils import acquire_connection, release_connection, wait_for_db
 from dotenv import load_dotenv
 
 # Cargar variables de entorno (.env ya esta en la imagen)
@@ -15,6 +19,56 @@ load_dotenv()
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+HISTORY_DAYS = 3 * 365  # 3 anos atras
+GAP_PADDING_DAYS = 3
+
+# Upsert de un lote completo: el JSON [{"fecha": "YYYY-MM-DD", "tasa": n}, ...]
+# se expande con OPENJSON y se aplica con un unico MERGE
+UPSERT_RATES_SQL = """
+MERGE staging.tipo_cambio AS target
+USING (
+    SELECT j.fecha, 'CRC' AS de_moneda, 'USD' AS a_moneda, j.tasa, 'BCCR' AS fuente
+    FROM OPENJSON(%s) WITH (fecha DATE '$.fecha', tasa DECIMAL(18,6) '$.tasa') AS j
+) AS src
+ON target.fecha = src.fecha AND target.de_moneda = src.de_moneda AND target.a_moneda = src.a_moneda
+WHEN MATCHED AND target.tasa <> src.tasa THEN
+    UPDATE SET tasa = src.tasa, fecha_actualizacion = GETDATE(), fuente = src.fuente
+WHEN NOT MATCHED THEN
+    INSERT (fecha, de_moneda, a_moneda, tasa, fuente)
+    VALUES (src.fecha, src.de_moneda, src.a_moneda, src.tasa, src.fuente);
+"""
+
+# Rangos de dias habiles (lunes a viernes) sin tasa CRC->USD ni en staging ni en
+# DimExchangeRate, excluyendo los que el BCCR ya respondio sin dato. Islas por
+# diferencia de ROW_NUMBER: dias habiles faltantes consecutivos (saltando fines
+# de semana) comparten grupo.
+MISSING_RATE_RANGES_SQL = """
+WITH dias AS (
+    SELECT TOP (DATEDIFF(day, %(inicio)s, %(fin)s) + 1)
+        DATEADD(day, ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1, CAST(%(inicio)s AS DATE)) AS fecha
+    FROM sys.all_objects a CROSS JOIN sys.all_objects b
+),
+habiles AS (
+    SELECT fecha, ROW_NUMBER() OVER (ORDER BY fecha) AS rn
+    FROM dias
+    WHERE DATEDIFF(day, '19000101', fecha) %% 7 < 5  -- 1900-01-01 fue lunes; no depende de DATEFIRST
+),
+faltantes AS (
+    SELECT h.fecha, h.rn - ROW_NUMBER() OVER (ORDER BY h.fecha) AS grupo
+    FROM habiles h
+    WHERE NOT EXISTS (SELECT 1 FROM staging.tipo_cambio t
+                      WHERE t.fecha = h.fecha AND t.de_moneda = 'CRC' AND t.a_moneda = 'USD')
+      AND NOT EXISTS (SELECT 1 FROM dwh.DimExchangeRate d
+                      WHERE d.[date] = h.fecha AND d.fromCurrency = 'CRC' AND d.toCurrency = 'USD')
+      AND NOT EXISTS (SELECT 1 FROM staging.tipo_cambio_sin_dato n
+                      WHERE n.fecha = h.fecha AND n.de_moneda = 'CRC' AND n.a_moneda = 'USD')
+)
+SELECT MIN(fecha) AS inicio, MAX(fecha) AS fin, COUNT(*) AS dias
+FROM faltantes
+GROUP BY grupo
+ORDER BY inicio;
+"""
+
 
 class BCCRExchangeRate:
     def __init__(self):
@@ -29,10 +83,117 @@ class BCCRExchangeRate:
         # Referencia informativa; pymssql no usa drivers ODBC
         self.driver = "ODBC Driver 17 for SQL Server" if platform.system() == "Windows" else "ODBC Driver 18 for SQL Server"
 
-        self.base_url = "https://gee.bccr.fi.cr/Indicadores/Suscripciones/WS/wsindicadoreseconomicos.asmx"
+        # BCCR_URL permite apuntar a un stub SOAP local para pruebas
+        self.base_url = os.getenv(
+            "BCCR_URL", "https://gee.bccr.fi.cr/Indicadores/Suscripciones/WS/wsindicadoreseconomicos.asmx"
+        )
         self.indicador = "317"  # compra del dolar
 
-    def get_exchange_rate_data(self, start_date, end_date):
+        # Backfill: ventanas concurrentes sobre una sesion keep-alive, con limite de tasa y reintentos
+        self.timeout = float(os.getenv("BCCR_TIMEOUT", "30"))
+        self.chunk_days = int(os.getenv("BCCR_CHUNK_DAYS", "180"))
+        self.workers = int(os.getenv("BCCR_WORKERS", "4"))
+        self.rate_limit = float(os.getenv("BCCR_RATE_LIMIT", "2"))  # solicitudes por segundo
+        self.retries = int(os.getenv("BCCR_RETRIES", "4"))
+        # Sync por huecos: rangos faltantes separados por <= N dias se piden en una sola ventana
+        self.gap_merge_days = int(os.getenv("BCCR_GAP_MERGE_DAYS", "7"))
+        self.session = make_session(self.workers)
+
+        # Cache local de tasas parseadas (BCCR_CACHE_MODE: on, off, replay)
+        self.cache_mode = BCCR_CACHE_MODE if BCCR_CACHE_MODE in CACHE_MODES else "on"
+        self.cache = RateCache() if self.cache_mode != "off" else None
+        if self.cache_mode == "on":
+            self.cache.purge_expired()
+        elif self.cache_mode == "replay":
+            self.retries = 0  # sin red: un faltante no se arregla reintentando
+        # Dias habiles ya registrados sin dato; se cargan al guardar el primer mes cerrado
+        self._known_without_rate = None
+        self._known_lock = threading.Lock()
+
+    def fetch_exchange_rate_data(self, start_date, end_date):
+        """
+        Tasas de [start_date, end_date] pasando por el cache: los meses guardados
+        se sirven localmente y los meses faltantes contiguos se piden al BCCR en
+        una sola consulta. Lanza requests.RequestException / ET.ParseError ante
+        errores (para reintentos) y RateCacheMiss en modo replay.
+        """
+        if self.cache is None:
+            return self._request_exchange_rate_data(start_date, end_date)
+
+        replay = self.cache_mode == "replay"
+        pieces = month_pieces(start_date, end_date)
+        cached = {piece: self.cache.get(self.indicador, *piece, allow_expired=replay) for piece in pieces}
+        missing = [piece for piece in pieces if cached[piece] is None]
+        if missing and replay:
+            raise RateCacheMiss(f"Sin cache para {missing[0][0]} a {missing[-1][1]} (modo replay)")
+
+        spans = []
+        for piece in missing:
+            if spans and spans[-1][-1][1] + timedelta(days=1) == piece[0]:
+                spans[-1].append(piece)
+            else:
+                spans.append([piece])
+        for span in spans:
+            rows = self._request_exchange_rate_data(span[0][0], span[-1][1])
+            for piece_start, piece_end in span:
+                piece_rows = [r for r in rows if piece_start <= r["fecha"] <= piece_end]
+                cached[(piece_start, piece_end)] = piece_rows
+                # Un mes sin datos suele ser un error del servicio, no se guarda
+                if piece_rows:
+                    complete = self.month_is_complete(piece_start, piece_end, piece_rows)
+                    self.cache.put(self.indicador, piece_start, piece_end, piece_rows, complete=complete)
+
+        if not missing:
+            logging.info(f"Cache BCCR: {start_date} a {end_date} servido localmente")
+        return [r for piece in pieces for r in cached[piece] if start_date <= r["fecha"] <= end_date]
+
+    def month_is_complete(self, start_date, end_date, rows):
+        """
+        True si las tasas cubren todos los dias habiles del mes, salvo los ya
+        registrados sin dato. Un mes cerrado incompleto (respuesta truncada) no
+        se guarda inmutable: expira y se vuelve a pedir.
+        """
+        if end_date >= datetime.today().date().replace(day=1):
+            return True  # el mes en curso expira de todas formas
+        returned = {r["fecha"] for r in rows}
+        pending = [
+            start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)
+            if (start_date + timedelta(days=i)).weekday() < 5
+            and start_date + timedelta(days=i) not in returned
+        ]
+        if not pending:
+            return True
+        known = self.known_days_without_rate()
+        return all(day in known for day in pending)
+
+    def known_days_without_rate(self):
+        """Fechas de staging.tipo_cambio_sin_dato (CRC/USD); vacio si la base no responde."""
+        with self._known_lock:
+            if self._known_without_rate is not None:
+                return self._known_without_rate
+            connection = self.connect_to_database()
+            if not connection:
+                return set()
+            try:
+                cursor = connection.cursor()
+                cursor.execute(
+                    "SELECT fecha FROM staging.tipo_cambio_sin_dato WHERE de_moneda = 'CRC' AND a_moneda = 'USD'"
+                )
+                self._known_without_rate = {
+                    fecha.date() if isinstance(fecha, datetime) else fecha for (fecha,) in cursor.fetchall()
+                }
+            except Exception as e:
+                logging.warning(f"No se pudieron leer los dias sin dato: {e}")
+                return set()
+            finally:
+                release_connection(connection)
+            return self._known_without_rate
+
+    def _request_exchange_rate_data(self, start_date, end_date):
+        """
+        Consulta el indicador para [start_date, end_date] usando la sesion compartida.
+        Lanza requests.RequestException / ET.ParseError ante errores.
+        """
         soap_body = f"""<?xml version="1.0" encoding="utf-8"?>
 <soap:Envelope xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
   <soap:Body>
@@ -55,137 +216,256 @@ class BCCRExchangeRate:
 
         logging.info(f"Consultando BCCR desde {start_date} hasta {end_date}")
 
-        try:
-            response = requests.post(self.base_url, data=soap_body, headers=headers)
-            response.raise_for_status()
+        response = self.session.post(self.base_url, data=soap_body, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
 
-            root = ET.fromstring(response.content)
-            soap_result = root.find(".//{http://ws.sdde.bccr.fi.cr}ObtenerIndicadoresEconomicosXMLResult")
+        root = ET.fromstring(response.content)
+        soap_result = root.find(".//{http://ws.sdde.bccr.fi.cr}ObtenerIndicadoresEconomicosXMLResult")
 
-            if soap_result is None or not soap_result.text:
-                logging.warning("No se encontro resultado XML en la respuesta SOAP")
-                return []
+        if soap_result is None or not soap_result.text:
+            logging.warning("No se encontro resultado XML en la respuesta SOAP")
+            return []
 
-            inner_root = ET.fromstring(soap_result.text)
+        inner_root = ET.fromstring(soap_result.text)
 
-            exchange_rates = []
-            for datos in inner_root.findall(".//INGC011_CAT_INDICADORECONOMIC"):
-                fecha_str = datos.find("DES_FECHA").text if datos.find("DES_FECHA") is not None else None
-                valor_str = datos.find("NUM_VALOR").text if datos.find("NUM_VALOR") is not None else None
+        exchange_rates = []
+        for datos in inner_root.findall(".//INGC011_CAT_INDICADORECONOMIC"):
+            fecha_str = datos.find("DES_FECHA").text if datos.find("DES_FECHA") is not None else None
+            valor_str = datos.find("NUM_VALOR").text if datos.find("NUM_VALOR") is not None else None
 
-                if fecha_str and valor_str:
-                    try:
-                        fecha = datetime.strptime(fecha_str, "%Y-%m-%dT%H:%M:%S%z").date()
-                        valor = float(valor_str)
-                        exchange_rates.append({"fecha": fecha, "tipo_cambio": valor})
-                    except ValueError as e:
-                        logging.warning(f"Error parsing date/value: {e}")
-                        continue
+            if fecha_str and valor_str:
+                try:
+                    fecha = datetime.strptime(fecha_str, "%Y-%m-%dT%H:%M:%S%z").date()
+                    valor = float(valor_str)
+                    exchange_rates.append({"fecha": fecha, "tipo_cambio": valor})
+                except ValueError as e:
+                    logging.warning(f"Error parsing date/value: {e}")
+                    continue
 
-            logging.info(f"Obtenidos {len(exchange_rates)} registros de tipos de cambio")
-            return exchange_rates
+        logging.info(f"Obtenidos {len(exchange_rates)} registros de tipos de cambio")
+        return exchange_rates
 
+    def get_exchange_rate_data(self, start_date, end_date):
+        """Igual que fetch_exchange_rate_data pero devuelve [] ante errores."""
+        try:
+            return self.fetch_exchange_rate_data(start_date, end_date)
         except requests.RequestException as e:
             logging.error(f"Error al obtener datos del BCCR: {e}")
             return []
         except ET.ParseError as e:
             logging.error(f"Error al parsear XML: {e}")
             return []
+        except RateCacheMiss as e:
+            logging.error(str(e))
+            return []
 
     def connect_to_database(self):
         try:
-            logging.info(f"Conectando a SQL Server: {self.server}/{self.database}")
-            server_parts = self.server.replace(",", ":").split(":")
-            server_host = server_parts[0]
-            server_port = int(server_parts[1]) if len(server_parts) > 1 else 1433
-
-            # Dentro de Docker usamos el nombre del servicio
-            if server_host == "localhost":
-                server_host = "sqlserver-dw"
-                server_port = 1433
-
-            logging.info(f"Intentando conectar a {server_host}:{server_port}/{self.database}")
-
-            connection = pymssql.connect(
-                server=server_host,
-                port=server_port,
-                user=self.username,
-                password=self.password,
-                database=self.database,
-                timeout=10,
-                as_dict=False,
-            )
+            if not wait_for_db():
+                logging.error(f"SQL Server no disponible: {self.server}/{self.database}")
+                return None
 
-            logging.info("Conexion a base de datos exitosa (pymssql/FreeTDS)")
+            connection = acquire_connection()
+            logging.info("Conexion obtenida del pool del DWH (pymssql/FreeTDS)")
             return connection
 
-        except pymssql.DatabaseError as e:
-            logging.error(f"Error de base de datos: {e}")
-            return None
         except Exception as e:
             logging.error(f"Error conectando a la base de datos: {e}")
             return None
 
-    def upsert_exchange_rates(self, rates):
+    def upsert_exchange_rates(self, rates, promote=False):
         """
-        Inserta o actualiza tipos de cambio en staging.tipo_cambio en batch.
+        Inserta o actualiza tipos de cambio en staging.tipo_cambio con un solo
+        MERGE: el lote viaja como un documento JSON (OPENJSON) en lugar de un
+        MERGE por fila. Con promote=True llama sp_promote_exchange_rate para el
+        rango del lote en la misma transaccion.
         Espera lista de dicts con keys: fecha (date) y tipo_cambio (float).
+        Retorna la cantidad de fechas enviadas.
         """
         if not rates:
             logging.info("No hay registros para insertar/actualizar")
-            return
+            return 0
+
+        # Una fila por fecha: MERGE falla si el origen repite la llave
+        by_date = {}
+        for r in rates:
+            fecha = r["fecha"]
+            if isinstance(fecha, str):
+                fecha = datetime.strptime(fecha, "%Y-%m-%d").date()
+            by_date[fecha] = float(r["tipo_cambio"])
+        payload = json.dumps([{"fecha": f.isoformat(), "tasa": t} for f, t in sorted(by_date.items())])
 
         connection = self.connect_to_database()
         if not connection:
-            return
+            return 0
 
         try:
             cursor = connection.cursor()
-            sql = """
-MERGE staging.tipo_cambio AS target
-USING (VALUES (%s, 'CRC', 'USD', %s, 'BCCR')) AS src(fecha, de_moneda, a_moneda, tasa, fuente)
-ON target.fecha = src.fecha AND target.de_moneda = src.de_moneda AND target.a_moneda = src.a_moneda
-WHEN MATCHED THEN
-    UPDATE SET tasa = src.tasa, fecha_actualizacion = GETDATE(), fuente = src.fuente
-WHEN NOT MATCHED THEN
-    INSERT (fecha, de_moneda, a_moneda, tasa, fuente)
-    VALUES (src.fecha, src.de_moneda, src.a_moneda, src.tasa, src.fuente);
-"""
-            params = []
-            for r in rates:
-                fecha = r["fecha"]
-                if isinstance(fecha, str):
-                    fecha = datetime.strptime(fecha, "%Y-%m-%d").date()
-                params.append((fecha, float(r["tipo_cambio"])))
-
-            cursor.executemany(sql, params)
+            cursor.execute(UPSERT_RATES_SQL, (payload,))
+            if promote:
+                cursor.execute(
+                    "EXEC dbo.sp_promote_exchange_rate @FechaDesde = %s, @FechaHasta = %s;",
+                    (min(by_date), max(by_date)),
+                )
             connection.commit()
-            logging.info(f"Upsert de tipos de cambio completado: {len(params)} registros")
+            logging.info(f"Upsert de tipos de cambio completado: {len(by_date)} registros en un MERGE")
+            if promote:
+                logging.info(f"DimExchangeRate actualizada via sp_promote_exchange_rate ({min(by_date)} a {max(by_date)})")
+            return len(by_date)
         except Exception as e:
             logging.error(f"Error actualizando tipos de cambio: {e}")
             connection.rollback()
+            return 0
         finally:
-            connection.close()
+            release_connection(connection)
 
     def populate_historical_data(self):
+        """
+        Backfill de 3 anos: ventanas de chunk_days consultadas en paralelo con
+        reintentos. Retorna la lista de ventanas fallidas [(inicio, fin, error)].
+        """
         end_date = datetime.today().date()
-        start_date = end_date - timedelta(days=3 * 365)  # 3 anos atras
+        start_date = end_date - timedelta(days=HISTORY_DAYS)
 
         logging.info(f"Obteniendo datos historicos desde {start_date} hasta {end_date}")
+        failed = self.backfill_windows(split_windows(start_date, end_date, self.chunk_days))
 
-        current_date = start_date
-        while current_date < end_date:
-            chunk_end = min(current_date + timedelta(days=180), end_date)
-            logging.info(f"Procesando chunk: {current_date} a {chunk_end}")
+        logging.info("Poblacion de datos historicos completada")
+        return failed
 
-            exchange_rates = self.get_exchange_rate_data(current_date, chunk_end)
-            self.upsert_exchange_rates(exchange_rates)
+    def find_missing_ranges(self, start_date, end_date):
+        """Rangos [(inicio, fin, dias_habiles)] sin tipo de cambio, en una sola consulta."""
+        connection = self.connect_to_database()
+        if not connection:
+            return None
 
-            current_date = chunk_end + timedelta(days=1)
-            time.sleep(2)
+        try:
+            cursor = connection.cursor()
+            cursor.execute(MISSING_RATE_RANGES_SQL, {"inicio": start_date, "fin": end_date})
+            return [(inicio, fin, dias) for inicio, fin, dias in cursor.fetchall()]
+        except Exception as e:
+            logging.error(f"Error calculando huecos de tipos de cambio: {e}")
+            return None
+        finally:
+            release_connection(connection)
 
-        logging.info("Poblacion de datos historicos completada")
-        self.promote_exchange_rates_to_dim()
+    def sync_missing_rates(self):
+        """
+        Sincronizacion por huecos: consulta al BCCR solo los dias habiles de los
+        ultimos 3 anos que faltan. Con la tabla completa no hace ninguna llamada.
+        Retorna la lista de ventanas fallidas [(inicio, fin, error)].
+        """
+        end_date = datetime.today().date()
+        start_date = end_date - timedelta(days=HISTORY_DAYS)
+
+        missing = self.find_missing_ranges(start_date, end_date)
+        if missing is None:
+            return [(start_date, end_date, "no se pudieron calcular los huecos")]
+        if not missing:
+            logging.info(f"Tipos de cambio completos entre {start_date} y {end_date}; sin consultas al BCCR")
+            self.promote_exchange_rates_to_dim()
+            return []
+
+        # Margen de dias conocidos alrededor de cada hueco: si el BCCR no trae el dia
+        # pedido pero si sus vecinos, el dia queda registrado como sin dato (feriado)
+        padded = [
+            (inicio - timedelta(days=GAP_PADDING_DAYS), min(fin + timedelta(days=GAP_PADDING_DAYS), end_date))
+            for inicio, fin, _ in missing
+        ]
+        windows = coalesce_windows(padded, self.chunk_days, self.gap_merge_days)
+        logging.info(
+            f"{sum(dias for _, _, dias in missing)} dias habiles faltantes en {len(missing)} rangos "
+            f"-> {len(windows)} ventanas de consulta"
+        )
+        return self.backfill_windows(windows)
+
+    def backfill_windows(self, windows):
+        """
+        Consulta las ventanas en paralelo; todo lo obtenido se aplica con un solo
+        upsert y una sola promocion a DimExchangeRate.
+        """
+        logging.info(
+            f"Backfill BCCR: {len(windows)} ventanas, {self.workers} workers, "
+            f"{self.rate_limit} req/s, {self.retries} reintentos"
+        )
+
+        rates, failed = backfill(
+            self.fetch_exchange_rate_data,
+            windows,
+            max_workers=self.workers,
+            bucket=TokenBucket(self.rate_limit, capacity=self.workers),
+            retries=self.retries,
+        )
+        if rates and not self.upsert_exchange_rates(rates, promote=True):
+            # Datos obtenidos pero no guardados: todo el rango cuenta como fallido
+            failed.append((windows[0][0], windows[-1][1], "error guardando tipos de cambio en la base"))
+        else:
+            self.mark_days_without_rate(windows, failed, rates)
+
+        if failed:
+            logging.error(f"{len(failed)} de {len(windows)} ventanas fallaron; rangos sin datos:")
+            for start, end, error in failed:
+                logging.error(f"  {start} a {end}: {error}")
+        return failed
+
+    def mark_days_without_rate(self, windows, failed, rates):
+        """
+        Registra los dias habiles pasados que el BCCR respondio sin dato (feriados)
+        para que el sync por huecos no los vuelva a pedir. Solo ventanas exitosas
+        que trajeron al menos un registro: una respuesta vacia puede ser un error.
+        Los dias posteriores al ultimo dato de la ventana tampoco se registran:
+        una respuesta truncada pierde la cola, no dias sueltos.
+        """
+        failed_windows = {(start, end) for start, end, _ in failed}
+        returned = {r["fecha"] for r in rates}
+
+        days = []
+        for start, end in windows:
+            if (start, end) in failed_windows:
+                continue
+            window_days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+            window_returned = [day for day in window_days if day in returned]
+            if not window_returned:
+                continue
+            last_returned = window_returned[-1]
+            days.extend(
+                day for day in window_days
+                if day < last_returned and day.weekday() < 5 and day not in returned
+            )
+        if not days:
+            return
+
+        connection = self.connect_to_database()
+        if not connection:
+            return
+
+        try:
+            cursor = connection.cursor()
+            for i in range(0, len(days), 900):
+                batch = days[i:i + 900]
+                values = ", ".join(["(%s)"] * len(batch))
+                cursor.execute(
+                    f"""
+INSERT INTO staging.tipo_cambio_sin_dato (fecha, de_moneda, a_moneda)
+SELECT v.fecha, 'CRC', 'USD'
+FROM (VALUES {values}) AS v(fecha)
+WHERE NOT EXISTS (
+    SELECT 1 FROM staging.tipo_cambio_sin_dato n
+    WHERE n.fecha = v.fecha AND n.de_moneda = 'CRC' AND n.a_moneda = 'USD'
+);
+""",
+                    tuple(batch),
+                )
+            connection.commit()
+            with self._known_lock:
+                if self._known_without_rate is not None:
+                    self._known_without_rate.update(days)
+            logging.info(f"{len(days)} dias habiles sin dato del BCCR registrados")
+        except Exception as e:
+            logging.error(f"Error registrando dias sin dato: {e}")
+            connection.rollback()
+        finally:
+            release_connection(connection)
 
     def update_current_rate(self):
         today = datetime.today().date()
@@ -197,9 +477,8 @@ WHEN NOT MATCHED THEN
 
         if exchange_rates:
             latest_rate = max(exchange_rates, key=lambda x: x["fecha"])
-            self.upsert_exchange_rates([latest_rate])
+            self.upsert_exchange_rates([latest_rate], promote=True)
             logging.info(f"Tipo de cambio actualizado: {latest_rate['tipo_cambio']}")
-            self.promote_exchange_rates_to_dim()
         else:
             logging.warning("No se pudo obtener el tipo de cambio actual")
 
@@ -220,7 +499,7 @@ WHEN NOT MATCHED THEN
             logging.error(f"Error ejecutando sp_promote_exchange_rate: {e}")
             connection.rollback()
         finally:
-            connection.close()
+            release_connection(connection)
 
     def start_scheduler(self, custom_hour=None, custom_minute=None):
         import subprocess
@@ -376,15 +655,18 @@ WHEN NOT MATCHED THEN
 
 
 def main():
-    import sys
-
     bccr = BCCRExchangeRate()
 
     if len(sys.argv) > 1:
         command = sys.argv[1]
 
-        if command == "populate":
-            bccr.populate_historical_data()
+        if command in ("populate", "sync"):
+            failed = bccr.populate_historical_data() if command == "populate" else bccr.sync_missing_rates()
+            if failed:
+                print("Rangos fallidos:", file=sys.stderr)
+                for start, end, error in failed:
+                    print(f"  {start} a {end}: {error}", file=sys.stderr)
+                sys.exit(1)
         elif command == "update-current":
             bccr.update_current_rate()
         elif command == "scheduler":
@@ -403,9 +685,10 @@ def main():
         elif command == "remove-scheduler":
             bccr.remove_scheduler()
         else:
-            print("Comandos disponibles: populate, scheduler, remove-scheduler")
+            print("Comandos disponibles: populate, sync, update-current, scheduler, remove-scheduler")
     else:
         print("  python bccr_exchange_rate.py populate")
+        print("  python bccr_exchange_rate.py sync")
         print("  python bccr_exchange_rate.py scheduler")
         print("  python bccr_exchange_rate.py scheduler HH:MM")
         print("  python bccr_exchange_rate.py remove-scheduler")
@@ -0,0 +1,247 @@
+"""
+Benchmark offline de los caminos de minado de AprioriAnalysis.
+
+Genera canastas sintéticas (popularidad Zipf + patrones plantados), ejecuta
+run_apriori con cada motor / modo a varios factores de escala y reporta tiempo,
+RSS pico y si las reglas coinciden con el camino de referencia (dense, el
+comportamiento original con mlxtend). No necesita SQL Server.
+
+Uso:
+    python benchmark_apriori.py
+    python benchmark_apriori.py --orders 20000 --products 800 --scales 1,2,4 --paths fpgrowth,eclat,son,pairs
+Sale con código 1 si algún camino produce reglas distintas a la referencia.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+logging.basicConfig(
+    level=logging.WARNING,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# Caminos de minado: atributos de AprioriAnalysis que se fijan para cada corrida
+PATHS = {
+    "dense": {"engine": "dense"},
+    "sparse": {"engine": "sparse"},
+    "fpgrowth": {"engine": "fpgrowth"},
+    "eclat": {"engine": "eclat"},
+    # Al menos 2 particiones: con 1 mine_frequent_itemsets cae al fpgrowth serial
+    "son": {"engine": "fpgrowth", "partitions": max(os.cpu_count() or 2, 2)},
+    "pairs": {"pairs_only": True},
+}
+REFERENCE_PATH = "dense"
+
+
+def generate_baskets(n_orders, n_products, zipf=1.1, mean_size=3.0, n_patterns=10,
+                     pattern_size=3, pattern_rate=0.15, seed=42):
+    """
+    Canastas sintéticas con la misma forma que extract_transactions:
+      - popularidad de productos ~ 1 / rank^zipf
+      - tamaño de canasta 1 + Poisson(mean_size - 1)
+      - n_patterns grupos de pattern_size productos; cada orden incluye uno
+        con probabilidad pattern_rate
+    Los product_ids empiezan en 1 como en dwh.DimProduct.
+    Retorna: (EncodedTransactions, patrones plantados)
+    """
+    from mining_engines import EncodedTransactions
+
+    rng = np.random.default_rng(seed)
+    product_ids = np.arange(1, n_products + 1)
+    weights = 1.0 / np.arange(1, n_products + 1) ** zipf
+    weights /= weights.sum()
+    patterns = [
+        tuple(sorted(rng.choice(product_ids, size=pattern_size, replace=False).tolist()))
+        for _ in range(n_patterns)
+    ]
+
+    sizes = 1 + rng.poisson(max(mean_size - 1, 0), size=n_orders)
+    draws = rng.choice(product_ids, size=int(sizes.sum()), p=weights)
+    planted = rng.random(n_orders) < pattern_rate
+    which = rng.integers(0, max(n_patterns, 1), size=n_orders)
+
+    transactions = EncodedTransactions()
+    offset = 0
+    for i, size in enumerate(sizes.tolist()):
+        basket = set(draws[offset:offset + size].tolist())
+        offset += size
+        if planted[i] and patterns:
+            basket.update(patterns[which[i]])
+        transactions.add(sorted(basket))
+    return transactions, patterns
+
+
+def rule_keys(rules):
+    """Conjunto comparable de reglas (redondeo para absorber diferencias de punto flotante)."""
+    if rules.empty:
+        return set()
+    keys = set()
+    for antecedents, consequents, support, confidence, lift in zip(
+        rules["antecedents"], rules["consequents"], rules["support"], rules["confidence"], rules["lift"]
+    ):
+        keys.add((
+            tuple(sorted(antecedents)), tuple(sorted(consequents)),
+            round(float(support), 9), round(float(confidence), 9), round(float(lift), 9),
+        ))
+    return keys
+
+
+def rule_keys_subset(keys, pairs_only):
+    """Reglas de referencia comparables con un camino (pairs solo produce reglas 1->1)."""
+    if not pairs_only:
+        return keys
+    return {k for k in keys if len(k[0]) == 1 and len(k[1]) == 1}
+
+
+def _run_path(args):
+    """Corre un camino en un proceso nuevo para medir su RSS pico de forma aislada."""
+    path, scale, params, settings = args
+    from apriori_analysis import AprioriAnalysis
+
+    transactions, patterns = generate_baskets(n_orders=params["orders"] * scale, **params["generator"])
+    analysis = AprioriAnalysis()
+    analysis.min_support = params["min_support"]
+    analysis.min_confidence = params["min_confidence"]
+    analysis.min_lift = params["min_lift"]
+    analysis.partitions = 1
+    analysis.pairs_only = False
+    analysis.pair_top_k = 0
+    analysis.__dict__.update(settings)
+
+    start = time.perf_counter()
+    rules = analysis.run_apriori(transactions)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss: KB en Linux. SON mina en procesos hijos (ya terminados al salir
+    # del pool): su pico cuenta en RUSAGE_CHILDREN, no en RUSAGE_SELF
+    self_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    peak_rss_mb = max(self_rss_mb, children_rss_mb)
+    planted_found = sum(
+        1 for pattern in patterns
+        if any(set(a) | set(c) <= set(pattern) for a, c, *_ in rule_keys(rules))
+    )
+    return {
+        "path": path,
+        "scale": scale,
+        "orders": len(transactions),
+        "seconds": elapsed,
+        "peak_rss_mb": peak_rss_mb,
+        "children_rss_mb": children_rss_mb,
+        "rules": len(rules),
+        "keys": rule_keys(rules),
+        "planted": f"{planted_found}/{len(patterns)}",
+    }
+
+
+def run_benchmark(paths, scales, params):
+    """
+    Ejecuta cada camino a cada escala; cada corrida en su propio proceso (spawn).
+    ProcessPoolExecutor y no multiprocessing.Pool: los workers de Pool son
+    daemon y no pueden lanzar los procesos del camino SON.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for scale in scales:
+        for path in paths:
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                result = pool.submit(_run_path, (path, scale, params, PATHS[path])).result()
+            results.append(result)
+            print(
+                f"  escala x{scale:<3} {path:<9} {result['orders']:>8} órdenes  "
+                f"{result['seconds']:8.2f} s  {result['peak_rss_mb']:8.1f} MB "
+                f"(hijos {result['children_rss_mb']:6.1f} MB)  "
+                f"{result['rules']:>7} reglas  plantados {result['planted']}",
+                flush=True,
+            )
+    return results
+
+
+def compare(results, reference=REFERENCE_PATH):
+    """Compara cada corrida con la referencia de su escala. Retorna lista de diferencias."""
+    mismatches = []
+    by_scale = {}
+    for result in results:
+        by_scale.setdefault(result["scale"], {})[result["path"]] = result
+    for scale, runs in sorted(by_scale.items()):
+        ref_path = reference if reference in runs else next(iter(runs))
+        ref = runs[ref_path]
+        for path, run in runs.items():
+            if path == ref_path:
+                continue
+            pairs_only = PATHS[path].get("pairs_only", False)
+            expected = rule_keys_subset(ref["keys"], pairs_only)
+            if run["keys"] != expected:
+                mismatches.append(
+                    f"escala x{scale}: {path} difiere de {ref_path} "
+                    f"({len(run['keys'] - expected)} extra, {len(expected - run['keys'])} faltantes)"
+                )
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline de los motores de AprioriAnalysis")
+    parser.add_argument("--orders", type=int, default=10000, help="órdenes a escala x1")
+    parser.add_argument("--products", type=int, default=500, help="tamaño del catálogo")
+    parser.add_argument("--zipf", type=float, default=1.1, help="sesgo Zipf de la popularidad")
+    parser.add_argument("--basket-size", type=float, default=3.0, help="tamaño promedio de canasta")
+    parser.add_argument("--patterns", type=int, default=10, help="patrones plantados")
+    parser.add_argument("--pattern-size", type=int, default=3)
+    parser.add_argument("--pattern-rate", type=float, default=0.15, help="fracción de órdenes con un patrón")
+    parser.add_argument("--scales", default="1,2,4", help="factores de escala separados por coma")
+    parser.add_argument("--paths", default=",".join(PATHS), help=f"caminos a medir ({', '.join(PATHS)})")
+    parser.add_argument("--min-support", type=float, default=0.01)
+    parser.add_argument("--min-confidence", type=float, default=0.3)
+    parser.add_argument("--min-lift", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    paths = [p.strip() for p in args.paths.split(",") if p.strip()]
+    unknown = [p for p in paths if p not in PATHS]
+    if unknown:
+        parser.error(f"caminos desconocidos: {', '.join(unknown)}")
+    scales = [int(s) for s in args.scales.split(",")]
+
+    params = {
+        "orders": args.orders,
+        "min_support": args.min_support,
+        "min_confidence": args.min_confidence,
+        "min_lift": args.min_lift,
+        "generator": {
+            "n_products": args.products,
+            "zipf": args.zipf,
+            "mean_size": args.basket_size,
+            "n_patterns": args.patterns,
+            "pattern_size": args.pattern_size,
+            "pattern_rate": args.pattern_rate,
+            "seed": args.seed,
+        },
+    }
+
+    print("=" * 80)
+    print(f"BENCHMARK APRIORI: {args.orders} órdenes x{scales}, {args.products} productos, zipf={args.zipf}")
+    print(f"support={args.min_support}, confidence={args.min_confidence}, lift={args.min_lift}")
+    print("=" * 80)
+
+    results = run_benchmark(paths, scales, params)
+    mismatches = compare(results)
+
+    print("=" * 80)
+    if mismatches:
+        for mismatch in mismatches:
+            print(f"✗ {mismatch}")
+        return False
+    print(f"✓ Todas las reglas coinciden con {REFERENCE_PATH if REFERENCE_PATH in paths else paths[0]}")
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
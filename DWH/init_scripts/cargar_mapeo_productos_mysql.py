@@ -10,7 +10,7 @@ import os
 import sys
 from pathlib import Path
 
-import pymssql
+from db_utils import acquire_connection, release_connection, wait_for_db
 from dotenv import load_dotenv
 
 # Cargar variables de entorno desde DWH/ o raiz
@@ -61,31 +61,15 @@ class ProductMappingLoader:
             return []
 
     def connect_to_database(self):
-        """Conecta a SQL Server DWH usando pymssql"""
+        """Obtiene una conexion del pool del DWH (db_utils)"""
         try:
-            server_parts = self.server.replace(",", ":").split(":")
-            server_host = server_parts[0]
-            server_port = int(server_parts[1]) if len(server_parts) > 1 else 1433
-
-            if server_host == "localhost":
-                server_host = "sqlserver-dw"
-                server_port = 1433
-
-            connection = pymssql.connect(
-                server=server_host,
-                port=server_port,
-                user=self.username,
-                password=self.password,
-                database=self.database,
-                timeout=10,
-                as_dict=False,
-            )
+            if not wait_for_db():
+                logger.error("[ERROR] DWH no disponible")
+                return None
 
+            connection = acquire_connection()
             logger.debug("[OK] Conexion a base de datos exitosa")
             return connection
-        except pymssql.DatabaseError as e:
-            logger.error(f"[ERROR] Error de base de datos: {e}")
-            return None
         except Exception as e:
             logger.error(f"[ERROR] Error conectando a BD: {e}")
             return None
@@ -148,7 +132,7 @@ VALUES (%s, %s, %s, %s, 1)
             logger.error(f"[ERROR] Error al cargar mappings: {e}")
             connection.rollback()
         finally:
-            connection.close()
+            release_connection(connection)
 
 
 def main():
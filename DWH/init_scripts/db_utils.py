@@ -1,7 +1,12 @@
+import atexit
 import logging
 import os
+import threading
 import time
-from typing import Iterable, Sequence
+from collections import deque
+from contextlib import contextmanager
+from itertools import chain, islice
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence
 
 import pymssql
 from dotenv import load_dotenv
@@ -10,6 +15,26 @@ load_dotenv()
 
 LOGGER = logging.getLogger(__name__)
 
+# Tamaño de lote para leer cursores de las fuentes (fetchmany / batch_size)
+FETCH_SIZE = int(os.getenv("ETL_FETCH_SIZE", "5000"))
+
+# Carga masiva: a partir de BULK_THRESHOLD filas executemany_chunks usa bulk_insert.
+# ETL_BULK_BACKEND = "values" (INSERT multi-fila) o "bulk_copy" (TDS bulk copy de pymssql).
+BULK_THRESHOLD = int(os.getenv("ETL_BULK_THRESHOLD", "2000"))
+BULK_BACKEND = os.getenv("ETL_BULK_BACKEND", "values").lower()
+# SQL Server acepta como maximo 1000 filas en un constructor VALUES
+VALUES_MAX_ROWS = 1000
+
+# Pool de conexiones al DWH (uno por proceso)
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))  # segundos antes de descartar una conexion ociosa
+POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))  # ociosa mas de esto -> SELECT 1 antes de reusar
+POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "600"))
+
+# Extraccion incremental: ETL_FULL_REFRESH=1 (o --full-refresh) ignora los watermarks
+ETL_FULL_REFRESH = os.getenv("ETL_FULL_REFRESH", "0") == "1"
+WATERMARK_TABLE = "staging.etl_watermark"
+
 
 def get_connection():
     server = os.getenv("serverenv", "localhost")
@@ -35,11 +60,139 @@ def get_connection():
     )
 
 
+class ConnectionPool:
+    """
+    Pool acotado de conexiones pymssql. Cada conexion se entrega a un solo
+    usuario a la vez; al devolverla se hace rollback de lo no confirmado.
+    Las conexiones ociosas mas de max_idle se cierran y las que llevan mas
+    de ping_after sin uso se validan con SELECT 1 antes de reutilizarse.
+    """
+
+    def __init__(self, factory, max_size: int = POOL_SIZE, max_idle: float = POOL_MAX_IDLE, ping_after: float = POOL_PING_AFTER):
+        self._factory = factory
+        self._max_idle = max_idle
+        self._ping_after = ping_after
+        self._idle = deque()  # (conexion, ultimo uso)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            return True
+        except Exception:
+            return False
+
+    def _evict_idle(self, now: float):
+        with self._lock:
+            keep = deque(item for item in self._idle if now - item[1] <= self._max_idle)
+            expired = [item[0] for item in self._idle if now - item[1] > self._max_idle]
+            self._idle = keep
+        for conn in expired:
+            self._close(conn)
+
+    def acquire(self, timeout: float = POOL_ACQUIRE_TIMEOUT):
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("No hay conexiones libres en el pool del DWH")
+        try:
+            now = time.monotonic()
+            self._evict_idle(now)
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._factory()
+                conn, last_used = item
+                if now - last_used <= self._ping_after or self._is_healthy(conn):
+                    return conn
+                LOGGER.info("Conexion del pool descartada (health check fallido)")
+                self._close(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard: bool = False):
+        try:
+            if not discard:
+                try:
+                    conn.rollback()
+                except Exception:
+                    discard = True
+            if discard:
+                self._close(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            self.release(conn, discard=True)
+            raise
+        else:
+            self.release(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn, _ in idle:
+            self._close(conn)
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+_DB_READY = False
+
+
+def get_pool() -> ConnectionPool:
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = ConnectionPool(get_connection)
+                atexit.register(_POOL.close_all)
+    return _POOL
+
+
+def pooled_connection():
+    """Context manager: `with pooled_connection() as conn:` toma y devuelve una conexion del pool."""
+    return get_pool().connection()
+
+
+def acquire_connection():
+    """Para codigo que no puede usar `with`: devolver siempre con release_connection()."""
+    return get_pool().acquire()
+
+
+def release_connection(conn, discard: bool = False):
+    get_pool().release(conn, discard=discard)
+
+
 def wait_for_db(retries: int = 30, delay: float = 2.0):
+    """Sondea el DWH una sola vez por proceso; la conexion de prueba queda en el pool."""
+    global _DB_READY
+    if _DB_READY:
+        return True
     for i in range(retries):
         try:
-            with get_connection():
+            with pooled_connection():
                 LOGGER.info("DB lista (%s/%s)", i + 1, retries)
+                _DB_READY = True
                 return True
         except Exception as e:
             LOGGER.info("DB no disponible (%s/%s): %s", i + 1, retries, e)
@@ -58,7 +211,7 @@ def executemany(table: str, columns: Sequence[str], rows: Iterable[Sequence]):
     if not wait_for_db():
         LOGGER.error("DB no disponible para insertar en %s", table)
         return 0
-    with get_connection() as conn:
+    with pooled_connection() as conn:
         cur = conn.cursor()
         cur.executemany(sql, rows)
         conn.commit()
@@ -66,11 +219,96 @@ def executemany(table: str, columns: Sequence[str], rows: Iterable[Sequence]):
         return cur.rowcount
 
 
+def iter_batches(rows: Iterable[Sequence], size: int) -> Iterator[List[Sequence]]:
+    """Agrupa un iterable en listas de a lo sumo `size` filas sin materializarlo."""
+    it = iter(rows)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def fetch_iter(cursor, size: int = FETCH_SIZE) -> Iterator:
+    """Recorre un cursor DB-API con fetchmany en lugar de fetchall."""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+
+def _bulk_values(conn, table: str, columns: Sequence[str], rows: Iterable[Sequence], batch_size: int) -> int:
+    """Un INSERT ... VALUES (...), (...), ... por lote: un round-trip cada batch_size filas."""
+    cols_str = ", ".join(columns)
+    row_placeholder = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    batch_size = min(batch_size, VALUES_MAX_ROWS)
+    total = 0
+    cur = conn.cursor()
+    for batch in iter_batches(rows, batch_size):
+        sql = f"INSERT INTO {table} ({cols_str}) VALUES " + ", ".join([row_placeholder] * len(batch))
+        cur.execute(sql, tuple(value for row in batch for value in row))
+        total += len(batch)
+    return total
+
+
+def _bulk_copy(conn, table: str, columns: Sequence[str], rows: Iterable[Sequence], batch_size: int) -> int:
+    """Bulk copy nativo de TDS (pymssql >= 2.2.8); mapea columnas por su ordinal en la tabla."""
+    cur = conn.cursor()
+    cur.execute("SELECT name, column_id FROM sys.columns WHERE object_id = OBJECT_ID(%s)", (table,))
+    ordinals = {name.lower(): column_id for name, column_id in cur.fetchall()}
+    column_ids = [ordinals[c.lower()] for c in columns]
+
+    counter = [0]
+
+    def counted():
+        for row in rows:
+            counter[0] += 1
+            yield tuple(row)
+
+    conn.bulk_copy(table, counted(), column_ids=column_ids, batch_size=batch_size, tablock=True)
+    return counter[0]
+
+
+def bulk_insert(table: str, columns: Sequence[str], rows: Iterable[Sequence], batch_size: int = VALUES_MAX_ROWS):
+    """
+    Carga masiva con la misma firma que executemany_chunks. Evita el
+    round-trip por fila de executemany en pymssql.
+    """
+    loader = _bulk_copy if BULK_BACKEND == "bulk_copy" else _bulk_values
+    if not wait_for_db():
+        LOGGER.error("DB no disponible para insertar en %s", table)
+        return 0
+    with pooled_connection() as conn:
+        total = loader(conn, table, columns, rows, batch_size)
+        conn.commit()
+        LOGGER.info("Insertadas %s filas en %s (bulk %s)", total, table, BULK_BACKEND)
+        return total
+
+
 def executemany_chunks(table: str, columns: Sequence[str], rows: Iterable[Sequence], chunk_size: int = 5000):
-    rows = list(rows)
-    if not rows:
+    """
+    Inserta `rows` en lotes de `chunk_size`. `rows` puede ser un generador:
+    cada lote se envia en cuanto se completa, asi la memoria queda acotada
+    por chunk_size y no por el tamaño de la fuente.
+
+    Si la fuente trae al menos BULK_THRESHOLD filas se delega en bulk_insert;
+    para decidirlo solo se retienen en memoria las primeras BULK_THRESHOLD filas.
+    """
+    batches = iter_batches(rows, chunk_size)
+    head = []
+    buffered = 0
+    for batch in batches:
+        head.append(batch)
+        buffered += len(batch)
+        if buffered >= BULK_THRESHOLD:
+            break
+    if not head:
         LOGGER.info("Sin filas para insertar en %s", table)
         return 0
+    if buffered >= BULK_THRESHOLD:
+        return bulk_insert(table, columns, chain.from_iterable(chain(head, batches)))
+
     total = 0
     placeholders = ", ".join(["%s"] * len(columns))
     cols_str = ", ".join(columns)
@@ -78,10 +316,9 @@ def executemany_chunks(table: str, columns: Sequence[str], rows: Iterable[Sequen
     if not wait_for_db():
         LOGGER.error("DB no disponible para insertar en %s", table)
         return 0
-    with get_connection() as conn:
+    with pooled_connection() as conn:
         cur = conn.cursor()
-        for i in range(0, len(rows), chunk_size):
-            batch = rows[i : i + chunk_size]
+        for batch in head:
             cur.executemany(sql, batch)
             total += cur.rowcount
         conn.commit()
@@ -93,7 +330,7 @@ def execute_sp(sp_name: str):
     if not wait_for_db():
         LOGGER.error("DB no disponible para ejecutar %s", sp_name)
         return
-    with get_connection() as conn:
+    with pooled_connection() as conn:
         cur = conn.cursor()
         cur.execute(f"EXEC {sp_name};")
         conn.commit()
@@ -104,7 +341,7 @@ def clear_table(table: str):
     if not wait_for_db():
         LOGGER.error("DB no disponible para truncar %s", table)
         return
-    with get_connection() as conn:
+    with pooled_connection() as conn:
         cur = conn.cursor()
         try:
             cur.execute(f"TRUNCATE TABLE {table};")
@@ -112,3 +349,156 @@ def clear_table(table: str):
             cur.execute(f"DELETE FROM {table};")
         conn.commit()
         LOGGER.info("Limpieza completa de %s", table)
+
+
+def upsert_chunks(
+    table: str,
+    columns: Sequence[str],
+    rows: Iterable[Sequence],
+    key_columns: Sequence[str] = ("source_system", "source_key"),
+    chunk_size: int = 5000,
+):
+    """
+    Upsert por lotes: las filas se cargan en una tabla temporal con
+    INSERT multi-fila y se aplican con un solo MERGE sobre `key_columns`
+    (la clave natural unica de cada tabla de staging).
+    """
+    batches = iter_batches(rows, chunk_size)
+    first = next(batches, None)
+    if first is None:
+        LOGGER.info("Sin filas nuevas para %s", table)
+        return 0
+    if not wait_for_db():
+        LOGGER.error("DB no disponible para actualizar %s", table)
+        return 0
+
+    cols_str = ", ".join(columns)
+    keys_str = ", ".join(key_columns)
+    on = " AND ".join(f"t.{c} = s.{c}" for c in key_columns)
+    updates = ", ".join(f"{c} = s.{c}" for c in columns if c not in key_columns)
+    src_cols = ", ".join(f"s.{c}" for c in columns)
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT TOP 0 {cols_str} INTO #delta FROM {table}")
+        loaded = _bulk_values(conn, "#delta", columns, chain.from_iterable(chain([first], batches)), VALUES_MAX_ROWS)
+        cur.execute(
+            f"""
+            MERGE {table} AS t
+            USING (
+                SELECT {cols_str}
+                FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY {keys_str} ORDER BY (SELECT NULL)) AS rn
+                    FROM #delta
+                ) d
+                WHERE rn = 1
+            ) AS s
+            ON {on}
+            WHEN MATCHED THEN
+                UPDATE SET {updates}, fecha_carga = GETDATE()
+            WHEN NOT MATCHED THEN
+                INSERT ({cols_str}) VALUES ({src_cols});
+            """
+        )
+        merged = cur.rowcount
+        cur.execute("DROP TABLE #delta")
+        conn.commit()
+        LOGGER.info("Upsert en %s: %s filas leidas, %s insertadas/actualizadas", table, loaded, merged)
+        return loaded
+
+
+def get_watermark(source_system: str, table_name: str, column: str) -> Optional[str]:
+    """Ultimo valor extraido; None si no existe o se guardo sobre otra columna."""
+    if not wait_for_db():
+        return None
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT watermark_column, watermark_value FROM {WATERMARK_TABLE} WHERE source_system = %s AND table_name = %s",
+            (source_system, table_name),
+        )
+        row = cur.fetchone()
+        if not row or row[0] != column:
+            return None
+        return row[1]
+
+
+def set_watermark(source_system: str, table_name: str, column: str, value, rows_loaded: int):
+    if not wait_for_db():
+        LOGGER.error("DB no disponible para guardar watermark de %s", table_name)
+        return
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            MERGE {WATERMARK_TABLE} AS t
+            USING (SELECT %s AS source_system, %s AS table_name) AS s
+            ON t.source_system = s.source_system AND t.table_name = s.table_name
+            WHEN MATCHED THEN
+                UPDATE SET watermark_column = %s, watermark_value = %s, rows_loaded = %s, updated_at = GETDATE()
+            WHEN NOT MATCHED THEN
+                INSERT (source_system, table_name, watermark_column, watermark_value, rows_loaded)
+                VALUES (s.source_system, s.table_name, %s, %s, %s);
+            """,
+            (source_system, table_name, column, value, rows_loaded, column, value, rows_loaded),
+        )
+        conn.commit()
+        LOGGER.info("Watermark %s/%s = %s (%s filas)", source_system, table_name, value, rows_loaded)
+
+
+class Watermark:
+    """
+    High-water mark de una tabla fuente hacia una tabla de staging.
+
+    `since` es el ultimo valor extraido (None => extraccion completa) y
+    `track()` va registrando el maximo visto mientras las filas fluyen
+    hacia el writer, sin materializarlas.
+    """
+
+    def __init__(self, source_system: str, table_name: str, column: str,
+                 parse: Callable[[str], Any] = str, full_refresh: bool = ETL_FULL_REFRESH):
+        self.source_system = source_system
+        self.table_name = table_name
+        self.column = column
+        stored = None if full_refresh else get_watermark(source_system, table_name, column)
+        self.since = parse(stored) if stored is not None else None
+        self.value = self.since
+
+    @property
+    def full_refresh(self) -> bool:
+        return self.since is None
+
+    def track(self, records: Iterable, key: Callable[[Any], Any]) -> Iterator:
+        for record in records:
+            value = key(record)
+            if value is not None and (self.value is None or value > self.value):
+                self.value = value
+            yield record
+
+    def save(self, rows_loaded: int):
+        if self.value is None:
+            return
+        set_watermark(self.source_system, self.table_name, self.column, str(self.value), rows_loaded)
+
+
+def load_staging(
+    table: str,
+    columns: Sequence[str],
+    rows: Iterable[Sequence],
+    watermark: Watermark,
+    chunk_size: int = 5000,
+    key_columns: Sequence[str] = ("source_system", "source_key"),
+):
+    """
+    Carga `rows` en staging segun el watermark: sin watermark previo limpia la
+    tabla y hace carga completa; con watermark hace upsert del delta. Al final
+    avanza el watermark.
+    """
+    if watermark.full_refresh:
+        LOGGER.info("%s: extraccion completa", table)
+        clear_table(table)
+        total = executemany_chunks(table, columns, rows, chunk_size=chunk_size)
+    else:
+        LOGGER.info("%s: extraccion incremental desde %s > %s", table, watermark.column, watermark.since)
+        total = upsert_chunks(table, columns, rows, key_columns=key_columns, chunk_size=chunk_size)
+    watermark.save(total)
+    return total
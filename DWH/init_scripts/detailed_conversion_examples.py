@@ -72,7 +72,7 @@ cur.execute("""
         END as precio_usd_calculado,
         ms.order_date
     FROM staging.mysql_sales ms
-    LEFT JOIN dwh.DimExchangeRate ex ON ex.date = ms.order_date AND ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD'
+    LEFT JOIN dwh.ExchangeRateCalendar ex ON ex.date = ms.order_date AND ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD'
     WHERE ms.unit_price > 10000  -- Precios grandes para ver la diferencia
     ORDER BY ms.unit_price DESC
 """)
@@ -1,8 +1,10 @@
 import logging
 import os
+import sys
 from datetime import datetime
 
-from db_utils import clear_table, executemany_chunks
+from bson import ObjectId
+from db_utils import ETL_FULL_REFRESH, FETCH_SIZE, Watermark, load_staging
 from dotenv import load_dotenv
 from pymongo import MongoClient
 
@@ -30,101 +32,124 @@ def get_client():
     return MongoClient(uri)
 
 
-def load_orders():
-    clear_table("staging.mongo_orders")
+def id_filter(watermark):
+    """Filtro por _id: los ObjectId crecen con el tiempo de insercion."""
+    if watermark.full_refresh:
+        return {}
+    return {"_id": {"$gt": watermark.since}}
+
+
+def _doc_id(doc):
+    return doc.get("_id") if isinstance(doc.get("_id"), ObjectId) else None
+
+
+def load_orders(full_refresh=ETL_FULL_REFRESH):
+    wm = Watermark("MongoDB", "staging.mongo_orders", "ordens._id", parse=ObjectId, full_refresh=full_refresh)
     with get_client() as client:
         db = client.get_default_database()
         orders = db.get_collection("ordens")
-        rows = []
-        for doc in orders.find({}):
-            total = doc.get("total")
-            rows.append(
-                (
-                    "MongoDB",
-                    str(doc.get("_id")) or doc.get("orden_id"),
-                    str(doc.get("client_id")) or doc.get("cliente_id"),
-                    parse_date(doc.get("fecha")),
-                    total,
-                    doc.get("moneda") or "CRC",
-                    None,
-                )
+        rows = (
+            (
+                "MongoDB",
+                str(doc.get("_id")) or doc.get("orden_id"),
+                str(doc.get("client_id")) or doc.get("cliente_id"),
+                parse_date(doc.get("fecha")),
+                doc.get("total"),
+                doc.get("moneda") or "CRC",
+                None,
             )
-        executemany_chunks(
+            for doc in wm.track(orders.find(id_filter(wm), batch_size=FETCH_SIZE), key=_doc_id)
+        )
+        load_staging(
             "staging.mongo_orders",
             ["source_system", "source_key", "customer_key", "order_date", "total_amount", "currency", "payload_json"],
             rows,
+            wm,
+        )
+
+
+def _iter_item_rows(coll_items, orders, productos, wm):
+    """Items desde la colección orden_items (un documento por línea)."""
+    for doc in wm.track(coll_items.find(id_filter(wm), batch_size=FETCH_SIZE), key=_doc_id):
+        order_key = doc.get("orden_id") or doc.get("order_id")
+        producto_id = doc.get("producto_id")
+        product_desc = productos.get(str(producto_id)) if producto_id else None
+        moneda, fecha = orders.get(order_key, (None, None))
+
+        yield (
+            "MongoDB",
+            f"{order_key}-{doc.get('producto_id')}",
+            order_key,
+            producto_id,
+            product_desc,
+            doc.get("cantidad"),
+            doc.get("precio_unit"),
+            moneda or doc.get("moneda") or "CRC",
+            parse_date(fecha),
+            None,
         )
 
 
-def load_order_items():
-    clear_table("staging.mongo_order_items")
+def _iter_embedded_item_rows(orders_coll, wm):
+    """Fallback: items embebidos en ordens, recorriendo el cursor por lotes."""
+    projection = {"_id": 1, "orden_id": 1, "items": 1, "moneda": 1, "fecha": 1}
+    for doc in wm.track(orders_coll.find(id_filter(wm), projection, batch_size=FETCH_SIZE), key=_doc_id):
+        order_key = str(doc.get("_id")) or doc.get("orden_id")
+        items = doc.get("items", [])
+        for idx, item in enumerate(items):
+            # Extraer producto_id de diferentes lugares
+            producto_id = item.get("producto_id")
+            if not producto_id:
+                # Si está en equivalencias dict
+                equiv = item.get("equivalencias", {})
+                if isinstance(equiv, dict):
+                    producto_id = equiv.get("sku") or equiv.get("alt")
+                else:
+                    producto_id = item.get("sku")
+
+            yield (
+                "MongoDB",
+                f"{order_key}-{idx}",
+                str(order_key),
+                str(producto_id) if producto_id else None,
+                item.get("descripcion"),
+                float(item.get("cantidad", 0)),
+                float(item.get("precio_unit", 0)),
+                doc.get("moneda") or "CRC",
+                parse_date(doc.get("fecha")),
+                None,
+            )
+
+
+def load_order_items(full_refresh=ETL_FULL_REFRESH):
     with get_client() as client:
         db = client.get_default_database()
-        orders = {str(o.get("_id")) or o.get("orden_id"): o for o in db.get_collection("ordens").find({})}
-        
-        # Cargar productos para hacer lookup
-        productos = {}
-        try:
-            for p in db.get_collection("productos").find({}):
-                producto_id = str(p.get("_id"))
-                productos[producto_id] = p.get("nombre") or p.get("name") or "Unknown Product"
-        except Exception:
-            LOG.warning("No se pudo cargar colección productos")
-        
+        orders_coll = db.get_collection("ordens")
         coll_items = db.get_collection("orden_items")
-        rows = []
-
-        if coll_items.count_documents({}) > 0:
-            for doc in coll_items.find({}):
-                order_key = doc.get("orden_id") or doc.get("order_id")
-                producto_id = doc.get("producto_id")
-                product_desc = productos.get(str(producto_id)) if producto_id else None
-                
-                rows.append(
-                    (
-                        "MongoDB",
-                        f"{order_key}-{doc.get('producto_id')}",
-                        order_key,
-                        producto_id,
-                        product_desc,
-                        doc.get("cantidad"),
-                        doc.get("precio_unit"),
-                        (orders.get(order_key, {}).get("moneda") if order_key in orders else None) or doc.get("moneda") or "CRC",
-                        parse_date(orders.get(order_key, {}).get("fecha")) if order_key in orders else None,
-                        None,
-                    )
-                )
+
+        if coll_items.find_one({}, {"_id": 1}) is not None:
+            wm = Watermark("MongoDB", "staging.mongo_order_items", "orden_items._id", parse=ObjectId, full_refresh=full_refresh)
+            # Solo moneda y fecha por orden: evita cargar documentos completos en memoria
+            orders = {
+                str(o.get("_id")) or o.get("orden_id"): (o.get("moneda"), o.get("fecha"))
+                for o in orders_coll.find({}, {"_id": 1, "orden_id": 1, "moneda": 1, "fecha": 1}, batch_size=FETCH_SIZE)
+            }
+
+            # Cargar productos para hacer lookup
+            productos = {}
+            try:
+                for p in db.get_collection("productos").find({}, {"_id": 1, "nombre": 1, "name": 1}, batch_size=FETCH_SIZE):
+                    producto_id = str(p.get("_id"))
+                    productos[producto_id] = p.get("nombre") or p.get("name") or "Unknown Product"
+            except Exception:
+                LOG.warning("No se pudo cargar colección productos")
+
+            rows = _iter_item_rows(coll_items, orders, productos, wm)
         else:
-            # Fallback: items embebidos en ordens
-            for order_key, doc in orders.items():
-                items = doc.get("items", [])
-                for idx, item in enumerate(items):
-                    # Extraer producto_id de diferentes lugares
-                    producto_id = item.get("producto_id")
-                    if not producto_id:
-                        # Si está en equivalencias dict
-                        equiv = item.get("equivalencias", {})
-                        if isinstance(equiv, dict):
-                            producto_id = equiv.get("sku") or equiv.get("alt")
-                        else:
-                            producto_id = item.get("sku")
-                    
-                    rows.append(
-                        (
-                            "MongoDB",
-                            f"{order_key}-{idx}",
-                            str(order_key),
-                            str(producto_id) if producto_id else None,
-                            item.get("descripcion"),
-                            float(item.get("cantidad", 0)),
-                            float(item.get("precio_unit", 0)),
-                            doc.get("moneda") or "CRC",
-                            parse_date(doc.get("fecha")),
-                            None,
-                        )
-                    )
-
-        executemany_chunks(
+            wm = Watermark("MongoDB", "staging.mongo_order_items", "ordens._id", parse=ObjectId, full_refresh=full_refresh)
+            rows = _iter_embedded_item_rows(orders_coll, wm)
+
+        load_staging(
             "staging.mongo_order_items",
             [
                 "source_system",
@@ -139,43 +164,44 @@ def load_order_items():
                 "payload_json",
             ],
             rows,
+            wm,
         )
 
 
-def load_customers():
-    clear_table("staging.mongo_customers")
+def load_customers(full_refresh=ETL_FULL_REFRESH):
+    wm = Watermark("MongoDB", "staging.mongo_customers", "clientes._id", parse=ObjectId, full_refresh=full_refresh)
     with get_client() as client:
         db = client.get_default_database()
         customers = db.get_collection("clientes")
-        rows = []
-        for doc in customers.find({}):
-            rows.append(
-                (
-                    "MongoDB",
-                    str(doc.get("_id")) or doc.get("cliente_id"),
-                    doc.get("nombre"),
-                    doc.get("email"),
-                    doc.get("genero"),
-                    None,
-                )
+        rows = (
+            (
+                "MongoDB",
+                str(doc.get("_id")) or doc.get("cliente_id"),
+                doc.get("nombre"),
+                doc.get("email"),
+                doc.get("genero"),
+                None,
             )
-        executemany_chunks(
+            for doc in wm.track(customers.find(id_filter(wm), batch_size=FETCH_SIZE), key=_doc_id)
+        )
+        load_staging(
             "staging.mongo_customers",
             ["source_system", "source_key", "name", "email", "genero", "payload_json"],
             rows,
+            wm,
         )
 
 
-def load_products():
-    clear_table("staging.mongo_products")
+def load_products(full_refresh=ETL_FULL_REFRESH):
+    wm = Watermark("MongoDB", "staging.mongo_products", "productos._id", parse=ObjectId, full_refresh=full_refresh)
     with get_client() as client:
         db = client.get_default_database()
         productos = db.get_collection("productos")
-        rows = []
-        for doc in productos.find({}):
-            equiv = doc.get("equivalencias", {})
-            rows.append(
-                (
+
+        def iter_rows():
+            for doc in wm.track(productos.find(id_filter(wm), batch_size=FETCH_SIZE), key=_doc_id):
+                equiv = doc.get("equivalencias", {})
+                yield (
                     "MongoDB",
                     str(doc.get("_id")),
                     doc.get("codigo_mongo"),
@@ -185,19 +211,21 @@ def load_products():
                     equiv.get("alt") if isinstance(equiv, dict) else None,
                     None,
                 )
-            )
-        executemany_chunks(
+
+        load_staging(
             "staging.mongo_products",
             ["source_system", "source_key", "codigo_mongo", "nombre", "categoria", "sku_equiv", "alt_equiv", "payload_json"],
-            rows,
+            iter_rows(),
+            wm,
         )
 
 
 def main():
-    load_orders()
-    load_customers()
-    load_products()
-    load_order_items()
+    full_refresh = ETL_FULL_REFRESH or "--full-refresh" in sys.argv[1:]
+    load_orders(full_refresh)
+    load_customers(full_refresh)
+    load_products(full_refresh)
+    load_order_items(full_refresh)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,10 @@
 import logging
 import os
+import sys
 from datetime import datetime
 
 import pymssql
-from db_utils import clear_table, executemany_chunks
+from db_utils import ETL_FULL_REFRESH, Watermark, fetch_iter, load_staging
 from dotenv import load_dotenv
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -29,38 +30,48 @@ def get_conn():
     return pymssql.connect(server=host, port=port, user=user, password=pwd, database=db, timeout=30)
 
 
-def load_products():
-    clear_table("staging.mssql_products")
-    rows = []
+def incremental_query(sql, id_column, watermark):
+    """Agrega el filtro del watermark (columna IDENTITY) a la consulta fuente."""
+    if watermark.full_refresh:
+        return sql, None
+    return f"{sql} WHERE {id_column} > %s ORDER BY {id_column}", (watermark.since,)
+
+
+def load_products(full_refresh=ETL_FULL_REFRESH):
+    wm = Watermark("MSSQL_SRC", "staging.mssql_products", "Producto.ProductoId", parse=int, full_refresh=full_refresh)
     with get_conn() as conn:
         cur = conn.cursor(as_dict=True)
-        cur.execute("SELECT SKU AS source_key, Nombre, Categoria, 0.0 AS price FROM sales_ms.Producto")
-        for r in cur.fetchall():
-            rows.append(
-                (
-                    "MSSQL_SRC",
-                    r["source_key"],
-                    r["source_key"],  # code = SKU también
-                    r["Nombre"],
-                    r["Categoria"],
-                    r.get("price"),
-                    None,
-                )
+        cur.execute(*incremental_query(
+            "SELECT ProductoId, SKU AS source_key, Nombre, Categoria, 0.0 AS price FROM sales_ms.Producto",
+            "ProductoId",
+            wm,
+        ))
+        rows = (
+            (
+                "MSSQL_SRC",
+                r["source_key"],
+                r["source_key"],  # code = SKU también
+                r["Nombre"],
+                r["Categoria"],
+                r.get("price"),
+                None,
             )
-    executemany_chunks(
-        "staging.mssql_products",
-        ["source_system", "source_key", "code", "name", "category", "price", "payload_json"],
-        rows,
-        chunk_size=5000,
-    )
+            for r in wm.track(fetch_iter(cur), key=lambda r: r["ProductoId"])
+        )
+        load_staging(
+            "staging.mssql_products",
+            ["source_system", "source_key", "code", "name", "category", "price", "payload_json"],
+            rows,
+            wm,
+            chunk_size=5000,
+        )
 
 
-def load_customers():
-    clear_table("staging.mssql_customers")
-    rows = []
+def load_customers(full_refresh=ETL_FULL_REFRESH):
+    wm = Watermark("MSSQL_SRC", "staging.mssql_customers", "Cliente.ClienteId", parse=int, full_refresh=full_refresh)
     with get_conn() as conn:
         cur = conn.cursor(as_dict=True)
-        cur.execute(
+        cur.execute(*incremental_query(
             """
             SELECT ClienteId,
                    Nombre,
@@ -69,35 +80,37 @@ def load_customers():
                    Pais,
                    FechaRegistro
             FROM sales_ms.Cliente
-            """
-        )
-        for r in cur.fetchall():
-            rows.append(
-                (
-                    "MSSQL_SRC",
-                    str(r["ClienteId"]),
-                    r["Nombre"],
-                    r["Email"],
-                    r["Genero"],
-                    r["Pais"],
-                    parse_date(r["FechaRegistro"]),
-                    None,
-                )
+            """,
+            "ClienteId",
+            wm,
+        ))
+        rows = (
+            (
+                "MSSQL_SRC",
+                str(r["ClienteId"]),
+                r["Nombre"],
+                r["Email"],
+                r["Genero"],
+                r["Pais"],
+                parse_date(r["FechaRegistro"]),
+                None,
             )
-    executemany_chunks(
-        "staging.mssql_customers",
-        ["source_system", "source_key", "name", "email", "gender", "country", "created_at_src", "payload_json"],
-        rows,
-        chunk_size=5000,
-    )
+            for r in wm.track(fetch_iter(cur), key=lambda r: r["ClienteId"])
+        )
+        load_staging(
+            "staging.mssql_customers",
+            ["source_system", "source_key", "name", "email", "gender", "country", "created_at_src", "payload_json"],
+            rows,
+            wm,
+            chunk_size=5000,
+        )
 
 
-def load_sales():
-    clear_table("staging.mssql_sales")
-    rows = []
+def load_sales(full_refresh=ETL_FULL_REFRESH):
+    wm = Watermark("MSSQL_SRC", "staging.mssql_sales", "OrdenDetalle.OrdenDetalleId", parse=int, full_refresh=full_refresh)
     with get_conn() as conn:
         cur = conn.cursor(as_dict=True)
-        cur.execute(
+        cur.execute(*incremental_query(
             """
             SELECT d.OrdenDetalleId,
                    o.OrdenId,
@@ -111,48 +124,52 @@ def load_sales():
             FROM sales_ms.OrdenDetalle d
             JOIN sales_ms.Orden o ON d.OrdenId = o.OrdenId
             JOIN sales_ms.Producto p ON d.ProductoId = p.ProductoId
-            """
-        )
-        for r in cur.fetchall():
-            rows.append(
-                (
-                    "MSSQL_SRC",
-                    f"{r['OrdenId']}-{r['product_key']}",
-                    r["product_key"],
-                    r["customer_key"],
-                    r["OrdenId"],
-                    r["channel"],
-                    r["quantity"],
-                    r["unit_price"],
-                    r["currency"],
-                    parse_date(r["order_date"]),
-                    None,
-                )
+            """,
+            "d.OrdenDetalleId",
+            wm,
+        ))
+        rows = (
+            (
+                "MSSQL_SRC",
+                f"{r['OrdenId']}-{r['product_key']}",
+                r["product_key"],
+                r["customer_key"],
+                r["OrdenId"],
+                r["channel"],
+                r["quantity"],
+                r["unit_price"],
+                r["currency"],
+                parse_date(r["order_date"]),
+                None,
             )
-    executemany_chunks(
-        "staging.mssql_sales",
-        [
-            "source_system",
-            "source_key",
-            "product_key",
-            "customer_key",
-            "order_key",
-            "channel",
-            "quantity",
-            "unit_price",
-            "currency",
-            "order_date",
-            "payload_json",
-        ],
-        rows,
-        chunk_size=8000,
-    )
+            for r in wm.track(fetch_iter(cur), key=lambda r: r["OrdenDetalleId"])
+        )
+        load_staging(
+            "staging.mssql_sales",
+            [
+                "source_system",
+                "source_key",
+                "product_key",
+                "customer_key",
+                "order_key",
+                "channel",
+                "quantity",
+                "unit_price",
+                "currency",
+                "order_date",
+                "payload_json",
+            ],
+            rows,
+            wm,
+            chunk_size=8000,
+        )
 
 
 def main():
-    load_customers()
-    load_products()
-    load_sales()
+    full_refresh = ETL_FULL_REFRESH or "--full-refresh" in sys.argv[1:]
+    load_customers(full_refresh)
+    load_products(full_refresh)
+    load_sales(full_refresh)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,10 @@
 import logging
 import os
+import sys
 from datetime import datetime
 
 import pymysql
-from db_utils import clear_table, executemany_chunks
+from db_utils import ETL_FULL_REFRESH, Watermark, fetch_iter, load_staging
 from dotenv import load_dotenv
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -29,66 +30,77 @@ def get_conn():
     return pymysql.connect(host=host, port=port, user=user, password=pwd, database=db, cursorclass=pymysql.cursors.DictCursor)
 
 
-def load_products():
-    clear_table("staging.mysql_products")
-    rows = []
+def stream_cursor(conn):
+    """Cursor sin buffer (server-side): las filas se leen a medida que se consumen."""
+    return conn.cursor(pymysql.cursors.SSDictCursor)
+
+
+def incremental_query(sql, id_column, watermark):
+    """Agrega el filtro del watermark (id autoincremental) a la consulta fuente."""
+    if watermark.full_refresh:
+        return sql, None
+    return f"{sql} WHERE {id_column} > %s ORDER BY {id_column}", (watermark.since,)
+
+
+def load_products(full_refresh=ETL_FULL_REFRESH):
+    wm = Watermark("MySQL", "staging.mysql_products", "Producto.id", parse=int, full_refresh=full_refresh)
     with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, codigo_alt, nombre, categoria FROM Producto")
-            for r in cur.fetchall():
-                rows.append(
-                    (
-                        "MySQL",
-                        r["codigo_alt"],
-                        r["codigo_alt"],
-                        r["codigo_alt"],
-                        r["nombre"],
-                        r["categoria"],
-                        None,  # MySQL no tiene precio en Producto
-                        None,
-                    )
+        with stream_cursor(conn) as cur:
+            cur.execute(*incremental_query("SELECT id, codigo_alt, nombre, categoria FROM Producto", "id", wm))
+            rows = (
+                (
+                    "MySQL",
+                    r["codigo_alt"],
+                    r["codigo_alt"],
+                    r["codigo_alt"],
+                    r["nombre"],
+                    r["categoria"],
+                    None,  # MySQL no tiene precio en Producto
+                    None,
                 )
-    executemany_chunks(
-        "staging.mysql_products",
-        ["source_system", "source_key", "sku", "codigo_alt", "nombre", "categoria", "precio", "payload_json"],
-        rows,
-        chunk_size=5000,
-    )
+                for r in wm.track(fetch_iter(cur), key=lambda r: r["id"])
+            )
+            load_staging(
+                "staging.mysql_products",
+                ["source_system", "source_key", "sku", "codigo_alt", "nombre", "categoria", "precio", "payload_json"],
+                rows,
+                wm,
+                chunk_size=5000,
+            )
 
 
-def load_customers():
-    clear_table("staging.mysql_customers")
-    rows = []
+def load_customers(full_refresh=ETL_FULL_REFRESH):
+    wm = Watermark("MySQL", "staging.mysql_customers", "Cliente.id", parse=int, full_refresh=full_refresh)
     with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, nombre, correo, genero, pais, created_at FROM Cliente")
-            for r in cur.fetchall():
-                rows.append(
-                    (
-                        "MySQL",
-                        str(r["id"]),
-                        r["nombre"],
-                        r["correo"],
-                        r["genero"],
-                        r["pais"],
-                        parse_date(r["created_at"]),
-                        None,
-                    )
+        with stream_cursor(conn) as cur:
+            cur.execute(*incremental_query("SELECT id, nombre, correo, genero, pais, created_at FROM Cliente", "id", wm))
+            rows = (
+                (
+                    "MySQL",
+                    str(r["id"]),
+                    r["nombre"],
+                    r["correo"],
+                    r["genero"],
+                    r["pais"],
+                    parse_date(r["created_at"]),
+                    None,
                 )
-    executemany_chunks(
-        "staging.mysql_customers",
-        ["source_system", "source_key", "nombre", "correo", "genero", "pais", "created_at_src", "payload_json"],
-        rows,
-        chunk_size=5000,
-    )
+                for r in wm.track(fetch_iter(cur), key=lambda r: r["id"])
+            )
+            load_staging(
+                "staging.mysql_customers",
+                ["source_system", "source_key", "nombre", "correo", "genero", "pais", "created_at_src", "payload_json"],
+                rows,
+                wm,
+                chunk_size=5000,
+            )
 
 
-def load_sales():
-    clear_table("staging.mysql_sales")
-    rows = []
+def load_sales(full_refresh=ETL_FULL_REFRESH):
+    wm = Watermark("MySQL", "staging.mysql_sales", "OrdenDetalle.id", parse=int, full_refresh=full_refresh)
     with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
+        with stream_cursor(conn) as cur:
+            cur.execute(*incremental_query(
                 """
                 SELECT d.id AS detalle_id,
                        o.id AS orden_id,
@@ -102,48 +114,52 @@ def load_sales():
                 FROM OrdenDetalle d
                 JOIN Orden o ON d.orden_id = o.id
                 JOIN Producto p ON d.producto_id = p.id
-                """
-            )
-            for r in cur.fetchall():
-                rows.append(
-                    (
-                        "MySQL",
-                        f"{r['orden_id']}-{r['sku']}",
-                        r["sku"],
-                        r["customer_key"],
-                        r["orden_id"],
-                        r["canal"],
-                        r["cantidad"],
-                        r["precio_unit"],
-                        r["moneda"],
-                        parse_date(r["fecha"]),
-                        None,
-                    )
+                """,
+                "d.id",
+                wm,
+            ))
+            rows = (
+                (
+                    "MySQL",
+                    f"{r['orden_id']}-{r['sku']}",
+                    r["sku"],
+                    r["customer_key"],
+                    r["orden_id"],
+                    r["canal"],
+                    r["cantidad"],
+                    r["precio_unit"],
+                    r["moneda"],
+                    parse_date(r["fecha"]),
+                    None,
                 )
-    executemany_chunks(
-        "staging.mysql_sales",
-        [
-            "source_system",
-            "source_key",
-            "sku",
-            "customer_key",
-            "order_key",
-            "channel",
-            "quantity",
-            "unit_price",
-            "currency",
-            "order_date",
-            "payload_json",
-        ],
-        rows,
-        chunk_size=8000,
-    )
+                for r in wm.track(fetch_iter(cur), key=lambda r: r["detalle_id"])
+            )
+            load_staging(
+                "staging.mysql_sales",
+                [
+                    "source_system",
+                    "source_key",
+                    "sku",
+                    "customer_key",
+                    "order_key",
+                    "channel",
+                    "quantity",
+                    "unit_price",
+                    "currency",
+                    "order_date",
+                    "payload_json",
+                ],
+                rows,
+                wm,
+                chunk_size=8000,
+            )
 
 
 def main():
-    load_customers()
-    load_products()
-    load_sales()
+    full_refresh = ETL_FULL_REFRESH or "--full-refresh" in sys.argv[1:]
+    load_customers(full_refresh)
+    load_products(full_refresh)
+    load_sales(full_refresh)
 
 
 if __name__ == "__main__":
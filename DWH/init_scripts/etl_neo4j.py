@@ -1,9 +1,10 @@
 import json
 import logging
 import os
+import sys
 from datetime import datetime, date
 
-from db_utils import clear_table, executemany_chunks
+from db_utils import ETL_FULL_REFRESH, FETCH_SIZE, Watermark, clear_table, executemany_chunks, load_staging
 from dotenv import load_dotenv
 from neo4j import GraphDatabase
 from neo4j.time import DateTime
@@ -33,56 +34,57 @@ def serialize_neo4j_value(obj):
     return obj
 
 
+NODE_QUERIES = [
+    # Clientes
+    "MATCH (c:Cliente) RETURN labels(c) AS lbls, c.id AS id, properties(c) AS props",
+    # Productos
+    "MATCH (p:Producto) RETURN labels(p) AS lbls, p.id AS id, properties(p) AS props",
+    # Ordenes
+    "MATCH (o:Orden) RETURN labels(o) AS lbls, o.id AS id, properties(o) AS props",
+    # Categorias
+    "MATCH (c:Categoria) RETURN labels(c) AS lbls, c.nombre AS id, properties(c) AS props",
+]
+
+
+def _node_rows(result):
+    for r in result:
+        yield (
+            "NEO4J",
+            ",".join(r["lbls"]),
+            r["id"],
+            json.dumps(serialize_neo4j_value(dict(r["props"]))),
+        )
+
+
+def _edge_rows(result):
+    for r in result:
+        # Validar que from_id y to_id no sean None
+        if r["from_id"] is not None and r["to_id"] is not None:
+            yield (
+                "NEO4J",
+                r["type"],
+                ",".join(r["from_lbls"]),
+                str(r["from_id"]),
+                ",".join(r["to_lbls"]),
+                str(r["to_id"]),
+                json.dumps(serialize_neo4j_value(dict(r["props"]))),
+            )
+
+
 def load_nodes_and_edges():
+    # Nodos y relaciones no tienen una marca monotona confiable: se recargan completos.
     clear_table("staging.neo4j_nodes")
     clear_table("staging.neo4j_edges")
     driver = get_driver()
-    nodes = []
-    edges = []
-    with driver.session() as session:
-        # Clientes
-        result = session.run("MATCH (c:Cliente) RETURN labels(c) AS lbls, c.id AS id, properties(c) AS props")
-        for r in result:
-            nodes.append(
-                (
-                    "NEO4J",
-                    ",".join(r["lbls"]),
-                    r["id"],
-                    json.dumps(serialize_neo4j_value(dict(r["props"]))),
-                )
-            )
-        # Productos
-        result = session.run("MATCH (p:Producto) RETURN labels(p) AS lbls, p.id AS id, properties(p) AS props")
-        for r in result:
-            nodes.append(
-                (
-                    "NEO4J",
-                    ",".join(r["lbls"]),
-                    r["id"],
-                    json.dumps(serialize_neo4j_value(dict(r["props"]))),
-                )
-            )
-        # Ordenes
-        result = session.run("MATCH (o:Orden) RETURN labels(o) AS lbls, o.id AS id, properties(o) AS props")
-        for r in result:
-            nodes.append(
-                (
-                    "NEO4J",
-                    ",".join(r["lbls"]),
-                    r["id"],
-                    json.dumps(serialize_neo4j_value(dict(r["props"]))),
-                )
-            )
-        # Categorias
-        result = session.run("MATCH (c:Categoria) RETURN labels(c) AS lbls, c.nombre AS id, properties(c) AS props")
-        for r in result:
-            nodes.append(
-                (
-                    "NEO4J",
-                    ",".join(r["lbls"]),
-                    r["id"],
-                    json.dumps(serialize_neo4j_value(dict(r["props"]))),
-                )
+    # Cada resultado se consume mientras se inserta: Neo4j entrega registros
+    # por lotes de fetch_size y nunca se materializa el grafo completo.
+    with driver.session(fetch_size=FETCH_SIZE) as session:
+        for query in NODE_QUERIES:
+            executemany_chunks(
+                "staging.neo4j_nodes",
+                ["source_system", "node_label", "node_key", "props_json"],
+                _node_rows(session.run(query)),
+                chunk_size=5000,
             )
         # Relaciones
         result = session.run(
@@ -95,77 +97,61 @@ def load_nodes_and_edges():
                    properties(r) AS props
             """
         )
-        for r in result:
-            # Validar que from_id y to_id no sean None
-            if r["from_id"] is not None and r["to_id"] is not None:
-                edges.append(
-                    (
-                        "NEO4J",
-                        r["type"],
-                        ",".join(r["from_lbls"]),
-                        str(r["from_id"]),
-                        ",".join(r["to_lbls"]),
-                        str(r["to_id"]),
-                        json.dumps(serialize_neo4j_value(dict(r["props"]))),
-                    )
-                )
-
-    executemany_chunks(
-        "staging.neo4j_nodes",
-        ["source_system", "node_label", "node_key", "props_json"],
-        nodes,
-        chunk_size=5000,
-    )
-    executemany_chunks(
-        "staging.neo4j_edges",
-        ["source_system", "edge_type", "from_label", "from_key", "to_label", "to_key", "props_json"],
-        edges,
-        chunk_size=5000,
-    )
+        executemany_chunks(
+            "staging.neo4j_edges",
+            ["source_system", "edge_type", "from_label", "from_key", "to_label", "to_key", "props_json"],
+            _edge_rows(result),
+            chunk_size=5000,
+        )
     driver.close()
 
 
-def load_order_items():
-    clear_table("staging.neo4j_order_items")
+def load_order_items(full_refresh=ETL_FULL_REFRESH):
+    # Watermark por fecha de la orden; se usa >= para no perder ordenes tardias
+    # del mismo dia (el upsert por source_key absorbe las repetidas).
+    wm = Watermark("NEO4J", "staging.neo4j_order_items", "Orden.fecha", full_refresh=full_refresh)
     driver = get_driver()
-    rows = []
-    with driver.session() as session:
+    with driver.session(fetch_size=FETCH_SIZE) as session:
         result = session.run(
             """
             MATCH (c:Cliente)-[:REALIZO]->(o:Orden)-[r:CONTIENE]->(p:Producto)
+            WHERE $since IS NULL OR toString(o.fecha) >= $since
             OPTIONAL MATCH (p)-[:Perteneciente_A|:PERTENECE_A]->(cat:Categoria)
             RETURN o.id AS order_id,
+                   toString(o.fecha) AS fecha_wm,
                    p.id AS product_id,
                    c.id AS customer_id,
                    cat.id AS category_id,
                    r,
                    o,
                    p
-            """
+            """,
+            since=wm.since,
         )
-        for rec in result:
-            rel_props = dict(rec["r"].items()) if rec.get("r") else {}
-            order_node = rec.get("o")
-            qty = rel_props.get("cantidad") or rel_props.get("quantity") or 1
-            price = rel_props.get("precio_unit") or rel_props.get("unit_price")
-            currency = rel_props.get("moneda") or "USD"
-            
-            # Serializar order_date (puede ser DateTime de Neo4j)
-            order_date = None
-            if order_node:
-                fecha = order_node.get("fecha")
-                if fecha:
-                    order_date = serialize_neo4j_value(fecha)
-                    if isinstance(order_date, str):
-                        # Si es string ISO, convertir a date
-                        try:
-                            from datetime import datetime
-                            order_date = datetime.fromisoformat(order_date.replace('Z', '')).date()
-                        except:
-                            order_date = None
-            
-            rows.append(
-                (
+
+        def iter_rows():
+            for rec in wm.track(result, key=lambda rec: rec["fecha_wm"]):
+                rel_props = dict(rec["r"].items()) if rec.get("r") else {}
+                order_node = rec.get("o")
+                qty = rel_props.get("cantidad") or rel_props.get("quantity") or 1
+                price = rel_props.get("precio_unit") or rel_props.get("unit_price")
+                currency = rel_props.get("moneda") or "USD"
+
+                # Serializar order_date (puede ser DateTime de Neo4j)
+                order_date = None
+                if order_node:
+                    fecha = order_node.get("fecha")
+                    if fecha:
+                        order_date = serialize_neo4j_value(fecha)
+                        if isinstance(order_date, str):
+                            # Si es string ISO, convertir a date
+                            try:
+                                from datetime import datetime
+                                order_date = datetime.fromisoformat(order_date.replace('Z', '')).date()
+                            except:
+                                order_date = None
+
+                yield (
                     "NEO4J",
                     f"{rec['order_id']}-{rec['product_id']}",
                     str(rec["order_id"]),
@@ -178,31 +164,33 @@ def load_order_items():
                     order_date,
                     json.dumps(serialize_neo4j_value(rel_props)),
                 )
-            )
-    executemany_chunks(
-        "staging.neo4j_order_items",
-        [
-            "source_system",
-            "source_key",
-            "order_key",
-            "product_key",
-            "customer_key",
-            "category_key",
-            "quantity",
-            "unit_price",
-            "currency",
-            "order_date",
-            "payload_json",
-        ],
-        rows,
-        chunk_size=5000,
-    )
+
+        load_staging(
+            "staging.neo4j_order_items",
+            [
+                "source_system",
+                "source_key",
+                "order_key",
+                "product_key",
+                "customer_key",
+                "category_key",
+                "quantity",
+                "unit_price",
+                "currency",
+                "order_date",
+                "payload_json",
+            ],
+            iter_rows(),
+            wm,
+            chunk_size=5000,
+        )
     driver.close()
 
 
 def main():
+    full_refresh = ETL_FULL_REFRESH or "--full-refresh" in sys.argv[1:]
     load_nodes_and_edges()
-    load_order_items()
+    load_order_items(full_refresh)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 import logging
 import os
-from db_utils import clear_table, executemany_chunks
+import sys
+from db_utils import ETL_FULL_REFRESH, Watermark, clear_table, executemany_chunks, load_staging
 from dotenv import load_dotenv
 from supabase import create_client, Client
 from datetime import datetime
@@ -27,81 +28,75 @@ def get_supabase() -> Client:
     return create_client(url, key)
 
 
-def load_clientes():
-    """Cargar clientes desde Supabase (tabla cliente en español)"""
-    clear_table("staging.supabase_users")
-    supabase = get_supabase()
-    rows = []
-    
-    # Paginación para evitar límites
-    page_size = 1000
+def iter_table(supabase: Client, table: str, page_size: int = 1000, columns: str = "*", since=None):
+    """
+    Recorre una tabla de Supabase por páginas, entregando fila por fila.
+    Las páginas se ordenan por la llave primaria (`<tabla>_id`) para que el
+    paginado sea estable; `since=(columna, valor)` filtra el delta incremental.
+    """
     offset = 0
-    
     while True:
-        response = supabase.table("cliente").select("*").range(offset, offset + page_size - 1).execute()
+        query = supabase.table(table).select(columns)
+        if since is not None:
+            query = query.gte(*since)
+        response = query.order(f"{table}_id").range(offset, offset + page_size - 1).execute()
         if not response.data:
             break
-        
-        for r in response.data:
-            rows.append(
-                (
-                    "SUPABASE",
-                    str(r["cliente_id"]),
-                    r["email"],
-                    r["nombre"],
-                    r.get("genero", ""),
-                    r.get("pais", ""),
-                    parse_dt(r.get("fecha_registro")),
-                    None,
-                )
-            )
-        
+        yield from response.data
         offset += page_size
         if len(response.data) < page_size:
             break
-    
-    executemany_chunks(
+
+
+def load_clientes(full_refresh=ETL_FULL_REFRESH):
+    """Cargar clientes desde Supabase (tabla cliente en español)"""
+    wm = Watermark("SUPABASE", "staging.supabase_users", "cliente.fecha_registro", full_refresh=full_refresh)
+    supabase = get_supabase()
+    since = None if wm.full_refresh else ("fecha_registro", wm.since)
+    rows = (
+        (
+            "SUPABASE",
+            str(r["cliente_id"]),
+            r["email"],
+            r["nombre"],
+            r.get("genero", ""),
+            r.get("pais", ""),
+            parse_dt(r.get("fecha_registro")),
+            None,
+        )
+        for r in wm.track(iter_table(supabase, "cliente", since=since), key=lambda r: r.get("fecha_registro"))
+    )
+
+    load_staging(
         "staging.supabase_users",
         ["source_system", "source_key", "email", "name", "gender", "country", "created_at_src", "payload_json"],
         rows,
+        wm,
         chunk_size=5000,
     )
 
 
-def load_ordenes():
+def load_ordenes(full_refresh=ETL_FULL_REFRESH):
     """Cargar órdenes desde Supabase (tabla orden en español)"""
-    clear_table("staging.supabase_orders")
+    wm = Watermark("SUPABASE", "staging.supabase_orders", "orden.fecha", full_refresh=full_refresh)
     supabase = get_supabase()
-    rows = []
-    
-    page_size = 1000
-    offset = 0
-    
-    while True:
-        response = supabase.table("orden").select("*").range(offset, offset + page_size - 1).execute()
-        if not response.data:
-            break
-        
-        for r in response.data:
-            rows.append(
-                (
-                    "SUPABASE",
-                    str(r["orden_id"]),
-                    str(r["cliente_id"]),
-                    r.get("total", 0),
-                    "COMPLETED",  # status por defecto
-                    r.get("canal", "WEB"),  # payment_method = canal
-                    parse_dt(r.get("fecha")),  # created_at_src
-                    None,  # updated_at_src
-                    None,  # payload_json
-                )
-            )
-        
-        offset += page_size
-        if len(response.data) < page_size:
-            break
-    
-    executemany_chunks(
+    since = None if wm.full_refresh else ("fecha", wm.since)
+    rows = (
+        (
+            "SUPABASE",
+            str(r["orden_id"]),
+            str(r["cliente_id"]),
+            r.get("total", 0),
+            "COMPLETED",  # status por defecto
+            r.get("canal", "WEB"),  # payment_method = canal
+            parse_dt(r.get("fecha")),  # created_at_src
+            None,  # updated_at_src
+            None,  # payload_json
+        )
+        for r in wm.track(iter_table(supabase, "orden", since=since), key=lambda r: r.get("fecha"))
+    )
+
+    load_staging(
         "staging.supabase_orders",
         [
             "source_system",
@@ -115,43 +110,35 @@ def load_ordenes():
             "payload_json",
         ],
         rows,
+        wm,
         chunk_size=5000,
     )
 
 
-def load_order_items():
+def load_order_items(full_refresh=ETL_FULL_REFRESH):
     """Cargar items de órdenes desde Supabase (tabla orden_detalle en español)"""
-    clear_table("staging.supabase_order_items")
+    # orden_detalle no tiene fecha propia: el delta se filtra por la fecha de la orden
+    wm = Watermark("SUPABASE", "staging.supabase_order_items", "orden.fecha", full_refresh=full_refresh)
     supabase = get_supabase()
-    rows = []
-    
-    page_size = 1000
-    offset = 0
-    
-    while True:
-        response = supabase.table("orden_detalle").select("*").range(offset, offset + page_size - 1).execute()
-        if not response.data:
-            break
-        
-        for r in response.data:
-            rows.append(
-                (
-                    "SUPABASE",
-                    str(r["orden_detalle_id"]),
-                    str(r["orden_id"]),
-                    str(r["producto_id"]),
-                    r["cantidad"],
-                    r["precio_unit"],
-                    r["cantidad"] * r["precio_unit"],
-                    None,
-                )
-            )
-        
-        offset += page_size
-        if len(response.data) < page_size:
-            break
-    
-    executemany_chunks(
+    since = None if wm.full_refresh else ("orden.fecha", wm.since)
+    rows = (
+        (
+            "SUPABASE",
+            str(r["orden_detalle_id"]),
+            str(r["orden_id"]),
+            str(r["producto_id"]),
+            r["cantidad"],
+            r["precio_unit"],
+            r["cantidad"] * r["precio_unit"],
+            None,
+        )
+        for r in wm.track(
+            iter_table(supabase, "orden_detalle", columns="*, orden!inner(fecha)", since=since),
+            key=lambda r: (r.get("orden") or {}).get("fecha"),
+        )
+    )
+
+    load_staging(
         "staging.supabase_order_items",
         [
             "source_system",
@@ -164,45 +151,33 @@ def load_order_items():
             "payload_json",
         ],
         rows,
+        wm,
         chunk_size=5000,
     )
 
 
 def load_productos():
     """Cargar productos desde Supabase (tabla producto en español)"""
+    # producto no tiene columna de fecha/versión: se recarga completo en cada corrida
     clear_table("staging.supabase_products")
     supabase = get_supabase()
-    rows = []
-    
-    page_size = 1000
-    offset = 0
-    
-    while True:
-        response = supabase.table("producto").select("*").range(offset, offset + page_size - 1).execute()
-        if not response.data:
-            break
-        
-        for r in response.data:
-            rows.append(
-                (
-                    "SUPABASE",
-                    str(r["producto_id"]),
-                    r["nombre"],
-                    None,  # description
-                    r.get("categoria", ""),
-                    r.get("precio", 0),
-                    None,  # stock
-                    None,  # supplier_id
-                    None,  # active
-                    None,  # created_at_src
-                    None,  # payload_json
-                )
-            )
-        
-        offset += page_size
-        if len(response.data) < page_size:
-            break
-    
+    rows = (
+        (
+            "SUPABASE",
+            str(r["producto_id"]),
+            r["nombre"],
+            None,  # description
+            r.get("categoria", ""),
+            r.get("precio", 0),
+            None,  # stock
+            None,  # supplier_id
+            None,  # active
+            None,  # created_at_src
+            None,  # payload_json
+        )
+        for r in iter_table(supabase, "producto")
+    )
+
     executemany_chunks(
         "staging.supabase_products",
         [
@@ -225,20 +200,17 @@ def load_productos():
 
 def main():
     LOG.info("=== Iniciando ETL Supabase ===")
-    load_clientes()
+    full_refresh = ETL_FULL_REFRESH or "--full-refresh" in sys.argv[1:]
+    load_clientes(full_refresh)
     LOG.info("Clientes cargados")
     load_productos()
     LOG.info("Productos cargados")
-    load_ordenes()
+    load_ordenes(full_refresh)
     LOG.info("Órdenes cargadas")
-    load_order_items()
+    load_order_items(full_refresh)
     LOG.info("Items cargados")
     LOG.info("=== ETL Supabase completado ===")
 
 
 if __name__ == "__main__":
     main()
-
-
-if __name__ == "__main__":
-    main()
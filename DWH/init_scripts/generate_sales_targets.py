@@ -6,7 +6,7 @@ Las metas se calculan como: ventas_mes_anterior * 1.1 (10% de crecimiento).
 
 import logging
 from datetime import datetime
-from db_utils import get_connection
+from db_utils import pooled_connection
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,7 +22,7 @@ def generate_sales_targets():
     logger.info("GENERANDO METAS DE VENTAS")
     logger.info("="*60)
     
-    with get_connection() as conn:
+    with pooled_connection() as conn:
         with conn.cursor() as cur:
             
             # Limpiar tabla de metas
@@ -1,4 +1,4 @@
-from db_utils import get_connection
+from db_utils import pooled_connection
 import logging
 from datetime import datetime
 
@@ -15,7 +15,7 @@ def migrate_to_dwh_schema():
     logger.info("INICIANDO MIGRACIÓN A ESQUEMA dwh")
     logger.info("="*60)
     
-    with get_connection() as conn:
+    with pooled_connection() as conn:
         with conn.cursor() as cur:
             
             # 1. Limpiar tablas dwh (DELETE para evitar issues con FKs)
@@ -0,0 +1,483 @@
+"""
+Motores de minería de itemsets frecuentes para apriori_analysis.
+
+Todos reciben las transacciones (EncodedTransactions o listas de product_ids) y devuelven el mismo
+DataFrame que mlxtend.apriori(use_colnames=True): columnas `support` e
+`itemsets` (frozenset de product_ids). Así association_rules calcula
+exactamente el mismo support/confidence/lift sin importar el motor.
+
+Motores (APRIORI_ENGINE):
+    dense     one-hot denso de mlxtend (comportamiento original; memoria O(transacciones x productos))
+    sparse    apriori de mlxtend sobre una matriz CSR (memoria O(items no cero))
+    fpgrowth  FP-Growth de mlxtend sobre la misma matriz CSR
+    eclat     Eclat nativo con bitsets verticales por producto
+
+Modo particionado (APRIORI_PARTITIONS > 1): algoritmo SON en dos fases sobre un
+pool de procesos. Cualquier motor puede usarse como minero local.
+
+Modo pares (APRIORI_PAIRS_ONLY=1): mine_pair_rules genera directamente las
+reglas 1 -> 1 con un producto de matrices dispersas, sin pasar por itemsets.
+"""
+import logging
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from mlxtend.frequent_patterns import apriori, fpgrowth
+from mlxtend.preprocessing import TransactionEncoder
+from scipy.sparse import csr_matrix
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENGINE = "fpgrowth"
+
+# Margen relativo para umbrales locales (particiones SON, incrementos de
+# apriori incremental): sólo agrega candidatos que luego se descartan con el
+# conteo exacto; evita perder itemsets en el borde por redondeo de punto flotante.
+LOCAL_SUPPORT_SLACK = 1e-9
+
+
+class EncodedTransactions:
+    """
+    Transacciones compactas: los product_ids se remapean a enteros densos
+    (0..k-1) y se guardan contiguos en `items` (array 'i'); la transacción j
+    ocupa items[offsets[j]:offsets[j + 1]]. `product_ids[code]` recupera el id.
+    Cuesta ~4 bytes por item frente a los ~100 de una lista de ints en Python.
+    """
+
+    def __init__(self, product_ids=None):
+        self.items = array("i")
+        self.offsets = array("q", [0])
+        self.product_ids = product_ids if product_ids is not None else []
+        self._codes = {pid: code for code, pid in enumerate(self.product_ids)}
+
+    def add(self, product_ids):
+        """Agrega una transacción (product_ids sin repetir)."""
+        codes = self._codes
+        for pid in product_ids:
+            code = codes.get(pid)
+            if code is None:
+                code = codes[pid] = len(self.product_ids)
+                self.product_ids.append(pid)
+            self.items.append(code)
+        self.offsets.append(len(self.items))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        items, offsets, ids = self.items, self.offsets, self.product_ids
+        for j in range(len(self)):
+            yield [ids[code] for code in items[offsets[j]:offsets[j + 1]]]
+
+    def __getitem__(self, key):
+        """Un slice devuelve otro EncodedTransactions con los mismos códigos (particiones SON)."""
+        if not isinstance(key, slice):
+            raise TypeError("EncodedTransactions sólo admite slices")
+        start, stop, step = key.indices(len(self))
+        if step != 1:
+            raise ValueError("EncodedTransactions sólo admite slices contiguos")
+        stop = max(start, stop)
+        part = EncodedTransactions.__new__(EncodedTransactions)
+        base = self.offsets[start]
+        part.items = self.items[base:self.offsets[stop]]
+        part.offsets = array("q", (o - base for o in self.offsets[start:stop + 1]))
+        part.product_ids = self.product_ids
+        part._codes = None
+        return part
+
+    def __getstate__(self):
+        # Los workers no necesitan el diccionario inverso; sólo se usa al construir
+        return {"items": self.items, "offsets": self.offsets, "product_ids": self.product_ids}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._codes = None
+
+    def nbytes(self):
+        return self.items.itemsize * len(self.items) + self.offsets.itemsize * len(self.offsets)
+
+
+def _encoded_csr(transactions):
+    """CSR directo desde los buffers codificados, columnas ordenadas por product_id."""
+    ids = np.asarray(transactions.product_ids, dtype=np.int64)
+    order = np.argsort(ids, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    indices = rank[np.frombuffer(transactions.items, dtype=np.int32)].astype(np.int32)
+    indptr = np.frombuffer(transactions.offsets, dtype=np.int64)
+    data = np.ones(len(indices), dtype=bool)
+    matrix = csr_matrix((data, indices, indptr.copy()), shape=(len(transactions), len(ids)))
+    matrix.sum_duplicates()
+    return matrix, ids[order]
+
+
+def build_csr(transactions):
+    """
+    Matriz transacciones x productos en formato CSR (booleana) sin pasar por
+    una matriz densa. Devuelve (matriz, product_ids por columna).
+    """
+    if isinstance(transactions, EncodedTransactions):
+        return _encoded_csr(transactions)
+    lengths = np.fromiter((len(t) for t in transactions), dtype=np.int64, count=len(transactions))
+    indptr = np.zeros(len(transactions) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    flat = np.fromiter((item for t in transactions for item in t), dtype=np.int64, count=int(indptr[-1]))
+
+    columns, indices = np.unique(flat, return_inverse=True)
+    data = np.ones(len(indices), dtype=bool)
+    matrix = csr_matrix((data, indices.astype(np.int32), indptr), shape=(len(transactions), len(columns)))
+    matrix.sum_duplicates()
+    return matrix, columns
+
+
+def _sparse_frame(transactions):
+    """
+    DataFrame disperso con columnas posicionales 0..k-1 (mlxtend rechaza nombres
+    enteros dispersos que no empiezan en 0). Devuelve (frame, product_ids por columna).
+    """
+    matrix, columns = build_csr(transactions)
+    logger.info(f"Matriz CSR: {matrix.shape[0]} transacciones x {matrix.shape[1]} productos, {matrix.nnz} items")
+    return pd.DataFrame.sparse.from_spmatrix(matrix), columns.tolist()
+
+
+def _mine_sparse_frame(miner, transactions, min_support, **kwargs):
+    frame, columns = _sparse_frame(transactions)
+    result = miner(frame, min_support=min_support, use_colnames=False, **kwargs)
+    result["itemsets"] = [frozenset(columns[i] for i in itemset) for itemset in result["itemsets"]]
+    return result
+
+
+def mine_dense(transactions, min_support):
+    transactions = list(transactions)
+    te = TransactionEncoder()
+    te_ary = te.fit(transactions).transform(transactions)
+    df_encoded = pd.DataFrame(te_ary, columns=te.columns_)
+    logger.info(f"Matriz transaccional: {df_encoded.shape[0]} transacciones x {df_encoded.shape[1]} productos")
+    return apriori(df_encoded, min_support=min_support, use_colnames=True, low_memory=True)
+
+
+def mine_sparse(transactions, min_support):
+    return _mine_sparse_frame(apriori, transactions, min_support, low_memory=True)
+
+
+def mine_fpgrowth(transactions, min_support):
+    return _mine_sparse_frame(fpgrowth, transactions, min_support)
+
+
+def _tid_bitsets(transactions, csr=None):
+    """Representación vertical: product_id -> (bitset de transacciones como int, conteo)."""
+    matrix, columns = csr if csr is not None else build_csr(transactions)
+    csc = matrix.tocsc()
+    n_bytes = (matrix.shape[0] + 7) // 8
+    bitsets = {}
+    for col, product_id in enumerate(columns.tolist()):
+        rows = csc.indices[csc.indptr[col]:csc.indptr[col + 1]]
+        if not len(rows):
+            continue
+        bits = np.zeros(n_bytes * 8, dtype=bool)
+        bits[rows] = True
+        bitsets[product_id] = (int.from_bytes(np.packbits(bits, bitorder="little").tobytes(), "little"), len(rows))
+    return bitsets
+
+
+def mine_eclat(transactions, min_support):
+    """
+    Eclat: recorrido en profundidad intersectando bitsets de transacciones.
+    El support se calcula igual que mlxtend (conteo / n, comparado con >=).
+    """
+    n = float(len(transactions))
+    frequent = [
+        (product_id, bits, count)
+        for product_id, (bits, count) in sorted(_tid_bitsets(transactions).items())
+        if count / n >= min_support
+    ]
+
+    supports = []
+    itemsets = []
+
+    def extend(prefix, items):
+        for i, (item, bits, count) in enumerate(items):
+            itemset = prefix + (item,)
+            supports.append(count / n)
+            itemsets.append(frozenset(itemset))
+            suffix = []
+            for other, other_bits, _ in items[i + 1:]:
+                inter = bits & other_bits
+                inter_count = inter.bit_count()
+                if inter_count / n >= min_support:
+                    suffix.append((other, inter, inter_count))
+            if suffix:
+                extend(itemset, suffix)
+
+    extend((), frequent)
+    return pd.DataFrame({"support": supports, "itemsets": itemsets})
+
+
+ENGINES = {
+    "dense": mine_dense,
+    "sparse": mine_sparse,
+    "fpgrowth": mine_fpgrowth,
+    "eclat": mine_eclat,
+}
+
+
+def _split(transactions, partitions):
+    """Particiones contiguas de tamaño similar (ninguna vacía)."""
+    size = -(-len(transactions) // partitions)
+    return [transactions[i:i + size] for i in range(0, len(transactions), size)]
+
+
+def _son_local(args):
+    """Fase 1 (worker): itemsets frecuentes locales de una partición."""
+    chunk, min_support, engine = args
+    local = ENGINES[engine](chunk, min_support * (1 - LOCAL_SUPPORT_SLACK))
+    return set(local["itemsets"])
+
+
+def item_counts(transactions):
+    """{product_id: número de transacciones que lo contienen} (sólo productos presentes)."""
+    matrix, columns = build_csr(transactions)
+    counts = np.asarray(matrix.astype(np.int32).sum(axis=0)).ravel()
+    return {pid: int(c) for pid, c in zip(columns.tolist(), counts.tolist()) if c}
+
+
+def count_itemsets(transactions, itemsets):
+    """
+    Conteo exacto (número de transacciones) de cada itemset, en el orden recibido.
+    Tamaño 1: suma de columnas; tamaño 2: producto disperso X^T X; mayores: bitsets.
+    """
+    matrix, columns = build_csr(transactions)
+    col_of = {pid: j for j, pid in enumerate(columns.tolist())}
+    counts = np.zeros(len(itemsets), dtype=np.int64)
+    col_counts = None
+    pairs, larger = [], []
+    for i, itemset in enumerate(itemsets):
+        cols = [col_of.get(item) for item in itemset]
+        if None in cols:
+            continue
+        if len(cols) == 1:
+            if col_counts is None:
+                col_counts = np.asarray(matrix.astype(np.int32).sum(axis=0)).ravel()
+            counts[i] = col_counts[cols[0]]
+        elif len(cols) == 2:
+            pairs.append((i, cols[0], cols[1]))
+        else:
+            larger.append(i)
+
+    if pairs:
+        idx, a, b = (np.array(v, dtype=np.int64) for v in zip(*pairs))
+        used, inverse = np.unique(np.concatenate([a, b]), return_inverse=True)
+        sub = matrix[:, used].astype(np.int32)
+        gram = (sub.T @ sub).tocsr()
+        counts[idx] = np.asarray(gram[inverse[:len(a)], inverse[len(a):]]).ravel()
+
+    if larger:
+        bitsets = _tid_bitsets(transactions, (matrix, columns))
+        for i in larger:
+            bits = None
+            for item in itemsets[i]:
+                item_bits = bitsets.get(item, (0, 0))[0]
+                bits = item_bits if bits is None else bits & item_bits
+            counts[i] = bits.bit_count()
+    return counts
+
+
+def _son_count(args):
+    """Fase 2 (worker): conteo exacto de cada candidato en una partición."""
+    chunk, candidates = args
+    return count_itemsets(chunk, candidates)
+
+
+def mine_son(transactions, min_support, engine=DEFAULT_ENGINE, partitions=None, max_workers=None):
+    """
+    SON (Savasere, Omiecinski, Navathe) en dos pasadas paralelas:
+      1. cada partición se mina con el mismo support relativo; la unión de los
+         itemsets locales contiene todo itemset globalmente frecuente.
+      2. se cuentan los candidatos en todas las particiones y se conservan los
+         que cumplen conteo / n >= min_support, igual que el motor serial.
+    """
+    partitions = partitions or os.cpu_count() or 1
+    chunks = _split(transactions, partitions)
+    n = float(len(transactions))
+    logger.info(f"SON: {len(chunks)} particiones, motor local {engine}, workers={max_workers or os.cpu_count()}")
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        candidates = set()
+        for local in pool.map(_son_local, [(chunk, min_support, engine) for chunk in chunks]):
+            candidates |= local
+        candidates = sorted(candidates, key=lambda s: (len(s), sorted(s)))
+        logger.info(f"SON fase 1: {len(candidates)} itemsets candidatos")
+
+        counts = np.zeros(len(candidates), dtype=np.int64)
+        for partial in pool.map(_son_count, [(chunk, candidates) for chunk in chunks]):
+            counts += partial
+
+    supports = counts / n
+    keep = supports >= min_support
+    logger.info(f"SON fase 2: {int(keep.sum())} itemsets frecuentes globales")
+    return pd.DataFrame({
+        "support": supports[keep],
+        "itemsets": [itemset for itemset, k in zip(candidates, keep) if k],
+    })
+
+
+def itemset_counts(frequent_itemsets, n):
+    """{itemset: conteo} a partir de un DataFrame(support, itemsets) minado sobre n transacciones."""
+    counts = np.rint(frequent_itemsets["support"].to_numpy() * n).astype(np.int64)
+    return dict(zip(frequent_itemsets["itemsets"], counts.tolist()))
+
+
+def frequent_from_counts(counts, n, min_support):
+    """DataFrame(support, itemsets) de los itemsets con conteo / n >= min_support."""
+    itemsets = [s for s, c in counts.items() if c / float(n) >= min_support]
+    return pd.DataFrame({
+        "support": [counts[s] / float(n) for s in itemsets],
+        "itemsets": itemsets,
+    })
+
+
+def negative_border(frequent, items):
+    """
+    Borde negativo: itemsets infrecuentes cuyos subconjuntos propios son todos
+    frecuentes (productos sueltos infrecuentes + candidatos apriori-gen que no
+    resultaron frecuentes).
+    """
+    border = {frozenset([item]) for item in items if frozenset([item]) not in frequent}
+    levels = {}
+    for itemset in frequent:
+        levels.setdefault(len(itemset), []).append(tuple(sorted(itemset)))
+    for k, level in levels.items():
+        by_prefix = {}
+        for itemset in level:
+            by_prefix.setdefault(itemset[:-1], []).append(itemset[-1])
+        for prefix, tails in by_prefix.items():
+            tails.sort()
+            for i, a in enumerate(tails):
+                for b in tails[i + 1:]:
+                    candidate = prefix + (a, b)
+                    cset = frozenset(candidate)
+                    if cset in frequent:
+                        continue
+                    if all(frozenset(candidate[:j] + candidate[j + 1:]) in frequent for j in range(k - 1)):
+                        border.add(cset)
+    return border
+
+
+def build_itemset_state(transactions, frequent_itemsets):
+    """
+    Estado para mantenimiento incremental tras un minado completo:
+    conteos de los itemsets frecuentes y de su borde negativo.
+    Devuelve (counts, border).
+    """
+    n = len(transactions)
+    counts = itemset_counts(frequent_itemsets, n)
+    border = negative_border(set(counts), item_counts(transactions))
+    border_list = list(border)
+    counts.update(zip(border_list, count_itemsets(transactions, border_list).tolist()))
+    logger.info(f"Estado incremental: {len(counts) - len(border)} frecuentes, {len(border)} en el borde negativo")
+    return counts, border
+
+
+def update_itemset_counts(counts, border, n, delta, min_support):
+    """
+    Mantenimiento incremental con borde negativo (Thomas et al.): suma a
+    `counts` (frecuentes + borde, conteos sobre n transacciones) los conteos en
+    `delta`. Todo itemset fuera de `counts` contiene uno del borde, así que
+    mientras ningún itemset del borde se vuelva frecuente los frecuentes nuevos
+    son exactamente los de `counts` con conteo / n' >= min_support.
+
+    Devuelve (counts, border, n') o None si el borde cambió (requiere minado completo).
+    Los productos que aparecen por primera vez entran al borde con conteo 0.
+    """
+    counts = dict(counts)
+    border = set(border)
+    for item in item_counts(delta):
+        single = frozenset([item])
+        if single not in counts:
+            counts[single] = 0
+            border.add(single)
+
+    itemsets = list(counts)
+    delta_counts = count_itemsets(delta, itemsets)
+    n_total = n + len(delta)
+    for itemset, c in zip(itemsets, delta_counts.tolist()):
+        counts[itemset] += c
+
+    promoted = [s for s in border if counts[s] / float(n_total) >= min_support]
+    if promoted:
+        logger.info(f"Incremental: {len(promoted)} itemsets del borde negativo ahora son frecuentes, cambió el borde")
+        return None
+    logger.info(f"Incremental: {len(itemsets)} itemsets actualizados con {len(delta)} transacciones nuevas")
+    return counts, border, n_total
+
+
+def mine_pair_rules(transactions, min_support, min_confidence=0.0, min_lift=0.0, top_k=0):
+    """
+    Ruta rápida sólo para reglas 1 -> 1: co-ocurrencias producto x producto con
+    un único producto disperso X^T X sobre los productos frecuentes; support,
+    confidence y lift vectorizados (mismas fórmulas que association_rules).
+    top_k > 0 conserva por antecedente sólo las k mejores (lift, luego confidence).
+    Devuelve un DataFrame con las columnas de association_rules que usa el resto
+    del pipeline: antecedents, consequents, antecedent support, consequent
+    support, support, confidence, lift.
+    """
+    matrix, columns = build_csr(transactions)
+    n = float(matrix.shape[0])
+    item_count = np.asarray(matrix.astype(np.int32).sum(axis=0)).ravel()
+    item_support = item_count / n
+    frequent = np.flatnonzero(item_support >= min_support)
+    logger.info(f"Pares: {len(frequent)} productos frecuentes de {len(columns)}")
+
+    sub = matrix[:, frequent].astype(np.int32)
+    gram = (sub.T @ sub).tocoo()
+    off_diagonal = gram.row != gram.col
+    a, c, count = gram.row[off_diagonal], gram.col[off_diagonal], gram.data[off_diagonal]
+
+    support = count / n
+    keep = support >= min_support
+    a, c, support = a[keep], c[keep], support[keep]
+    antecedent_support = item_support[frequent][a]
+    consequent_support = item_support[frequent][c]
+    confidence = support / antecedent_support
+    lift = confidence / consequent_support
+
+    keep = (confidence >= min_confidence) & (lift >= min_lift)
+    a, c = a[keep], c[keep]
+    support, confidence, lift = support[keep], confidence[keep], lift[keep]
+    antecedent_support, consequent_support = antecedent_support[keep], consequent_support[keep]
+
+    # Orden por antecedente y luego lift/confidence descendentes; rank dentro de cada antecedente
+    order = np.lexsort((-confidence, -lift, a))
+    if top_k and len(order):
+        a_sorted = a[order]
+        group_start = np.r_[0, np.flatnonzero(np.diff(a_sorted)) + 1]
+        starts = np.repeat(group_start, np.diff(np.r_[group_start, len(a_sorted)]))
+        order = order[np.arange(len(order)) - starts < top_k]
+
+    ids = columns[frequent]
+    logger.info(f"Pares: {len(order)} reglas 1 -> 1")
+    return pd.DataFrame({
+        "antecedents": [frozenset([pid]) for pid in ids[a[order]].tolist()],
+        "consequents": [frozenset([pid]) for pid in ids[c[order]].tolist()],
+        "antecedent support": antecedent_support[order],
+        "consequent support": consequent_support[order],
+        "support": support[order],
+        "confidence": confidence[order],
+        "lift": lift[order],
+    })
+
+
+def mine_frequent_itemsets(transactions, min_support, engine=DEFAULT_ENGINE, partitions=1, max_workers=None):
+    """
+    Ejecuta el motor configurado y devuelve DataFrame(support, itemsets).
+    Con partitions > 1 usa SON con `engine` como minero local.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"APRIORI_ENGINE desconocido: {engine} (opciones: {', '.join(ENGINES)})")
+    if partitions > 1 and len(transactions) >= partitions:
+        return mine_son(transactions, min_support, engine, partitions, max_workers)
+    logger.info(f"Motor de minería: {engine}")
+    return ENGINES[engine](transactions, min_support)
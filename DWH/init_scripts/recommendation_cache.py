@@ -0,0 +1,217 @@
+"""
+Caché precalculada de recomendaciones (top-N por producto).
+
+apriori_analysis la regenera al publicar cada versión de reglas (RuleSetId):
+para cada producto guarda sus N mejores consecuentes (lift, luego confidence)
+en un .npy estructurado que se abre con mmap. `recommend()` responde desde
+ese archivo con un LRU en proceso, sin consultar SQL Server; cuando cambia la
+versión publicada (archivo CURRENT) se recarga el mapa y se vacía el LRU.
+
+Uso:
+    from recommendation_cache import recommend
+    recommend([5689, 5737], n=10)  # -> ((product_id, lift, confidence), ...)
+"""
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RECO_CACHE_DIR = Path(os.getenv("RECO_CACHE_DIR", "/app/logs/recommendations"))
+RECO_TOP_N = int(os.getenv("RECO_TOP_N", "20"))
+RECO_LRU_SIZE = int(os.getenv("RECO_LRU_SIZE", "4096"))
+RECO_VERSION_CHECK = float(os.getenv("RECO_VERSION_CHECK", "5"))  # segundos entre revisiones de CURRENT
+
+VERSION_FILE = "CURRENT"
+RECO_DTYPE = np.dtype([
+    ("product_id", np.int64),
+    ("rec_id", np.int64),
+    ("lift", np.float32),
+    ("confidence", np.float32),
+])
+
+
+def build_top_n(rules, n=RECO_TOP_N):
+    """
+    Mapa producto -> top-N consecuentes a partir del DataFrame de reglas
+    (antecedents, consequents, lift, confidence). Un producto recomienda los
+    consecuentes de toda regla cuyo antecedente lo contiene (misma semántica
+    que sp_get_product_recommendations); si un consecuente aparece en varias
+    reglas se conserva la mejor.
+    """
+    best = {}
+    for antecedents, consequents, lift, confidence in zip(
+        rules["antecedents"], rules["consequents"], rules["lift"], rules["confidence"]
+    ):
+        score = (float(lift), float(confidence))
+        for product_id in antecedents:
+            candidates = best.setdefault(product_id, {})
+            for rec_id in consequents:
+                if rec_id != product_id and score > candidates.get(rec_id, (0.0, 0.0)):
+                    candidates[rec_id] = score
+
+    records = []
+    for product_id in sorted(best):
+        ranked = sorted(best[product_id].items(), key=lambda kv: (-kv[1][0], -kv[1][1], kv[0]))[:n]
+        records.extend((product_id, rec_id, lift, confidence) for rec_id, (lift, confidence) in ranked)
+    return np.array(records, dtype=RECO_DTYPE)
+
+
+def _map_path(version, cache_dir=RECO_CACHE_DIR):
+    return Path(cache_dir) / f"recommendations_{version}.npy"
+
+
+def write_top_n(records, version, cache_dir=RECO_CACHE_DIR):
+    """
+    Escribe el mapa de la versión y luego mueve CURRENT (os.replace, atómico).
+    Los lectores nunca ven un archivo a medio escribir. Conserva el mapa de la
+    versión reemplazada (un lector puede haber leído el CURRENT anterior justo
+    antes del cambio) y borra los más viejos.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    path = _map_path(version, cache_dir)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as fh:
+        np.save(fh, records)
+    os.replace(tmp, path)
+
+    try:
+        previous = (cache_dir / VERSION_FILE).read_text().strip()
+    except FileNotFoundError:
+        previous = None
+    keep = {path, _map_path(previous, cache_dir)} if previous else {path}
+
+    tmp_version = cache_dir / f"{VERSION_FILE}.tmp"
+    tmp_version.write_text(str(version))
+    os.replace(tmp_version, cache_dir / VERSION_FILE)
+
+    for old in cache_dir.glob("recommendations_*.npy"):
+        if old not in keep:
+            try:
+                old.unlink()
+            except OSError as e:
+                logger.warning(f"No se pudo borrar {old}: {e}")
+    logger.info(f"Caché de recomendaciones v{version}: {len(records)} entradas en {path}")
+    return path
+
+
+def publish_recommendations(rules, version, n=RECO_TOP_N, cache_dir=RECO_CACHE_DIR):
+    """Construye y publica el top-N de una versión de reglas."""
+    return write_top_n(build_top_n(rules, n), version, cache_dir)
+
+
+class _Snapshot:
+    """Mapa de una versión (registros + llaves). En la llave del LRU cuenta solo la versión."""
+
+    __slots__ = ("version", "records", "keys")
+
+    def __init__(self, version, records):
+        self.version = version
+        self.records = records
+        self.keys = records["product_id"]
+
+    def __hash__(self):
+        return hash(self.version)
+
+    def __eq__(self, other):
+        return isinstance(other, _Snapshot) and self.version == other.version
+
+
+class RecommendationCache:
+    """Lector del mapa mmap con LRU por carrito, invalidado por versión."""
+
+    def __init__(self, cache_dir=RECO_CACHE_DIR, lru_size=RECO_LRU_SIZE, version_check=RECO_VERSION_CHECK):
+        self.cache_dir = Path(cache_dir)
+        self.version_check = version_check
+        # Versión, registros y llaves se reemplazan juntos: un lector nunca mezcla
+        # el mapa de una versión con las llaves de otra
+        self._snapshot = _Snapshot(None, np.empty(0, dtype=RECO_DTYPE))
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._cached = lru_cache(maxsize=lru_size)(self._merge)
+
+    def _current_version(self):
+        try:
+            return (self.cache_dir / VERSION_FILE).read_text().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _load(self, version):
+        if version is None:
+            return np.empty(0, dtype=RECO_DTYPE)
+        return np.load(_map_path(version, self.cache_dir), mmap_mode="r")
+
+    def refresh(self, force=False):
+        """Recarga el mapa si cambió CURRENT (a lo sumo cada version_check segundos)."""
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.version_check:
+            return
+        with self._lock:
+            self._checked_at = now
+            version = self._current_version()
+            if version == self.version:
+                return
+            try:
+                records = self._load(version)
+            except FileNotFoundError:
+                # El mapa se borró entre leer CURRENT y abrirlo: se relee una vez
+                version = self._current_version()
+                if version == self.version:
+                    return
+                records = self._load(version)
+            self._snapshot = _Snapshot(version, records)
+            self._cached.cache_clear()
+            logger.info(f"Caché de recomendaciones cargada: versión {version}, {len(records)} entradas")
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def for_product(self, product_id, snapshot=None):
+        """Top-N precalculado de un producto (vista sobre el mmap)."""
+        snapshot = snapshot or self._snapshot
+        lo = np.searchsorted(snapshot.keys, product_id, side="left")
+        hi = np.searchsorted(snapshot.keys, product_id, side="right")
+        return snapshot.records[lo:hi]
+
+    def _merge(self, snapshot, cart, n):
+        # El snapshot es parte de la llave: un merge que corre durante un refresh
+        # queda guardado bajo la versión vieja y no se sirve para la nueva
+        candidates = {}
+        for product_id in cart:
+            for rec_id, lift, confidence in self.for_product(product_id, snapshot)[["rec_id", "lift", "confidence"]].tolist():
+                if rec_id in cart:
+                    continue
+                score = (lift, confidence)
+                if score > candidates.get(rec_id, (0.0, 0.0)):
+                    candidates[rec_id] = score
+        ranked = sorted(candidates.items(), key=lambda kv: (-kv[1][0], -kv[1][1], kv[0]))[:n]
+        return tuple((rec_id, lift, confidence) for rec_id, (lift, confidence) in ranked)
+
+    def recommend(self, product_ids, n=10):
+        """
+        Recomendaciones para un producto o carrito: une los top-N de cada
+        producto, excluye lo que ya está en el carrito y ordena por lift y
+        confidence. Devuelve ((product_id, lift, confidence), ...).
+        """
+        self.refresh()
+        if isinstance(product_ids, (int, np.integer)):
+            product_ids = (product_ids,)
+        return self._cached(self._snapshot, frozenset(int(p) for p in product_ids), n)
+
+
+_DEFAULT_CACHE = None
+
+
+def recommend(product_ids, n=10):
+    """API de módulo sobre una RecommendationCache compartida."""
+    global _DEFAULT_CACHE
+    if _DEFAULT_CACHE is None:
+        _DEFAULT_CACHE = RecommendationCache()
+    return _DEFAULT_CACHE.recommend(product_ids, n)
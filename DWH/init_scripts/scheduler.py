@@ -11,6 +11,7 @@ import logging
 from datetime import datetime
 from pathlib import Path
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from db_utils import execute_sp
 
 # Configure logging
@@ -39,6 +40,14 @@ ETL_SCRIPTS = [
 # Stored procedure maestro (ejecutado via sqlcmd/pymssql)
 PROMOTE_SP = "sp_etl_run_all"
 
+# Extracción en paralelo: cada fuente es un sistema distinto, así que los ETLs
+# pueden correr a la vez (ETL_PARALLEL=0 vuelve al modo secuencial)
+ETL_PARALLEL = os.getenv("ETL_PARALLEL", "1") != "0"
+ETL_MAX_WORKERS = int(os.getenv("ETL_MAX_WORKERS", str(len(ETL_SCRIPTS))))
+ETL_TIMEOUT = int(os.getenv("ETL_TIMEOUT", "600"))
+# Apriori: APRIORI_PARTITIONS/APRIORI_WORKERS se heredan por el proceso hijo
+APRIORI_TIMEOUT = int(os.getenv("APRIORI_TIMEOUT", "1800"))
+
 
 def job_exchange_rate():
     """Execute the BCCR exchange rate update"""
@@ -65,16 +74,16 @@ def job_exchange_rate():
         logger.error(f"Unexpected error during update: {str(e)}")
 
 
-def job_apriori():
-    """Execute the Apriori association rules analysis"""
-    logger.info("Starting scheduled Apriori analysis...")
+def job_apriori(mode='run'):
+    """Execute the Apriori association rules analysis ('run' = full re-mine, 'incremental' = fold in new orders)"""
+    logger.info(f"Starting scheduled Apriori analysis ({mode})...")
     try:
         result = subprocess.run(
-            [sys.executable, str(APRIORI_SCRIPT), 'run'],
+            [sys.executable, str(APRIORI_SCRIPT), mode],
             cwd=str(SCRIPT_DIR),
             capture_output=True,
             text=True,
-            timeout=1800  # 30 minutes timeout for large datasets
+            timeout=APRIORI_TIMEOUT
         )
         
         if result.returncode == 0:
@@ -85,59 +94,141 @@ def job_apriori():
             logger.error(f"Error: {result.stderr}")
             
     except subprocess.TimeoutExpired:
-        logger.error("Apriori analysis timed out (exceeded 30 minutes)")
+        logger.error(f"Apriori analysis timed out (exceeded {APRIORI_TIMEOUT}s)")
     except Exception as e:
         logger.error(f"Unexpected error during Apriori analysis: {str(e)}")
 
 
-def run_etl_scripts_once():
-    """Run all ETL scripts (extract->landing->staging) before scheduler loop."""
-    for script in ETL_SCRIPTS:
-        if not script.exists():
-            logger.warning(f"ETL script not found, skipping: {script}")
-            continue
-        logger.info(f"Running ETL script: {script.name}")
-        result = subprocess.run(
+def run_etl_script(script):
+    """Run one ETL script in its own process. Returns a result dict (never raises)."""
+    started = time.monotonic()
+    result = {"script": script.name, "ok": False, "returncode": None, "seconds": 0.0, "error": ""}
+    try:
+        proc = subprocess.run(
             [sys.executable, str(script)],
             cwd=str(SCRIPT_DIR),
             capture_output=True,
             text=True,
-            timeout=600
+            timeout=ETL_TIMEOUT
         )
-        if result.returncode == 0:
-            logger.info(f"ETL {script.name} completed")
-            if result.stdout:
-                logger.debug(result.stdout)
-        else:
-            logger.error(f"ETL {script.name} failed with code {result.returncode}")
-            logger.error(result.stderr)
+        result["returncode"] = proc.returncode
+        result["ok"] = proc.returncode == 0
+        result["error"] = proc.stderr if proc.returncode != 0 else ""
+        if proc.stdout:
+            logger.debug(proc.stdout)
+    except subprocess.TimeoutExpired:
+        result["error"] = f"timed out (exceeded {ETL_TIMEOUT}s)"
+    except Exception as e:
+        result["error"] = str(e)
+    result["seconds"] = time.monotonic() - started
+    return result
+
+
+def _log_etl_result(result):
+    if result["ok"]:
+        logger.info(f"ETL {result['script']} completed in {result['seconds']:.1f}s")
+    else:
+        logger.error(f"ETL {result['script']} failed (code {result['returncode']}) after {result['seconds']:.1f}s")
+        logger.error(result["error"])
+
 
-    # Ejecutar SP maestro de promoción (si existe)
+def _existing_etl_scripts():
+    scripts = []
+    for script in ETL_SCRIPTS:
+        if not script.exists():
+            logger.warning(f"ETL script not found, skipping: {script}")
+            continue
+        scripts.append(script)
+    return scripts
+
+
+def run_etl_scripts_parallel(max_workers=None):
+    """
+    Run the extract ETLs concurrently (bounded by max_workers).
+    Returns the list of per-source results; promotion is left to the caller.
+    """
+    scripts = _existing_etl_scripts()
+    max_workers = max(1, min(max_workers or ETL_MAX_WORKERS, len(scripts) or 1))
+    logger.info(f"Running {len(scripts)} ETL scripts in parallel (max_workers={max_workers})")
+
+    started = time.monotonic()
+    results = []
+    # Threads solo esperan a los subprocesos; el trabajo real ocurre en cada proceso hijo
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="etl") as pool:
+        futures = {pool.submit(run_etl_script, script): script for script in scripts}
+        for future in as_completed(futures):
+            result = future.result()
+            _log_etl_result(result)
+            results.append(result)
+    elapsed = time.monotonic() - started
+
+    logger.info("ETL summary:")
+    for result in sorted(results, key=lambda r: r["script"]):
+        status = "OK" if result["ok"] else "FAILED"
+        logger.info(f"  - {result['script']:<20} {status:<7} {result['seconds']:>7.1f}s")
+    logger.info(f"  Wall clock: {elapsed:.1f}s")
+    return results
+
+
+def _promote_staging():
+    """Ejecutar SP maestro de promoción. Returns True if it succeeded."""
     try:
-        logger.info("Executing promotion stored procedure sp_etl_run_all...")
-        execute_sp("sp_etl_run_all")
-        logger.info("sp_etl_run_all executed successfully")
+        logger.info(f"Executing promotion stored procedure {PROMOTE_SP}...")
+        execute_sp(PROMOTE_SP)
+        logger.info(f"{PROMOTE_SP} executed successfully")
+        return True
     except Exception as e:
-        logger.error(f"Error executing sp_etl_run_all: {e}")
+        logger.error(f"Error executing {PROMOTE_SP}: {e}")
+        return False
+
+
+def run_etl_scripts_once():
+    """
+    Run all ETL scripts (extract->landing->staging) and promote with
+    sp_etl_run_all only if every extract succeeded, in both modes.
+    Returns (per-source results, whether the promotion succeeded).
+    """
+    if ETL_PARALLEL:
+        results = run_etl_scripts_parallel()
+    else:
+        results = []
+        for script in _existing_etl_scripts():
+            logger.info(f"Running ETL script: {script.name}")
+            result = run_etl_script(script)
+            _log_etl_result(result)
+            results.append(result)
+
+    failed = [r["script"] for r in results if not r["ok"]]
+    if failed:
+        logger.error(f"Skipping {PROMOTE_SP}: failed extracts: {', '.join(failed)}")
+        return results, False
+
+    return results, _promote_staging()
 
 
 def main():
     """Main scheduler loop"""
+    if len(sys.argv) > 1 and sys.argv[1] == "run-etl":
+        results, promoted = run_etl_scripts_once()
+        sys.exit(0 if promoted and all(r["ok"] for r in results) else 1)
+
     logger.info("=" * 80)
     logger.info("SCHEDULER INICIADO - DWH Automation")
     logger.info("=" * 80)
     logger.info("Schedule:")
     logger.info("  - BCCR Exchange Rate: Daily at 5:00 AM")
     logger.info("  - Apriori Analysis: Weekly on Sundays at 2:00 AM")
+    logger.info("  - Apriori Incremental: Daily at 3:00 AM (new orders only)")
     logger.info("NOTE: ETLs must be run manually. Scheduler only handles BCCR & Apriori.")
     logger.info("=" * 80)
 
     # NO ejecutar ETLs al inicio - la base debe estar limpia
-    # Poblar datos históricos de BCCR (3 años) una sola vez al inicio
+    # Completar datos históricos de BCCR (3 años) al inicio: solo se piden los
+    # días hábiles que faltan, así que un reinicio con la tabla completa no consulta al BCCR
     try:
-        logger.info("Populating historical BCCR exchange rates (3 years)...")
+        logger.info("Syncing missing BCCR exchange rates (last 3 years)...")
         result = subprocess.run(
-            [sys.executable, str(BCCR_SCRIPT), 'populate'],
+            [sys.executable, str(BCCR_SCRIPT), 'sync'],
             cwd=str(SCRIPT_DIR),
             capture_output=True,
             text=True,
@@ -158,6 +249,7 @@ def main():
     # Schedule jobs
     schedule.every().day.at("05:00").do(job_exchange_rate)
     schedule.every().sunday.at("02:00").do(job_apriori)
+    schedule.every().day.at("03:00").do(job_apriori, 'incremental')
     
     logger.info("\n✓ Scheduler configured and running...")
     logger.info("Waiting for scheduled tasks...\n")
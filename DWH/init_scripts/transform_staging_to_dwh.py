@@ -1,6 +1,8 @@
-from db_utils import get_connection
+from db_utils import ETL_FULL_REFRESH, pooled_connection
 import logging
-from datetime import datetime, timedelta
+import os
+import sys
+from datetime import datetime
 
 logging.basicConfig(
     level=logging.INFO,
@@ -8,14 +10,69 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def transform_staging_to_dwh():
+# incremental: MERGE de dimensiones + solo hechos nuevos/cambiados
+# full: vacía dwh.* y reconstruye desde staging
+TRANSFORM_MODE = os.getenv("TRANSFORM_MODE", "incremental")
+
+
+def begin_batch(cur, full_refresh):
+    """
+    Abre una corrida en dwh.EtlBatch y devuelve (batch_id, corte).
+
+    Las corridas que quedaron en RUNNING (fallaron a medias) se descartan
+    junto con sus hechos, por lo que re-ejecutar no duplica filas. El corte
+    es el inicio de la última corrida exitosa; None => modo completo.
+    """
+    cur.execute("""
+        DELETE FROM dwh.FactSales
+        WHERE etlBatchId IN (SELECT id FROM dwh.EtlBatch WHERE status = 'RUNNING')
+    """)
+    if cur.rowcount:
+        logger.warning(f"⚠️  {cur.rowcount:,} hechos de corridas incompletas descartados")
+    cur.execute("UPDATE dwh.EtlBatch SET status = 'DISCARDED', finishedAt = GETDATE() WHERE status = 'RUNNING'")
+
+    cutoff = None
+    if not full_refresh:
+        cur.execute("SELECT MAX(startedAt) FROM dwh.EtlBatch WHERE status = 'OK'")
+        cutoff = cur.fetchone()[0]
+        if cutoff is None:
+            logger.info("   Sin corridas previas exitosas: se hará carga completa")
+
+    mode = 'full' if cutoff is None else 'incremental'
+    cur.execute("INSERT INTO dwh.EtlBatch (mode) OUTPUT INSERTED.id VALUES (%s)", (mode,))
+    batch_id = cur.fetchone()[0]
+    return batch_id, cutoff
+
+
+def finish_batch(cur, batch_id, rows_inserted):
+    cur.execute("""
+        UPDATE dwh.EtlBatch
+        SET status = 'OK', finishedAt = GETDATE(), rowsInserted = %s
+        WHERE id = %s
+    """, (rows_inserted, batch_id))
+
+
+def delete_changed_facts(cur, changed_sql, params):
+    """Elimina la versión previa de los hechos cuya línea de staging cambió desde el corte."""
+    cur.execute(f"""
+        DELETE f
+        FROM dwh.FactSales f
+        INNER JOIN ({changed_sql}) chg
+            ON chg.source_system = f.source_system AND chg.source_key = f.source_key
+    """, params)
+    return cur.rowcount
+
+
+def transform_staging_to_dwh(full_refresh=None):
     """Transform Layer: staging → dwh"""
-    
+    if full_refresh is None:
+        full_refresh = ETL_FULL_REFRESH or TRANSFORM_MODE == "full"
+
     logger.info("="*60)
     logger.info("TRANSFORM LAYER: staging → dwh")
     logger.info("="*60)
     
-    with get_connection() as conn:
+    with pooled_connection() as conn:
         with conn.cursor() as cur:
             
             # VALIDACIÓN: Verificar que hay datos en staging
@@ -56,17 +113,22 @@ def transform_staging_to_dwh():
             logger.info("✓ Staging contiene datos, continuando...")
             logger.info("  (Las fuentes sin datos serán omitidas automáticamente)\n")
             
-            # 1. Limpiar dwh.* (en orden correcto por FKs)
-            logger.info("\n🗑️  Limpiando dwh.*...")
-            cur.execute("DELETE FROM dwh.FactSales")
-            cur.execute("DELETE FROM dwh.DimOrder")
-            cur.execute("DELETE FROM dwh.DimTime")
-            cur.execute("DELETE FROM dwh.DimProduct")
-            cur.execute("DELETE FROM dwh.DimCategory")
-            cur.execute("DELETE FROM dwh.DimCustomer")
-            cur.execute("DELETE FROM dwh.DimChannel")
+            # 1. Abrir corrida; en modo completo limpiar dwh.* (en orden correcto por FKs)
+            batch_id, cutoff = begin_batch(cur, full_refresh)
+            params = {"batch": batch_id, "cutoff": cutoff}
+            if cutoff is None:
+                logger.info(f"\n🗑️  Corrida #{batch_id} (completa): limpiando dwh.*...")
+                cur.execute("DELETE FROM dwh.FactSales")
+                cur.execute("DELETE FROM dwh.DimOrder")
+                cur.execute("DELETE FROM dwh.DimTime")
+                cur.execute("DELETE FROM dwh.DimProduct")
+                cur.execute("DELETE FROM dwh.DimCategory")
+                cur.execute("DELETE FROM dwh.DimCustomer")
+                cur.execute("DELETE FROM dwh.DimChannel")
+                logger.info("✓ Limpiado")
+            else:
+                logger.info(f"\n🔁 Corrida #{batch_id} (incremental): cambios en staging desde {cutoff}")
             conn.commit()
-            logger.info("✓ Limpiado")
             
             # 2. DimExchangeRate - promover desde staging.tipo_cambio
             logger.info("\n💱 Promoviendo staging.tipo_cambio → dwh.DimExchangeRate...")
@@ -86,7 +148,8 @@ def transform_staging_to_dwh():
             # 3. DimCustomer (consolidar de todas las fuentes, dedup por email)
             logger.info("\n📊 Transformando staging → dwh.DimCustomer...")
             cur.execute("""
-                INSERT INTO dwh.DimCustomer (name, email, gender, country, created_at)
+                MERGE dwh.DimCustomer AS t
+                USING (
                 SELECT 
                     name,
                     email,
@@ -124,15 +187,27 @@ def transform_staging_to_dwh():
                     ) all_sources
                 ) unified
                 WHERE rn = 1 AND email IS NOT NULL
+                ) AS s
+                ON t.email = s.email
+                WHEN MATCHED AND EXISTS (
+                    SELECT s.name, s.gender, s.country
+                    EXCEPT
+                    SELECT t.name, t.gender, t.country
+                ) THEN
+                    UPDATE SET name = s.name, gender = s.gender, country = s.country
+                WHEN NOT MATCHED THEN
+                    INSERT (name, email, gender, country, created_at)
+                    VALUES (s.name, s.email, s.gender, s.country, s.created_at_src);
             """)
             count = cur.rowcount
             conn.commit()
-            logger.info(f"✓ {count:,} clientes únicos")
+            logger.info(f"✓ {count:,} clientes insertados/actualizados")
             
             # 4. DimCategory (consolidar categorías de todos los productos)
             logger.info("\n🏷️  Transformando staging → dwh.DimCategory...")
             cur.execute("""
-                INSERT INTO dwh.DimCategory (name)
+                MERGE dwh.DimCategory AS t
+                USING (
                 SELECT DISTINCT category
                 FROM (
                     SELECT category FROM staging.mssql_products WHERE category IS NOT NULL
@@ -149,11 +224,14 @@ def transform_staging_to_dwh():
                       AND JSON_VALUE(props_json, '$.nombre') IS NOT NULL
                 ) categories
                 WHERE category IS NOT NULL AND LEN(LTRIM(RTRIM(category))) > 0
-                ORDER BY category
+                ) AS s
+                ON t.name = s.category
+                WHEN NOT MATCHED THEN
+                    INSERT (name) VALUES (s.category);
             """)
             count = cur.rowcount
             conn.commit()
-            logger.info(f"✓ {count:,} categorías")
+            logger.info(f"✓ {count:,} categorías nuevas")
             
             # 5. DimProduct (consolidar productos de todas las fuentes CON categoryId)
             # NUEVA LÓGICA: Deduplicar por nombre y generar SKU unificado
@@ -198,23 +276,41 @@ def transform_staging_to_dwh():
                     SELECT 
                         name,
                         category,
-                        MIN(code) as original_code,
-                        ROW_NUMBER() OVER (ORDER BY MIN(name)) as row_num
+                        MIN(code) as original_code
                     FROM AllProducts
                     WHERE name IS NOT NULL AND code IS NOT NULL
                     GROUP BY name, category
+                ),
+                -- Llave natural (nombre, categoría): solo los que aún no existen
+                NewProducts AS (
+                    SELECT 
+                        up.name,
+                        c.id as categoryId,
+                        ROW_NUMBER() OVER (ORDER BY up.name) as row_num
+                    FROM UniqueProducts up
+                    LEFT JOIN dwh.DimCategory c ON c.name = up.category
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM dwh.DimProduct dp
+                        WHERE dp.name = up.name
+                          AND EXISTS (SELECT dp.categoryId INTERSECT SELECT c.id)
+                    )
+                ),
+                LastCode AS (
+                    SELECT COALESCE(MAX(CAST(SUBSTRING(code, 4, 10) AS INT)), 0) as last_num
+                    FROM dwh.DimProduct
+                    WHERE code LIKE 'SKU[0-9][0-9][0-9][0-9][0-9]'
                 )
                 INSERT INTO dwh.DimProduct (name, code, categoryId)
                 SELECT 
-                    up.name,
-                    'SKU' + RIGHT('00000' + CAST(up.row_num as VARCHAR), 5) as unified_code,
-                    c.id as categoryId
-                FROM UniqueProducts up
-                LEFT JOIN dwh.DimCategory c ON c.name = up.category
+                    np.name,
+                    'SKU' + RIGHT('00000' + CAST(lc.last_num + np.row_num as VARCHAR), 5) as unified_code,
+                    np.categoryId
+                FROM NewProducts np
+                CROSS JOIN LastCode lc
             """)
             count = cur.rowcount
             conn.commit()
-            logger.info(f"✓ {count:,} productos únicos insertados")
+            logger.info(f"✓ {count:,} productos nuevos insertados")
             
             # Paso 2: Poblar staging.map_producto con todos los mapeos
             logger.info("📋 Poblando staging.map_producto con mapeos...")
@@ -270,33 +366,37 @@ def transform_staging_to_dwh():
             
             # 6. DimTime (generar para 2024-2025)
             logger.info("\n📅 Generando dwh.DimTime...")
-            start_date = datetime(2024, 1, 1)
-            end_date = datetime(2025, 12, 31)
-            dates = []
-            current = start_date
-            while current <= end_date:
-                dates.append((
-                    current.year,
-                    current.month,
-                    current.day,
-                    current.strftime('%Y-%m-%d')
-                ))
-                current += timedelta(days=1)
-            
-            cur.executemany("""
-                INSERT INTO dwh.DimTime (year, month, day, date)
-                VALUES (%s, %s, %s, %s)
-            """, dates)
+            start_date = datetime(2024, 1, 1).date()
+            end_date = datetime(2025, 12, 31).date()
+            cur.execute("""
+                WITH Dias AS (
+                    SELECT TOP (DATEDIFF(DAY, %(desde)s, %(hasta)s) + 1)
+                        DATEADD(DAY, ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1, CAST(%(desde)s AS DATE)) as d
+                    FROM sys.all_objects a
+                    CROSS JOIN sys.all_objects b
+                )
+                MERGE dwh.DimTime AS t
+                USING Dias AS s
+                ON t.date = s.d
+                WHEN NOT MATCHED THEN
+                    INSERT (year, month, day, date)
+                    VALUES (YEAR(s.d), MONTH(s.d), DAY(s.d), s.d);
+            """, {"desde": start_date, "hasta": end_date})
             count = cur.rowcount
             conn.commit()
-            logger.info(f"✓ {count:,} fechas")
+            logger.info(f"✓ {count:,} fechas nuevas")
             
             # 7. DimChannel - con IDs fijos 1-5
             logger.info("\n📡 Poblando dwh.DimChannel...")
             cur.execute("SET IDENTITY_INSERT dwh.DimChannel ON")
             cur.execute("""
-                INSERT INTO dwh.DimChannel (id, name)
-                VALUES (1, 'WEB'), (2, 'TIENDA'), (3, 'APP'), (4, 'PARTNER'), (5, 'TELEFONO')
+                MERGE dwh.DimChannel AS t
+                USING (
+                    VALUES (1, 'WEB'), (2, 'TIENDA'), (3, 'APP'), (4, 'PARTNER'), (5, 'TELEFONO')
+                ) AS s (id, name)
+                ON t.name = s.name
+                WHEN NOT MATCHED THEN
+                    INSERT (id, name) VALUES (s.id, s.name);
             """)
             cur.execute("SET IDENTITY_INSERT dwh.DimChannel OFF")
             conn.commit()
@@ -305,65 +405,91 @@ def transform_staging_to_dwh():
             # 8. DimOrder - crear órdenes reales desde staging
             logger.info("\n📝 Transformando staging → dwh.DimOrder...")
             
-            # Crear órdenes desde cada fuente
+            # Una fila por orden de cada fuente, con llave natural (source_system, source_order_key)
             cur.execute("""
-                INSERT INTO dwh.DimOrder (totalOrderUSD)
-                SELECT DISTINCT
-                    COALESCE(total_amount, 0.0) as totalOrderUSD
-                FROM (
-                    -- MSSQL orders (agrupar por order_key)
-                    SELECT order_key, SUM(quantity * unit_price) as total_amount
-                    FROM staging.mssql_sales
-                    GROUP BY order_key
-                    
-                    UNION ALL
-                    
-                    -- MySQL orders (agrupar por order_key)
-                    SELECT order_key, SUM(quantity * unit_price) as total_amount
-                    FROM staging.mysql_sales
-                    GROUP BY order_key
-                    
-                    UNION ALL
-                    
-                    -- MongoDB orders
-                    SELECT source_key as order_key, total_amount
-                    FROM staging.mongo_orders
-                    
-                    UNION ALL
-                    
-                    -- Supabase orders
-                    SELECT source_key as order_key, total_amount
-                    FROM staging.supabase_orders
-                    
-                    UNION ALL
-                    
-                    -- Neo4j orders (agrupar por order_key)
-                    SELECT order_key, SUM(quantity * unit_price) as total_amount
-                    FROM staging.neo4j_order_items
-                    GROUP BY order_key
-                ) orders
-                WHERE total_amount > 0
+                MERGE dwh.DimOrder AS t
+                USING (
+                    SELECT source_system, order_key, CAST(total_amount AS DECIMAL(10,2)) as total_amount
+                    FROM (
+                        -- MSSQL orders (agrupar por order_key)
+                        SELECT source_system, order_key, SUM(quantity * unit_price) as total_amount
+                        FROM staging.mssql_sales
+                        WHERE order_key IS NOT NULL
+                        GROUP BY source_system, order_key
+                        
+                        UNION ALL
+                        
+                        -- MySQL orders (agrupar por order_key)
+                        SELECT source_system, order_key, SUM(quantity * unit_price) as total_amount
+                        FROM staging.mysql_sales
+                        WHERE order_key IS NOT NULL
+                        GROUP BY source_system, order_key
+                        
+                        UNION ALL
+                        
+                        -- MongoDB orders
+                        SELECT source_system, source_key as order_key, total_amount
+                        FROM staging.mongo_orders
+                        
+                        UNION ALL
+                        
+                        -- Supabase orders
+                        SELECT source_system, source_key as order_key, total_amount
+                        FROM staging.supabase_orders
+                        
+                        UNION ALL
+                        
+                        -- Neo4j orders (agrupar por order_key)
+                        SELECT source_system, order_key, SUM(quantity * unit_price) as total_amount
+                        FROM staging.neo4j_order_items
+                        GROUP BY source_system, order_key
+                    ) orders
+                    WHERE total_amount > 0
+                ) AS s
+                ON t.source_system = s.source_system AND t.source_order_key = s.order_key
+                WHEN MATCHED AND t.totalOrderUSD <> s.total_amount THEN
+                    UPDATE SET totalOrderUSD = s.total_amount
+                WHEN NOT MATCHED THEN
+                    INSERT (totalOrderUSD, source_system, source_order_key)
+                    VALUES (s.total_amount, s.source_system, s.order_key);
             """)
             count = cur.rowcount
             conn.commit()
-            logger.info(f"✓ {count:,} órdenes creadas")
+            logger.info(f"✓ {count:,} órdenes insertadas/actualizadas")
             
             # 9. FactSales (consolidar ventas de todas las fuentes)
             logger.info("\n💰 Transformando staging → dwh.FactSales...")
             logger.info("   (Esto puede tardar 1-2 minutos...)")
+
+            # Líneas de staging modificadas desde el corte: se reemplaza su hecho.
+            # Las nuevas entran solas por el NOT EXISTS sobre (source_system, source_key).
+            if cutoff is not None:
+                replaced = 0
+                for changed_sql in (
+                    "SELECT source_system, source_key FROM staging.mssql_sales WHERE fecha_carga >= %(cutoff)s",
+                    "SELECT source_system, source_key FROM staging.mysql_sales WHERE fecha_carga >= %(cutoff)s",
+                    """SELECT oi.source_system, oi.source_key
+                       FROM staging.mongo_order_items oi
+                       LEFT JOIN staging.mongo_orders mo ON mo.source_key = oi.order_key
+                       WHERE oi.fecha_carga >= %(cutoff)s OR mo.fecha_carga >= %(cutoff)s""",
+                    "SELECT source_system, source_key FROM staging.neo4j_order_items WHERE fecha_carga >= %(cutoff)s",
+                    """SELECT oi.source_system, oi.source_key
+                       FROM staging.supabase_order_items oi
+                       LEFT JOIN staging.supabase_orders so ON so.source_key = oi.order_key
+                       WHERE oi.fecha_carga >= %(cutoff)s OR so.fecha_carga >= %(cutoff)s""",
+                ):
+                    replaced += delete_changed_facts(cur, changed_sql, params)
+                conn.commit()
+                logger.info(f"   • {replaced:,} hechos con cambios en staging serán recargados")
             
             # 9.1 MSSQL sales
             logger.info("   • Cargando MSSQL sales...")
             cur.execute("""
-                WITH mssql_orders AS (
-                    SELECT order_key, SUM(quantity * unit_price) as total
-                    FROM staging.mssql_sales
-                    GROUP BY order_key
-                )
                 INSERT INTO dwh.FactSales (
                     productId, timeId, customerId, channelId, orderId,
                     productCant, productUnitPriceUSD, lineTotalUSD, 
-                    discountPercentage, exchangeRateId, created_at
+                    discountPercentage, exchangeRateId, created_at,
+                    source_system, source_key, etlBatchId
                 )
                 SELECT 
                     p.id as productId,
@@ -388,8 +514,11 @@ def transform_staging_to_dwh():
                         ELSE s.quantity * s.unit_price
                     END as lineTotalUSD,
                     0.0 as discountPercentage,
-                    ex.id as exchangeRateId,
-                    GETDATE() as created_at
+                    ex.exchangeRateId as exchangeRateId,
+                    GETDATE() as created_at,
+                    s.source_system,
+                    s.source_key,
+                    %(batch)s as etlBatchId
                 FROM staging.mssql_sales s
                 INNER JOIN staging.mssql_products sp ON sp.source_key = s.product_key AND sp.source_system = 'MSSQL_SRC'
                 INNER JOIN staging.mssql_customers sc ON sc.source_key = s.customer_key AND sc.source_system = 'MSSQL_SRC'
@@ -397,11 +526,14 @@ def transform_staging_to_dwh():
                 INNER JOIN dwh.DimProduct p ON p.code = mp.sku_oficial
                 INNER JOIN dwh.DimCustomer c ON c.email = sc.email
                 INNER JOIN dwh.DimTime t ON t.date = s.order_date
-                LEFT JOIN dwh.DimExchangeRate ex ON ex.date = s.order_date AND ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD'
-                LEFT JOIN mssql_orders mo ON mo.order_key = s.order_key
-                LEFT JOIN dwh.DimOrder o ON ABS(o.totalOrderUSD - mo.total) < 0.01
+                LEFT JOIN dwh.ExchangeRateCalendar ex ON ex.date = s.order_date AND ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD'
+                LEFT JOIN dwh.DimOrder o ON o.source_system = s.source_system AND o.source_order_key = s.order_key
                 WHERE s.quantity > 0 AND s.unit_price > 0
-            """)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM dwh.FactSales f
+                      WHERE f.source_system = s.source_system AND f.source_key = s.source_key
+                  )
+            """, params)
             count_mssql = cur.rowcount
             conn.commit()
             logger.info(f"   ✓ {count_mssql:,} ventas de MSSQL")
@@ -409,15 +541,11 @@ def transform_staging_to_dwh():
             # 7.2 MySQL sales
             logger.info("   • Cargando MySQL sales...")
             cur.execute("""
-                WITH mysql_orders AS (
-                    SELECT order_key, SUM(quantity * unit_price) as total
-                    FROM staging.mysql_sales
-                    GROUP BY order_key
-                )
                 INSERT INTO dwh.FactSales (
                     productId, timeId, customerId, channelId, orderId,
                     productCant, productUnitPriceUSD, lineTotalUSD, 
-                    discountPercentage, exchangeRateId, created_at
+                    discountPercentage, exchangeRateId, created_at,
+                    source_system, source_key, etlBatchId
                 )
                 SELECT 
                     p.id as productId,
@@ -442,19 +570,25 @@ def transform_staging_to_dwh():
                         ELSE s.quantity * s.unit_price
                     END as lineTotalUSD,
                     0.0 as discountPercentage,
-                    ex.id as exchangeRateId,
-                    GETDATE() as created_at
+                    ex.exchangeRateId as exchangeRateId,
+                    GETDATE() as created_at,
+                    s.source_system,
+                    s.source_key,
+                    %(batch)s as etlBatchId
                 FROM staging.mysql_sales s
                 INNER JOIN staging.mysql_customers mc ON mc.source_key = s.customer_key AND mc.source_system = 'MySQL'
                 INNER JOIN staging.map_producto mp ON mp.source_code = s.sku AND mp.source_system = 'MySQL'
                 INNER JOIN dwh.DimProduct p ON p.code = mp.sku_oficial
                 INNER JOIN dwh.DimCustomer c ON c.email = mc.correo
                 INNER JOIN dwh.DimTime t ON t.date = s.order_date
-                LEFT JOIN dwh.DimExchangeRate ex ON ex.date = s.order_date AND ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD'
-                LEFT JOIN mysql_orders mo ON mo.order_key = s.order_key
-                LEFT JOIN dwh.DimOrder o ON ABS(o.totalOrderUSD - mo.total) < 0.01
+                LEFT JOIN dwh.ExchangeRateCalendar ex ON ex.date = s.order_date AND ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD'
+                LEFT JOIN dwh.DimOrder o ON o.source_system = s.source_system AND o.source_order_key = s.order_key
                 WHERE s.quantity > 0 AND s.unit_price > 0
-            """)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM dwh.FactSales f
+                      WHERE f.source_system = s.source_system AND f.source_key = s.source_key
+                  )
+            """, params)
             count_mysql = cur.rowcount
             conn.commit()
             logger.info(f"   ✓ {count_mysql:,} ventas de MySQL")
@@ -465,7 +599,8 @@ def transform_staging_to_dwh():
                 INSERT INTO dwh.FactSales (
                     productId, timeId, customerId, channelId, orderId,
                     productCant, productUnitPriceUSD, lineTotalUSD, 
-                    discountPercentage, exchangeRateId, created_at
+                    discountPercentage, exchangeRateId, created_at,
+                    source_system, source_key, etlBatchId
                 )
                 SELECT 
                     p.id as productId,
@@ -485,23 +620,30 @@ def transform_staging_to_dwh():
                         ELSE oi.quantity * oi.unit_price
                     END as lineTotalUSD,
                     0.0 as discountPercentage,
-                    ex.id as exchangeRateId,
-                    GETDATE() as created_at
+                    ex.exchangeRateId as exchangeRateId,
+                    GETDATE() as created_at,
+                    oi.source_system,
+                    oi.source_key,
+                    %(batch)s as etlBatchId
                 FROM staging.mongo_order_items oi
                 INNER JOIN staging.mongo_orders mo ON mo.source_key = oi.order_key AND mo.source_system = 'MongoDB'
                 INNER JOIN staging.mongo_customers mc ON mc.source_key = mo.customer_key AND mc.source_system = 'MongoDB'
                 INNER JOIN dwh.DimCustomer c ON c.email = mc.email
                 INNER JOIN dwh.DimTime t ON t.date = oi.order_date
-                LEFT JOIN dwh.DimExchangeRate ex ON ex.date = oi.order_date AND ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD'
+                LEFT JOIN dwh.ExchangeRateCalendar ex ON ex.date = oi.order_date AND ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD'
                 -- Mapear producto desde staging.mongo_products usando product_key
                 INNER JOIN staging.mongo_products mp ON mp.source_key = oi.product_key AND mp.source_system = 'MongoDB'
                 INNER JOIN staging.map_producto mprod ON mprod.source_code = mp.codigo_mongo AND mprod.source_system = 'MongoDB'
                 INNER JOIN dwh.DimProduct p ON p.code = mprod.sku_oficial
-                LEFT JOIN dwh.DimOrder o ON ABS(o.totalOrderUSD - mo.total_amount) < 0.01
+                LEFT JOIN dwh.DimOrder o ON o.source_system = mo.source_system AND o.source_order_key = mo.source_key
                 WHERE oi.quantity > 0 
                   AND oi.unit_price > 0 
                   AND oi.product_key IS NOT NULL
-            """)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM dwh.FactSales f
+                      WHERE f.source_system = oi.source_system AND f.source_key = oi.source_key
+                  )
+            """, params)
             count_mongo = cur.rowcount
             conn.commit()
             logger.info(f"   ✓ {count_mongo:,} ventas de MongoDB")
@@ -509,15 +651,11 @@ def transform_staging_to_dwh():
             # 7.4 Neo4j order_items
             logger.info("   • Cargando Neo4j order_items...")
             cur.execute("""
-                WITH neo4j_orders AS (
-                    SELECT order_key, SUM(quantity * unit_price) as total
-                    FROM staging.neo4j_order_items
-                    GROUP BY order_key
-                )
                 INSERT INTO dwh.FactSales (
                     productId, timeId, customerId, channelId, orderId,
                     productCant, productUnitPriceUSD, lineTotalUSD, 
-                    discountPercentage, exchangeRateId, created_at
+                    discountPercentage, exchangeRateId, created_at,
+                    source_system, source_key, etlBatchId
                 )
                 SELECT 
                     p.id as productId,
@@ -537,19 +675,25 @@ def transform_staging_to_dwh():
                         ELSE oi.quantity * oi.unit_price
                     END as lineTotalUSD,
                     0.0 as discountPercentage,
-                    ex.id as exchangeRateId,
-                    GETDATE() as created_at
+                    ex.exchangeRateId as exchangeRateId,
+                    GETDATE() as created_at,
+                    oi.source_system,
+                    oi.source_key,
+                    %(batch)s as etlBatchId
                 FROM staging.neo4j_order_items oi
                 INNER JOIN staging.neo4j_nodes nc ON nc.node_key = oi.customer_key AND nc.node_label = 'Cliente'
                 INNER JOIN dwh.DimCustomer c ON c.email = JSON_VALUE(nc.props_json, '$.email')
                 INNER JOIN staging.map_producto mp ON mp.source_code = oi.product_key AND mp.source_system = 'Neo4j'
                 INNER JOIN dwh.DimProduct p ON p.code = mp.sku_oficial
                 INNER JOIN dwh.DimTime t ON t.date = oi.order_date
-                LEFT JOIN dwh.DimExchangeRate ex ON ex.date = oi.order_date AND ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD'
-                LEFT JOIN neo4j_orders no ON no.order_key = oi.order_key
-                LEFT JOIN dwh.DimOrder o ON ABS(o.totalOrderUSD - no.total) < 0.01
+                LEFT JOIN dwh.ExchangeRateCalendar ex ON ex.date = oi.order_date AND ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD'
+                LEFT JOIN dwh.DimOrder o ON o.source_system = oi.source_system AND o.source_order_key = oi.order_key
                 WHERE oi.quantity > 0 AND oi.unit_price > 0 AND oi.product_key IS NOT NULL
-            """)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM dwh.FactSales f
+                      WHERE f.source_system = oi.source_system AND f.source_key = oi.source_key
+                  )
+            """, params)
             count_neo4j = cur.rowcount
             conn.commit()
             logger.info(f"   ✓ {count_neo4j:,} ventas de Neo4j")
@@ -560,7 +704,8 @@ def transform_staging_to_dwh():
                 INSERT INTO dwh.FactSales (
                     productId, timeId, customerId, channelId, orderId,
                     productCant, productUnitPriceUSD, lineTotalUSD, 
-                    discountPercentage, exchangeRateId, created_at
+                    discountPercentage, exchangeRateId, created_at,
+                    source_system, source_key, etlBatchId
                 )
                 SELECT 
                     p.id as productId,
@@ -572,8 +717,11 @@ def transform_staging_to_dwh():
                     oi.unit_price,
                     oi.subtotal as lineTotalUSD,
                     0.0 as discountPercentage,
-                    ex.id as exchangeRateId,
-                    GETDATE() as created_at
+                    ex.exchangeRateId as exchangeRateId,
+                    GETDATE() as created_at,
+                    oi.source_system,
+                    oi.source_key,
+                    %(batch)s as etlBatchId
                 FROM staging.supabase_order_items oi
                 INNER JOIN staging.supabase_orders so ON so.source_key = oi.order_key AND so.source_system = 'SUPABASE'
                 INNER JOIN staging.supabase_users su ON su.source_key = so.user_key AND su.source_system = 'SUPABASE'
@@ -582,16 +730,23 @@ def transform_staging_to_dwh():
                 INNER JOIN staging.map_producto mp ON mp.source_code = sp.source_key AND mp.source_system = 'Supabase'
                 INNER JOIN dwh.DimProduct p ON p.code = mp.sku_oficial
                 INNER JOIN dwh.DimTime t ON t.date = CAST(so.created_at_src AS DATE)
-                LEFT JOIN dwh.DimExchangeRate ex ON ex.date = CAST(so.created_at_src AS DATE) AND ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD'
-                LEFT JOIN dwh.DimOrder o ON ABS(o.totalOrderUSD - so.total_amount) < 0.01
+                LEFT JOIN dwh.ExchangeRateCalendar ex ON ex.date = CAST(so.created_at_src AS DATE) AND ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD'
+                LEFT JOIN dwh.DimOrder o ON o.source_system = so.source_system AND o.source_order_key = so.source_key
                 WHERE oi.quantity > 0 AND oi.unit_price > 0
-            """)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM dwh.FactSales f
+                      WHERE f.source_system = oi.source_system AND f.source_key = oi.source_key
+                  )
+            """, params)
             count_supabase = cur.rowcount
             conn.commit()
             logger.info(f"   ✓ {count_supabase:,} ventas de Supabase")
             
             total_ventas = count_mssql + count_mysql + count_mongo + count_neo4j + count_supabase
             logger.info(f"   📊 Total: {total_ventas:,} transacciones cargadas")
+
+            finish_batch(cur, batch_id, total_ventas)
+            conn.commit()
             
             # Verificación Final
             logger.info("\n" + "="*60)
@@ -645,7 +800,7 @@ def transform_staging_to_dwh():
 if __name__ == "__main__":
     inicio = datetime.now()
     try:
-        transform_staging_to_dwh()
+        transform_staging_to_dwh(full_refresh=True if "--full-refresh" in sys.argv[1:] else None)
         duracion = (datetime.now() - inicio).total_seconds()
         logger.info(f"\n⏱️  {duracion:.1f}s")
     except Exception as e:
@@ -68,14 +68,13 @@ exports.getByProduct = async (req, res) => {
         r.Confidence,
         r.Lift,
         r.FechaCalculo
-      FROM dwh.ProductAssociationRules r
-      WHERE (
-        r.AntecedentProductIds = '${productId}'
-        OR r.AntecedentProductIds LIKE '${productId},%'
-        OR r.AntecedentProductIds LIKE '%,${productId},%'
-        OR r.AntecedentProductIds LIKE '%,${productId}'
-      )
-      AND r.Activo = 1
+      FROM dwh.AssociationRuleSetActive a
+      INNER JOIN dwh.ProductAssociationRuleItems i
+        ON i.ProductId = ${parseInt(productId, 10) || 0}
+        AND i.Role = 'A'
+        AND i.RuleSetId = a.RuleSetId
+      INNER JOIN dwh.ProductAssociationRules r ON r.RuleID = i.RuleID
+      WHERE a.Scope = 'global'
       ORDER BY r.Lift DESC
     `;
     
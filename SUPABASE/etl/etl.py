@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
 
 from conexion import *
@@ -45,40 +46,6 @@ def fetch_all_rows(supabase: Client, table_name: str, batch_size: int = 1000):
     return all_rows
 
 
-def generate_sku_for_product(cursor, product_row: dict) -> str:
-    # Buscar el último servicio ya creado (S + 4 dígitos), ordenado desc
-    cursor.execute(
-        """
-        SELECT TOP 1 code
-        FROM DimProduct
-        WHERE code LIKE 'S____'
-        ORDER BY code DESC;
-        """
-    )
-    row = cursor.fetchone()
-
-    last_number = 0
-    if row and row[0]:
-        last_code = str(row[0])
-
-        # Esperamos algo como "S0007"
-        if last_code[0].upper() == "S" and len(last_code) >= 2:
-            try:
-                last_number = int(last_code[1:])  # convierte "0007" → 7
-            except ValueError:
-                # Si por alguna razón el código no es numérico después de la S, empezamos desde 0
-                last_number = 0
-
-    new_number = last_number + 1
-    if new_number > 9999:
-        raise RuntimeError("Se alcanzó el máximo de códigos de servicio (S9999).")
-
-    # Formato: S + 4 dígitos, con ceros a la izquierda (S0001, S0002, ...)
-    new_code = f"S{new_number:04d}"
-    return new_code
-
-
-
 # ===============================
 #  LOG DE FECHAS PROCESADAS
 # ===============================
@@ -116,193 +83,378 @@ def append_processed_dates(new_dates: set[date]) -> None:
 
 
 # ===============================
-#  LOOKUPS / INSERTS EN DIMENSIONES
+#  CARGA SET-BASED A DIMENSIONES
 # ===============================
 
-def get_or_create_customer(cursor, nombre, email, genero, pais, fecha_registro) -> int:
-    # 1 buscar por emial
-    cursor.execute(
-        "SELECT id FROM DimCustomer WHERE email = ?",
-        (email,)
-    )
-    row = cursor.fetchone()
-    if row:
-        return int(row[0])
+# Detalles → FactSales: una sentencia INSERT ... SELECT por lote
+FACT_BATCH_SIZE = 5000
 
-    # 2 si no existe, inserta
-    gender_norm = genero
+# Búsquedas on-demand de filas fuera de rango: ids por request y requests simultáneas
+LOOKUP_BATCH_SIZE = int(os.getenv("SUPABASE_LOOKUP_BATCH_SIZE", "100"))
+LOOKUP_MAX_WORKERS = int(os.getenv("SUPABASE_LOOKUP_MAX_WORKERS", "4"))
 
-    #convertir fecharegistro a datetime para poder meterlo en createdat
-    if isinstance(fecha_registro, datetime):
-        created_at = fecha_registro
-    else:
-        created_at = datetime.combine(fecha_registro, datetime.min.time())
+# Llaves ya resueltas en este proceso (UUID Supabase -> ID DW).
+# Solo se actualizan después de un commit exitoso.
+CUSTOMER_KEYS: dict[str, int] = {}
+PRODUCT_KEYS: dict[str, int] = {}
 
-    cursor.execute(
-        """
-        INSERT INTO DimCustomer (name, email, gender, country, created_at)
-        OUTPUT INSERTED.id
-        VALUES (?, ?, ?, ?, ?);
-        """,
-        (nombre, email, gender_norm, pais, created_at)
-    )
-    new_id_row = cursor.fetchone()
-    if not new_id_row or new_id_row[0] is None:
-        raise RuntimeError("No se pudo obtener el ID insertado para DimCustomer")
 
-    return int(new_id_row[0])
+def parse_datetime(value) -> datetime:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    # Las columnas DATETIME de SQL Server no guardan zona horaria
+    return value.replace(tzinfo=None)
 
 
+def fetch_rows_by_id(supabase: Client, table_name: str, key_column: str, ids) -> list[dict]:
+    """
+    Trae de Supabase las filas de `ids` que quedaron fuera del rango de fechas.
+    Los ids se piden en lotes con un filtro in_() y los lotes en paralelo con
+    concurrencia acotada: miles de ids cuestan unas pocas requests.
+    """
+    ids = sorted(ids)
+    batches = [ids[i:i + LOOKUP_BATCH_SIZE] for i in range(0, len(ids), LOOKUP_BATCH_SIZE)]
+    if not batches:
+        return []
 
-def get_or_create_category(cursor, categoria: str) -> int:
-    cursor.execute(
-        "SELECT id FROM DimCategory WHERE name = ?",
-        (categoria,)
+    def fetch_batch(batch: list) -> list[dict]:
+        resp = supabase.table(table_name).select("*").in_(key_column, batch).execute()
+        return resp.data or []
+
+    rows = []
+    with ThreadPoolExecutor(max_workers=min(LOOKUP_MAX_WORKERS, len(batches))) as pool:
+        for data in pool.map(fetch_batch, batches):
+            rows.extend(data)
+    print(f"{table_name}: {len(rows)} de {len(ids)} filas en {len(batches)} requests")
+    return rows
+
+
+def bulk_insert(cursor, table: str, columns: list[str], rows: list[tuple]) -> None:
+    if not rows:
+        return
+    placeholders = ", ".join("?" for _ in columns)
+    cursor.fast_executemany = True
+    cursor.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders});",
+        rows
     )
-    row = cursor.fetchone()
-    if row:
-        return int(row[0])
 
+
+def create_temp_tables(cursor) -> None:
     cursor.execute(
         """
-        INSERT INTO DimCategory (name)
-        OUTPUT INSERTED.id
-        VALUES (?);
-        """,
-        (categoria,)
+        CREATE TABLE #cliente (
+            cliente_id NVARCHAR(64) NOT NULL,
+            nombre NVARCHAR(100),
+            email NVARCHAR(150),
+            genero NVARCHAR(10),
+            pais NVARCHAR(50),
+            created_at DATETIME
+        );
+        CREATE TABLE #producto (
+            producto_id NVARCHAR(64) NOT NULL,
+            nombre NVARCHAR(150),
+            categoria NVARCHAR(100),
+            sku NVARCHAR(50)
+        );
+        CREATE TABLE #orden (
+            orden_id NVARCHAR(64) NOT NULL PRIMARY KEY,
+            customerId INT NOT NULL,
+            fecha DATETIME NOT NULL,
+            channelType VARCHAR(50) NOT NULL,
+            moneda CHAR(3) NOT NULL,
+            total DECIMAL(18,2) NOT NULL
+        );
+        CREATE TABLE #orden_map (
+            orden_id NVARCHAR(64) NOT NULL PRIMARY KEY,
+            orderId INT NOT NULL
+        );
+        CREATE TABLE #detalle (
+            orden_id NVARCHAR(64) NOT NULL,
+            productId INT NOT NULL,
+            cantidad INT NOT NULL,
+            precio_unit DECIMAL(18,4) NOT NULL
+        );
+        """
     )
-    new_id_row = cursor.fetchone()
-    if not new_id_row or new_id_row[0] is None:
-        raise RuntimeError("No se pudo obtener el ID insertado para DimCategory")
 
-    return int(new_id_row[0])
 
+def resolve_customers(cursor, clientes: list[dict]) -> dict[str, int]:
+    """MERGE de clientes en DimCustomer (llave natural: email). Devuelve UUID -> id."""
+    if not clientes:
+        return {}
+
+    cursor.execute("TRUNCATE TABLE #cliente;")
+    bulk_insert(
+        cursor,
+        "#cliente",
+        ["cliente_id", "nombre", "email", "genero", "pais", "created_at"],
+        [
+            (
+                cli["cliente_id"],
+                cli["nombre"],
+                cli["email"],
+                cli["genero"],
+                cli["pais"],
+                datetime.combine(parse_datetime(cli["fecha_registro"]).date(), datetime.min.time()),
+            )
+            for cli in clientes
+        ]
+    )
+    cursor.execute(
+        """
+        MERGE DimCustomer AS t
+        USING (
+            SELECT nombre, email, genero, pais, created_at
+            FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY email ORDER BY created_at) AS rn
+                FROM #cliente
+            ) c
+            WHERE rn = 1
+        ) AS s
+        ON t.email = s.email
+        WHEN NOT MATCHED THEN
+            INSERT (name, email, gender, country, created_at)
+            VALUES (s.nombre, s.email, s.genero, s.pais, s.created_at);
+        """
+    )
+    cursor.execute(
+        """
+        SELECT c.cliente_id, d.id
+        FROM #cliente c
+        JOIN DimCustomer d ON d.email = c.email;
+        """
+    )
+    return {row[0]: int(row[1]) for row in cursor.fetchall()}
 
 
-def get_or_create_product(cursor, product_row: dict, category_id: int) -> int:
-    sku = product_row.get("sku")
-    nombre = product_row["nombre"]
+def resolve_products(cursor, productos: list[dict]) -> dict[str, int]:
+    """
+    MERGE de categorías y productos. Con SKU la llave natural es el código;
+    sin SKU es (nombre, categoría) y se generan códigos de servicio S0001, S0002, ...
+    Devuelve UUID -> id.
+    """
+    if not productos:
+        return {}
+
+    cursor.execute("TRUNCATE TABLE #producto;")
+    bulk_insert(
+        cursor,
+        "#producto",
+        ["producto_id", "nombre", "categoria", "sku"],
+        [(p["producto_id"], p["nombre"], p["categoria"], p.get("sku")) for p in productos]
+    )
 
-    if sku:
-        # Buscar por SKU
-        cursor.execute(
-            "SELECT id FROM DimProduct WHERE code = ?",
-            (sku,)
-        )
-        row = cursor.fetchone()
-        if row:
-            return int(row[0])
-
-        # si no existe, insertar nuevo con ese sku
-        cursor.execute(
-            """
-            INSERT INTO DimProduct (name, code, categoryId)
-            OUTPUT INSERTED.id
-            VALUES (?, ?, ?);
-            """,
-            (nombre, sku, category_id)
-        )
-        new_id_row = cursor.fetchone()
-        if not new_id_row or new_id_row[0] is None:
-            raise RuntimeError("No se pudo obtener el ID insertado para DimProduct (con sku)")
-        return int(new_id_row[0])
+    cursor.execute(
+        """
+        MERGE DimCategory AS t
+        USING (SELECT DISTINCT categoria FROM #producto) AS s
+        ON t.name = s.categoria
+        WHEN NOT MATCHED THEN
+            INSERT (name) VALUES (s.categoria);
+        """
+    )
 
-    # si el sku es null, buscar por nombre y categoria
     cursor.execute(
         """
-        SELECT id FROM DimProduct
-        WHERE name = ? AND categoryId = ?;
-        """,
-        (nombre, category_id)
+        MERGE DimProduct AS t
+        USING (
+            SELECT p.sku, p.nombre, c.id AS categoryId
+            FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY sku ORDER BY producto_id) AS rn
+                FROM #producto
+                WHERE sku IS NOT NULL
+            ) p
+            JOIN DimCategory c ON c.name = p.categoria
+            WHERE p.rn = 1
+        ) AS s
+        ON t.code = s.sku
+        WHEN NOT MATCHED THEN
+            INSERT (name, code, categoryId) VALUES (s.nombre, s.sku, s.categoryId);
+        """
     )
-    row = cursor.fetchone()
-    if row:
-        return int(row[0])
 
-    # No existe: generar un SKU (TODO) e insertar
-    generated_sku = generate_sku_for_product(cursor, product_row)
+    cursor.execute(
+        """
+        SELECT DISTINCT p.nombre, c.id AS categoryId
+        INTO #producto_nuevo
+        FROM #producto p
+        JOIN DimCategory c ON c.name = p.categoria
+        WHERE p.sku IS NULL
+          AND NOT EXISTS (
+              SELECT 1 FROM DimProduct d
+              WHERE d.name = p.nombre AND d.categoryId = c.id
+          );
+        """
+    )
+    cursor.execute(
+        """
+        SELECT
+            (SELECT COALESCE(MAX(CAST(SUBSTRING(code, 2, 4) AS INT)), 0)
+             FROM DimProduct
+             WHERE code LIKE 'S[0-9][0-9][0-9][0-9]'),
+            (SELECT COUNT(*) FROM #producto_nuevo);
+        """
+    )
+    last_number, new_count = cursor.fetchone()
+    if last_number + new_count > 9999:
+        raise RuntimeError("Se alcanzó el máximo de códigos de servicio (S9999).")
 
     cursor.execute(
         """
         INSERT INTO DimProduct (name, code, categoryId)
-        OUTPUT INSERTED.id
-        VALUES (?, ?, ?);
+        SELECT
+            nombre,
+            'S' + RIGHT('0000' + CAST(? + ROW_NUMBER() OVER (ORDER BY nombre, categoryId) AS VARCHAR(4)), 4),
+            categoryId
+        FROM #producto_nuevo;
         """,
-        (nombre, generated_sku, category_id)
+        (last_number,)
     )
-    new_id_row = cursor.fetchone()
-    if not new_id_row or new_id_row[0] is None:
-        raise RuntimeError("No se pudo obtener el ID insertado para DimProduct (sin sku)")
-    return int(new_id_row[0])
+    cursor.execute("DROP TABLE #producto_nuevo;")
 
-def get_or_create_time(cursor, fecha: date) -> int:
     cursor.execute(
-        "SELECT id FROM DimTime WHERE date = ?",
-        (fecha,)
+        """
+        SELECT producto_id, MIN(productId)
+        FROM (
+            SELECT p.producto_id, d.id AS productId
+            FROM #producto p
+            JOIN DimProduct d ON d.code = p.sku
+            WHERE p.sku IS NOT NULL
+            UNION ALL
+            SELECT p.producto_id, d.id
+            FROM #producto p
+            JOIN DimCategory c ON c.name = p.categoria
+            JOIN DimProduct d ON d.name = p.nombre AND d.categoryId = c.id
+            WHERE p.sku IS NULL
+        ) m
+        GROUP BY producto_id;
+        """
+    )
+    return {row[0]: int(row[1]) for row in cursor.fetchall()}
+
+
+def load_orders(cursor, ordenes: list[tuple[dict, datetime]], customer_keys: dict[str, int]) -> None:
+    """Carga las órdenes en #orden y resuelve DimTime, DimChannel y DimOrder con MERGE."""
+    bulk_insert(
+        cursor,
+        "#orden",
+        ["orden_id", "customerId", "fecha", "channelType", "moneda", "total"],
+        [
+            (
+                ord_row["orden_id"],
+                customer_keys[ord_row["cliente_id"]],
+                fecha_dt,
+                map_channel_type(ord_row["canal"]),
+                ord_row["moneda"],
+                float(ord_row["total"]),
+            )
+            for ord_row, fecha_dt in ordenes
+        ]
     )
-    row = cursor.fetchone()
-    if row:
-        return int(row[0])
-
-    year = fecha.year
-    month = fecha.month
-    day = fecha.day
 
     cursor.execute(
         """
-        INSERT INTO DimTime (year, month, day, date)
-        OUTPUT INSERTED.id
-        VALUES (?, ?, ?, ?);
-        """,
-        (year, month, day, fecha)
+        MERGE DimTime AS t
+        USING (SELECT DISTINCT CAST(fecha AS DATE) AS d FROM #orden) AS s
+        ON t.date = s.d
+        WHEN NOT MATCHED THEN
+            INSERT (year, month, day, date) VALUES (YEAR(s.d), MONTH(s.d), DAY(s.d), s.d);
+        """
+    )
+    cursor.execute(
+        """
+        MERGE DimChannel AS t
+        USING (SELECT DISTINCT channelType FROM #orden) AS s
+        ON t.channelType = s.channelType
+        WHEN NOT MATCHED THEN
+            INSERT (channelType) VALUES (s.channelType);
+        """
     )
-    new_row = cursor.fetchone()
-
-    return int(new_row[0])
-
-
-
-def get_or_create_channel(cursor, canal_supabase: str) -> int:
-    channel_type = map_channel_type(canal_supabase)
 
     cursor.execute(
-        "SELECT id FROM DimChannel WHERE channelType = ?",
-        (channel_type,)
+        """
+        SELECT TOP 1 CAST(o.fecha AS DATE)
+        FROM #orden o
+        LEFT JOIN DimExchangeRate ex
+            ON ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD' AND ex.date = CAST(o.fecha AS DATE)
+        WHERE ex.id IS NULL
+        ORDER BY 1;
+        """
     )
     row = cursor.fetchone()
     if row:
-        return int(row[0])
+        raise RuntimeError(f"No hay tipo de cambio en DimExchangeRate para la fecha {row[0]}")
 
+    # ON 1 = 0 => siempre inserta; OUTPUT puede referenciar la fuente y
+    # así obtenemos el mapeo orden_id -> DimOrder.id en una sola sentencia.
     cursor.execute(
         """
-        INSERT INTO DimChannel (channelType)
-        OUTPUT INSERTED.id
-        VALUES (?);
-        """,
-        (channel_type,)
+        MERGE DimOrder AS t
+        USING (
+            SELECT
+                o.orden_id,
+                CASE WHEN o.moneda = 'CRC' THEN o.total / ex.rate ELSE o.total END AS totalUSD
+            FROM #orden o
+            JOIN DimExchangeRate ex
+                ON ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD' AND ex.date = CAST(o.fecha AS DATE)
+        ) AS s
+        ON 1 = 0
+        WHEN NOT MATCHED THEN
+            INSERT (totalOrderUSD) VALUES (s.totalUSD)
+        OUTPUT s.orden_id, INSERTED.id INTO #orden_map (orden_id, orderId);
+        """
     )
-    new_id_row = cursor.fetchone()
-    if not new_id_row or new_id_row[0] is None:
-        raise RuntimeError("No se pudo obtener el ID insertado para DimChannel")
-    return int(new_id_row[0])
-
 
 
-def get_exchange_rate_for_date(cursor, fecha: date):
+def insert_fact_batch(cursor, rows: list[tuple]) -> int:
+    """Inserta un lote de detalles en FactSales con una sola sentencia."""
+    cursor.execute("TRUNCATE TABLE #detalle;")
+    bulk_insert(cursor, "#detalle", ["orden_id", "productId", "cantidad", "precio_unit"], rows)
     cursor.execute(
         """
-        SELECT id, rate
-        FROM DimExchangeRate
-        WHERE fromCurrency = 'CRC'
-          AND toCurrency = 'USD'
-          AND date = ?;
-        """,
-        (fecha,)
+        INSERT INTO FactSales (
+            productId,
+            timeId,
+            orderId,
+            channelId,
+            customerId,
+            productCant,
+            productUnitPriceUSD,
+            lineTotalUSD,
+            discountPercentage,
+            created_at,
+            exchangeRateId
+        )
+        SELECT
+            d.productId,
+            t.id,
+            m.orderId,
+            ch.id,
+            o.customerId,
+            d.cantidad,
+            p.unitPriceUSD,
+            d.cantidad * p.unitPriceUSD,
+            0.0,  -- supabase no maneja descuentos
+            o.fecha,
+            ex.id
+        FROM #detalle d
+        JOIN #orden o ON o.orden_id = d.orden_id
+        JOIN #orden_map m ON m.orden_id = d.orden_id
+        JOIN DimTime t ON t.date = CAST(o.fecha AS DATE)
+        JOIN (
+            SELECT channelType, MIN(id) AS id
+            FROM DimChannel
+            GROUP BY channelType
+        ) ch ON ch.channelType = o.channelType
+        JOIN DimExchangeRate ex
+            ON ex.fromCurrency = 'CRC' AND ex.toCurrency = 'USD' AND ex.date = CAST(o.fecha AS DATE)
+        CROSS APPLY (
+            SELECT CASE WHEN o.moneda = 'CRC' THEN d.precio_unit / ex.rate ELSE d.precio_unit END AS unitPriceUSD
+        ) p;
+        """
     )
-    row = cursor.fetchone()
-    if not row:
-        raise RuntimeError(f"No hay tipo de cambio en DimExchangeRate para la fecha {fecha}")
-    return int(row[0]), float(row[1])
+    return cursor.rowcount
 
 
 # ===============================
@@ -322,19 +474,13 @@ def run_etl_supabase_to_dw(effective_dates: set[date]):
     conn = get_dw_connection()
     cursor = conn.cursor()
 
-    # Diccionarios de mapeo (UUID Supabase -> ID DW)
-    cliente_uuid_to_id = {}
-    producto_uuid_to_id = {}
-    orden_uuid_to_id = {}
-    orden_uuid_to_time_id = {}
-    orden_uuid_to_channel_id = {}
-    orden_uuid_to_customer_id = {}
-    orden_uuid_to_exchange_rate_id = {}
-    orden_uuid_to_currency = {}
-    orden_uuid_to_rate = {}
-    orden_uuid_to_created_at = {}
+    # Copias locales de los caches: se publican solo si el commit sale bien
+    customer_keys = dict(CUSTOMER_KEYS)
+    product_keys = dict(PRODUCT_KEYS)
 
     try:
+        create_temp_tables(cursor)
+
         # =========================
         # 1. CLIENTES → DimCustomer
         # =========================
@@ -342,25 +488,13 @@ def run_etl_supabase_to_dw(effective_dates: set[date]):
         clientes = fetch_all_rows(supabase, "cliente")
         print(f"Clientes Supabase (total): {len(clientes)}")
 
-        for cli in clientes:
-            cliente_id = cli["cliente_id"]
-            nombre = cli["nombre"]
-            email = cli["email"]
-            genero = cli["genero"]
-            pais = cli["pais"]
-            fecha_registro = cli["fecha_registro"]  # Supabase suele devolver string 'YYYY-MM-DD'
-
-            if isinstance(fecha_registro, str):
-                fecha_registro = datetime.fromisoformat(fecha_registro)
-
-            fecha_cli = fecha_registro.date()
-
-            # Si la fecha de registro NO está en el rango efectivo → lo ignoramos
-            if fecha_cli not in effective_dates:
-                continue
-
-            dim_id = get_or_create_customer(cursor, nombre, email, genero, pais, fecha_cli)
-            cliente_uuid_to_id[cliente_id] = dim_id
+        # Si la fecha de registro NO está en el rango efectivo → lo ignoramos
+        clientes_rango = [
+            cli for cli in clientes
+            if cli["cliente_id"] not in customer_keys
+            and parse_datetime(cli["fecha_registro"]).date() in effective_dates
+        ]
+        customer_keys.update(resolve_customers(cursor, clientes_rango))
 
         # =========================
         # 2. PRODUCTOS → DimCategory + DimProduct
@@ -369,31 +503,14 @@ def run_etl_supabase_to_dw(effective_dates: set[date]):
         productos = fetch_all_rows(supabase, "producto")
         print(f"Productos Supabase (total): {len(productos)}")
 
-
-        for prod in productos:
-            producto_uuid = prod["producto_id"]
-            categoria = prod["categoria"]
-
-            # NUEVO: filtro por fecha_registro del producto
-            fecha_reg_raw = prod.get("fecha_registro")
-            if fecha_reg_raw is None:
-                # Si no tiene fecha_registro, por ahora lo ignoramos
-                continue
-
-            if isinstance(fecha_reg_raw, str):
-                fecha_registro = datetime.fromisoformat(fecha_reg_raw)
-            else:
-                fecha_registro = fecha_reg_raw
-
-            fecha_prod = fecha_registro.date()
-
-            if fecha_prod not in effective_dates:
-                continue
-
-            category_id = get_or_create_category(cursor, categoria)
-            product_id = get_or_create_product(cursor, prod, category_id)
-
-            producto_uuid_to_id[producto_uuid] = product_id
+        # Productos sin fecha_registro se ignoran por ahora
+        productos_rango = [
+            prod for prod in productos
+            if prod["producto_id"] not in product_keys
+            and prod.get("fecha_registro") is not None
+            and parse_datetime(prod["fecha_registro"]).date() in effective_dates
+        ]
+        product_keys.update(resolve_products(cursor, productos_rango))
 
         # =========================
         # 3. ÓRDENES → DimOrder (+ DimTime, DimChannel, DimExchangeRate)
@@ -402,96 +519,30 @@ def run_etl_supabase_to_dw(effective_dates: set[date]):
         ordenes = fetch_all_rows(supabase, "orden")
         print(f"Órdenes Supabase (total): {len(ordenes)}")
 
-
+        ordenes_rango = []
         for ord_row in ordenes:
-            orden_uuid = ord_row["orden_id"]
-            cliente_uuid = ord_row["cliente_id"]
-            fecha_raw = ord_row["fecha"]      # normalmente string ISO
-            canal = ord_row["canal"]          # 'WEB','APP','PARTNER'
-            moneda = ord_row["moneda"]        # 'USD' o 'CRC'
-            total = float(ord_row["total"])
-
-            # Parse fecha a datetime
-            if isinstance(fecha_raw, str):
-                fecha_dt = datetime.fromisoformat(fecha_raw.replace("Z", "+00:00"))
-            else:
-                fecha_dt = fecha_raw
-            fecha_only = fecha_dt.date()
-
+            fecha_dt = parse_datetime(ord_row["fecha"])
             # Si la fecha de la orden no está en el rango efectivo → ignorar esta orden
-            if fecha_only not in effective_dates:
+            if fecha_dt.date() not in effective_dates:
                 continue
-
-            # FK a DimCustomer:
-            # primero intentamos usar el mapping cargado en la fase de clientes
-            if cliente_uuid in cliente_uuid_to_id:
-                customer_id = cliente_uuid_to_id[cliente_uuid]
-            else:
-                # Cliente fue creado fuera de rango, pero igual lo necesitamos.
-                # Lo traemos directo de Supabase y lo insertamos/ubicamos en DimCustomer.
-                cli_resp = supabase.table("cliente").select("*").eq("cliente_id", cliente_uuid).execute()
-                cli_data = (cli_resp.data or [])
-                if not cli_data:
-                    raise RuntimeError(f"No se encontró cliente {cliente_uuid} para la orden {orden_uuid}")
-
-                cli = cli_data[0]
-                nombre = cli["nombre"]
-                email = cli["email"]
-                genero = cli["genero"]
-                pais = cli["pais"]
-                fecha_registro = cli["fecha_registro"]
-                if isinstance(fecha_registro, str):
-                    fecha_registro = datetime.fromisoformat(fecha_registro)
-
-                customer_id = get_or_create_customer(
-                    cursor,
-                    nombre,
-                    email,
-                    genero,
-                    pais,
-                    fecha_registro.date()
-                )
-                cliente_uuid_to_id[cliente_uuid] = customer_id
-
-            # DimTime
-            time_id = get_or_create_time(cursor, fecha_only)
-
-            # DimChannel
-            channel_id = get_or_create_channel(cursor, canal)
-
-            # DimExchangeRate
-            exchange_rate_id, rate_value = get_exchange_rate_for_date(cursor, fecha_only)
-
-            # Normalizar total a USD
-            if moneda == "USD":
-                total_usd = total
-            elif moneda == "CRC":
-                total_usd = total / rate_value
-            else:
-                raise RuntimeError(f"Moneda desconocida en orden {orden_uuid}: {moneda}")
-
-            cursor.execute(
-                """
-                INSERT INTO DimOrder (totalOrderUSD)
-                OUTPUT INSERTED.id
-                VALUES (?);
-                """,
-                (total_usd,)
-            )
-            order_id_row = cursor.fetchone()
-            if not order_id_row or order_id_row[0] is None:
-                raise RuntimeError(f"No se pudo obtener el ID insertado para DimOrder (orden {orden_uuid})")
-            order_id = int(order_id_row[0])
-
-            # Guardar mappings
-            orden_uuid_to_id[orden_uuid] = order_id
-            orden_uuid_to_time_id[orden_uuid] = time_id
-            orden_uuid_to_channel_id[orden_uuid] = channel_id
-            orden_uuid_to_customer_id[orden_uuid] = customer_id
-            orden_uuid_to_exchange_rate_id[orden_uuid] = exchange_rate_id
-            orden_uuid_to_currency[orden_uuid] = moneda
-            orden_uuid_to_rate[orden_uuid] = rate_value
-            orden_uuid_to_created_at[orden_uuid] = fecha_dt
+            if ord_row["moneda"] not in ("USD", "CRC"):
+                raise RuntimeError(f"Moneda desconocida en orden {ord_row['orden_id']}: {ord_row['moneda']}")
+            ordenes_rango.append((ord_row, fecha_dt))
+
+        # Clientes creados fuera de rango pero referenciados por órdenes del rango
+        faltantes = {ord_row["cliente_id"] for ord_row, _ in ordenes_rango} - customer_keys.keys()
+        if faltantes:
+            print(f"Clientes fuera de rango a resolver: {len(faltantes)}")
+            extra = fetch_rows_by_id(supabase, "cliente", "cliente_id", faltantes)
+            customer_keys.update(resolve_customers(cursor, extra))
+            for ord_row, _ in ordenes_rango:
+                if ord_row["cliente_id"] not in customer_keys:
+                    raise RuntimeError(
+                        f"No se encontró cliente {ord_row['cliente_id']} para la orden {ord_row['orden_id']}"
+                    )
+
+        load_orders(cursor, ordenes_rango, customer_keys)
+        orden_ids = {ord_row["orden_id"] for ord_row, _ in ordenes_rango}
 
         # =========================
         # 4. DETALLES → FactSales
@@ -500,89 +551,34 @@ def run_etl_supabase_to_dw(effective_dates: set[date]):
         detalles = fetch_all_rows(supabase, "orden_detalle")
         print(f"Detalles Supabase (total): {len(detalles)}")
 
-
-        for det in detalles:
-            orden_uuid = det["orden_id"]
-            producto_uuid = det["producto_id"]
-
-            # Si la orden no fue procesada (por estar fuera de rango), saltamos el detalle
-            if orden_uuid not in orden_uuid_to_id:
-                continue
-
-            cantidad = int(det["cantidad"])
-            precio_unit = float(det["precio_unit"])
-
-            # FKs desde mapeos en memoria
-            # Si el producto no está en el mapping (porque se creó fuera de rango),
-            # podemos traerlo on-demand desde Supabase también.
-            if producto_uuid in producto_uuid_to_id:
-                product_id = producto_uuid_to_id[producto_uuid]
-            else:
-                prod_resp = supabase.table("producto").select("*").eq("producto_id", producto_uuid).execute()
-                prod_data = prod_resp.data or []
-                if not prod_data:
-                    raise RuntimeError(f"No se encontró producto {producto_uuid} para el detalle de orden {orden_uuid}")
-                prod_row = prod_data[0]
-                categoria = prod_row["categoria"]
-                category_id = get_or_create_category(cursor, categoria)
-                product_id = get_or_create_product(cursor, prod_row, category_id)
-                producto_uuid_to_id[producto_uuid] = product_id
-
-            order_id = orden_uuid_to_id[orden_uuid]
-            time_id = orden_uuid_to_time_id[orden_uuid]
-            channel_id = orden_uuid_to_channel_id[orden_uuid]
-            customer_id = orden_uuid_to_customer_id[orden_uuid]
-            exchange_rate_id = orden_uuid_to_exchange_rate_id[orden_uuid]
-            currency = orden_uuid_to_currency[orden_uuid]
-            rate_value = orden_uuid_to_rate[orden_uuid]
-            created_at = orden_uuid_to_created_at[orden_uuid]
-
-            # Calcular precios en USD
-            if currency == "USD":
-                unit_price_usd = precio_unit
-            elif currency == "CRC":
-                unit_price_usd = precio_unit / rate_value
-            else:
-                raise RuntimeError(f"Moneda desconocida en detalle de orden {orden_uuid}: {currency}")
-
-            line_total_usd = cantidad * unit_price_usd
-            discount_percentage = 0.0  # supabase no maneja descuentos
-
-            cursor.execute(
-                """
-                INSERT INTO FactSales (
-                    productId,
-                    timeId,
-                    orderId,
-                    channelId,
-                    customerId,
-                    productCant,
-                    productUnitPriceUSD,
-                    lineTotalUSD,
-                    discountPercentage,
-                    created_at,
-                    exchangeRateId
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-                """,
-                (
-                    product_id,
-                    time_id,
-                    order_id,
-                    channel_id,
-                    customer_id,
-                    cantidad,
-                    unit_price_usd,
-                    line_total_usd,
-                    discount_percentage,
-                    created_at,
-                    exchange_rate_id
-                )
-            )
-
+        # Si la orden no fue procesada (por estar fuera de rango), saltamos el detalle
+        detalles_rango = [det for det in detalles if det["orden_id"] in orden_ids]
+
+        # Productos creados fuera de rango pero vendidos en el rango
+        faltantes = {det["producto_id"] for det in detalles_rango} - product_keys.keys()
+        if faltantes:
+            print(f"Productos fuera de rango a resolver: {len(faltantes)}")
+            extra = fetch_rows_by_id(supabase, "producto", "producto_id", faltantes)
+            product_keys.update(resolve_products(cursor, extra))
+            for det in detalles_rango:
+                if det["producto_id"] not in product_keys:
+                    raise RuntimeError(
+                        f"No se encontró producto {det['producto_id']} para el detalle de orden {det['orden_id']}"
+                    )
+
+        fact_rows = [
+            (det["orden_id"], product_keys[det["producto_id"]], int(det["cantidad"]), float(det["precio_unit"]))
+            for det in detalles_rango
+        ]
+        total_facts = 0
+        for start in range(0, len(fact_rows), FACT_BATCH_SIZE):
+            total_facts += insert_fact_batch(cursor, fact_rows[start:start + FACT_BATCH_SIZE])
+        print(f"FactSales insertadas: {total_facts}")
 
         # Si todo salió bien:
         conn.commit()
+        CUSTOMER_KEYS.update(customer_keys)
+        PRODUCT_KEYS.update(product_keys)
         print("ETL Supabase → DW completado correctamente.")
 
     except Exception as e:
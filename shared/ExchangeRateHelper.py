@@ -3,12 +3,14 @@
 Módulo ExchangeRateHelper
 Proporciona métodos para que los ETLs consulten tipos de cambio de DWH
 Uso: Cada ETL importa esto y llama a get_exchange_rate() con sus parámetros
+Para columnas completas: convertir_montos(montos, monedas, fechas)
 """
 
 import pyodbc
+import numpy as np
 from datetime import datetime, date
 import logging
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +26,9 @@ class ExchangeRateHelper:
             dw_connection_string: String de conexión a MSSQL_DW
         """
         self.connection_string = dw_connection_string
-        self.cache: Dict = {}  # Cache de tasas consultadas
+        self.cache: Dict = {}  # Cache de tasas consultadas: (de, a, fecha) -> tasa
+        # Calendarios precargados por par: (de, a) -> (fechas datetime64[D] consecutivas, tasas, desde, hasta)
+        self.series: Dict[Tuple[str, str], tuple] = {}
         self.conn = None
     
     def conectar(self):
@@ -84,13 +88,20 @@ class ExchangeRateHelper:
             fecha = fecha.date()
         
         # Clave de cache
-        cache_key = f"{de_moneda}_{a_moneda}_{fecha}"
+        cache_key = (de_moneda, a_moneda, fecha)
         
         # Consultar cache
         if usar_cache and cache_key in self.cache:
             logger.debug(f"[Cache] Tasa desde cache: {cache_key}")
             return self.cache[cache_key]
         
+        # Calendario precargado que cubre la fecha: acceso directo, sin SQL
+        if usar_cache and self._serie_cubre(de_moneda, a_moneda, fecha, fecha):
+            tasa = self.tasas_asof(de_moneda, a_moneda, [fecha])[0]
+            tasa = None if np.isnan(tasa) else float(tasa)
+            self.cache[cache_key] = tasa
+            return tasa
+        
         # Consultar base de datos
         try:
             if not self.conn:
@@ -98,33 +109,12 @@ class ExchangeRateHelper:
             
             cursor = self.conn.cursor()
             
-            # Consultar tasa exacta para la fecha
-            cursor.execute("""
-                SELECT rate 
-                FROM DimExchangeRate
-                WHERE fromCurrency = ?
-                AND toCurrency = ?
-                AND date = ?
-            """, de_moneda, a_moneda, fecha)
-            
-            row = cursor.fetchone()
-            
-            if row:
-                tasa = float(row[0])
-                # Guardar en cache
-                self.cache[cache_key] = tasa
-                logger.debug(f"[DB] Tasa obtenida: {de_moneda} -> {a_moneda} = {tasa}")
-                return tasa
-            
-            cursor.close()
-            
-            # Si no existe la fecha exacta, buscar la más cercana anterior
-            logger.warning(f"No existe tasa exacta para {fecha}, buscando anterior...")
-            cursor = self.conn.cursor()
-            
+            # Calendario denso (una fila por día, forward-fill): para fechas dentro
+            # del calendario es un seek exacto; <= solo cubre fechas posteriores
+            # a su último día
             cursor.execute("""
                 SELECT TOP 1 rate, date
-                FROM DimExchangeRate
+                FROM dwh.ExchangeRateCalendar
                 WHERE fromCurrency = ?
                 AND toCurrency = ?
                 AND date <= ?
@@ -135,11 +125,10 @@ class ExchangeRateHelper:
             
             if row:
                 tasa = float(row[0])
-                fecha_encontrada = row[1]
-                # Guardar con fecha encontrada como clave secundaria
-                cache_key_secundaria = f"{de_moneda}_{a_moneda}_{fecha_encontrada}"
-                self.cache[cache_key_secundaria] = tasa
-                logger.warning(f"Usando tasa de {fecha_encontrada}: {tasa}")
+                self.cache[cache_key] = tasa
+                if row[1] != fecha:
+                    logger.warning(f"Calendario de tasas sin {fecha}, usando {row[1]}: {tasa}")
+                logger.debug(f"[DB] Tasa obtenida: {de_moneda} -> {a_moneda} = {tasa}")
                 return tasa
             
             cursor.close()
@@ -170,7 +159,7 @@ class ExchangeRateHelper:
             tasa = helper.obtener_tasa_reciente('CRC', 'USD')
         """
         
-        cache_key = f"{de_moneda}_{a_moneda}_latest"
+        cache_key = (de_moneda, a_moneda, "latest")
         
         # Consultar cache
         if cache_key in self.cache:
@@ -275,12 +264,158 @@ class ExchangeRateHelper:
             logger.error(f"Error obteniendo rango de tasas: {e}")
             return []
     
+    def cargar_serie(
+        self,
+        de_moneda: str,
+        a_moneda: str,
+        fecha_inicio: Optional[date] = None,
+        fecha_fin: Optional[date] = None
+    ) -> int:
+        """
+        Carga en memoria el calendario denso (ExchangeRateCalendar) de un par en
+        una sola consulta: una tasa por día, ya con forward-fill, así que cada
+        lookup es un índice por desplazamiento de días.
+        
+        Args:
+            de_moneda: Moneda origen
+            a_moneda: Moneda destino
+            fecha_inicio: Fecha inicial (None = desde el inicio de la serie)
+            fecha_fin: Fecha final (None = hasta hoy)
+        
+        Returns:
+            int: Cantidad de tasas cargadas
+        """
+        fecha_fin = _a_date(fecha_fin) if fecha_fin is not None else datetime.now().date()
+        fecha_inicio = _a_date(fecha_inicio) if fecha_inicio is not None else date.min
+        
+        if not self.conn:
+            self.conectar()
+        
+        cursor = self.conn.cursor()
+        # Desde la última fila <= fecha_inicio (tasa vigente si el rango empieza
+        # después del último día del calendario) hasta fecha_fin
+        cursor.execute("""
+            SELECT date, rate
+            FROM dwh.ExchangeRateCalendar
+            WHERE fromCurrency = ?
+            AND toCurrency = ?
+            AND date <= ?
+            AND date >= COALESCE((
+                SELECT MAX(date)
+                FROM dwh.ExchangeRateCalendar
+                WHERE fromCurrency = ?
+                AND toCurrency = ?
+                AND date <= ?
+            ), ?)
+            ORDER BY date
+        """, de_moneda, a_moneda, fecha_fin, de_moneda, a_moneda, fecha_inicio, fecha_inicio)
+        rows = cursor.fetchall()
+        cursor.close()
+        
+        fechas = np.array([_a_date(row[0]) for row in rows], dtype="datetime64[D]")
+        tasas = np.array([float(row[1]) for row in rows], dtype=np.float64)
+        # Solo cubre hasta su último día: fechas posteriores vuelven a consultar
+        # (el calendario se extiende al promover nuevas tasas)
+        cubre_hasta = min(fecha_fin, fechas[-1].astype(date)) if fechas.size else None
+        self.series[(de_moneda, a_moneda)] = (fechas, tasas, fecha_inicio, cubre_hasta)
+        logger.info(f"Serie {de_moneda} -> {a_moneda}: {len(tasas)} tasas ({fecha_inicio} a {cubre_hasta})")
+        return len(tasas)
+    
+    def _serie_cubre(self, de_moneda: str, a_moneda: str, desde: date, hasta: date) -> bool:
+        serie = self.series.get((de_moneda, a_moneda))
+        return serie is not None and serie[3] is not None and serie[2] <= desde and hasta <= serie[3]
+    
+    def tasas_asof(self, de_moneda: str, a_moneda: str, fechas) -> np.ndarray:
+        """
+        Tasa vigente para cada fecha por acceso directo al calendario precargado
+        (posición = días desde su primera fecha). Fechas posteriores al último
+        día del calendario usan esa última tasa; NaN si no hay tasa o la fecha
+        falta (NaT). Carga o amplía la serie si no cubre las fechas pedidas.
+        """
+        fechas = np.asarray(fechas, dtype="datetime64[D]")
+        resultado = np.full(fechas.shape, np.nan, dtype=np.float64)
+        validas = ~np.isnat(fechas)
+        if not validas.any():
+            return resultado
+        
+        desde = fechas[validas].min().astype(date)
+        hasta = fechas[validas].max().astype(date)
+        if not self._serie_cubre(de_moneda, a_moneda, desde, hasta):
+            serie = self.series.get((de_moneda, a_moneda))
+            if serie is not None:
+                desde = min(desde, serie[2])
+                hasta = max(hasta, serie[3]) if serie[3] is not None else hasta
+            self.cargar_serie(de_moneda, a_moneda, desde, hasta)
+        
+        serie_fechas, serie_tasas, _, _ = self.series[(de_moneda, a_moneda)]
+        if serie_fechas.size == 0:
+            return resultado
+        idx = np.full(fechas.shape, -1, dtype=np.int64)
+        idx[validas] = np.minimum((fechas[validas] - serie_fechas[0]).astype(np.int64), serie_fechas.size - 1)
+        encontrada = idx >= 0
+        resultado[encontrada] = serie_tasas[idx[encontrada]]
+        return resultado
+    
+    def convertir_montos(self, montos, monedas, fechas, a_moneda: str = "USD"):
+        """
+        Convierte una columna completa de montos en una sola llamada.
+        
+        Args:
+            montos: Montos (lista, ndarray o pandas Series)
+            monedas: Moneda de cada monto, o una sola moneda para todos
+            fechas: Fecha de cada monto (date, datetime64 o 'YYYY-MM-DD')
+            a_moneda: Moneda destino
+        
+        Returns:
+            ndarray (o Series con el mismo índice si montos es Series) con los
+            montos convertidos; NaN donde no existe tasa.
+        
+        Ejemplo:
+            df["total_usd"] = helper.convertir_montos(df["total"], df["moneda"], df["fecha"])
+        """
+        valores = np.asarray(montos, dtype=np.float64)
+        fechas = np.asarray(fechas, dtype="datetime64[D]")
+        if np.ndim(monedas) == 0:
+            monedas = np.full(valores.shape, monedas, dtype=object)
+        else:
+            monedas = np.asarray(monedas, dtype=object)
+        
+        resultado = np.full(valores.shape, np.nan, dtype=np.float64)
+        for moneda in set(monedas.tolist()):
+            mascara = monedas == moneda
+            if moneda == a_moneda:
+                resultado[mascara] = valores[mascara]
+            elif moneda is not None:
+                # la tasa es de_moneda -> USD, igual que convertir_monto
+                resultado[mascara] = valores[mascara] / self.tasas_asof(moneda, a_moneda, fechas[mascara])
+        
+        faltantes = int(np.isnan(resultado).sum() - np.isnan(valores).sum())
+        if faltantes > 0:
+            logger.warning(f"{faltantes} montos sin tasa disponible para convertir a {a_moneda}")
+        
+        if hasattr(montos, "index"):
+            import pandas as pd
+            return pd.Series(resultado, index=montos.index, name=getattr(montos, "name", None))
+        return resultado
+    
     def limpiar_cache(self):
         """Limpia el cache en memoria"""
         self.cache.clear()
+        self.series.clear()
         logger.info("Cache limpiado")
 
 
+def _a_date(valor) -> date:
+    """Normaliza datetime/str/np.datetime64 a date."""
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    if isinstance(valor, np.datetime64):
+        return valor.astype("datetime64[D]").astype(date)
+    return date.fromisoformat(str(valor)[:10])
+
+
 # Ejemplo de uso en un ETL
 if __name__ == "__main__":
     
@@ -320,5 +455,14 @@ if __name__ == "__main__":
         if tasas:
             print(f"  Primera: {tasas[0]}")
             print(f"  Última: {tasas[-1]}\n")
+        
+        # Ejemplo 5: Convertir una columna completa
+        print("[EJEMPLO 5] Convertir columna de montos:")
+        usd = helper.convertir_montos(
+            [100000, 2500, 50000],
+            ['CRC', 'USD', 'CRC'],
+            [date(2024, 1, 15), date(2024, 1, 16), date(2024, 1, 20)]
+        )
+        print(f"  {usd}\n")
     
     print("=" * 80)